@@ -1,24 +1,36 @@
+import asyncio
 import logging
+import math
 import contextlib
 from starlette.applications import Starlette
+from kraken.spot import Market
 
-from starlette.routing import Route
+from starlette.routing import Route, WebSocketRoute
 from starlette.middleware import Middleware
 from starlette.templating import Jinja2Templates
-from handlers.orderbook import start_book
-from handlers.orders import start_orders
-from handlers.trades import start_trades
+from handlers.heatmap import MAX_QUERY_ROWS
+from handlers.orderbook import OrderbookHub
+from handlers.shards import ShardedOrderbookHub
 from handlers.token import get_token
-from handlers.ohlc import start_ohlc
-from handlers.spread import start_spread
 from handlers.manager import get_kraken_manager
+from handlers.rest import RestClient
+from handlers.ohlc_cache import OhlcCache
+from handlers.candles import KRAKEN_INTERVALS, CandleHub, columnar, parse_rows
+from handlers.trade_flow import TradeFlowHub
+from handlers.signals import SignalEngine
+from handlers.spread_store import HISTORY_POINTS, SpreadHub
+from handlers.order_state import OrderState
+from handlers.pairs import AssetPairs
+from handlers.broadcast import encode
+from handlers.recorder import Recorder
+from handlers.endpoints import use_kraken_endpoints
+from handlers.metrics import REGISTRY, gauge
 import uvicorn
 from starlette.config import Config
 from starlette.schemas import SchemaGenerator
-from starlette.responses import JSONResponse
+from starlette.responses import JSONResponse, PlainTextResponse, Response
 from starlette.middleware.cors import CORSMiddleware
 
-
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
@@ -29,8 +41,66 @@ schemas = SchemaGenerator(
 )
 
 pairs = ["BTC/USD"]
+# the pairs clients can ask for, loaded from Kraken at startup
+asset_pairs = AssetPairs(pairs)
+
+# Kraken or a stand-in like python -m mock_kraken
+kraken_endpoints = {
+    "rest_url": config("KRAKEN_REST_URL", cast=str, default=""),
+    "ws_url": config("KRAKEN_WS_URL", cast=str, default=""),
+    "ca_file": config("KRAKEN_CA_FILE", cast=str, default=""),
+}
+use_kraken_endpoints(**kraken_endpoints)
 
 kraken_manager = None
+record_dir = config("RECORD_DIR", cast=str, default="")
+recorder = (
+    Recorder(
+        record_dir,
+        segment_size=config("RECORD_SEGMENT_SIZE", cast=int, default=64 * 1024 * 1024),
+    )
+    if record_dir
+    else None
+)
+if recorder is not None:
+    gauge(
+        "recorder_pending_bytes",
+        "Recorded bytes waiting for the writer",
+        callback=lambda: {(): recorder.pending},
+    )
+book_shards = config("BOOK_SHARDS", cast=int, default=0)
+if book_shards:
+    if recorder is not None:
+        logger.warning("Book messages are not recorded with BOOK_SHARDS")
+    book_hub = ShardedOrderbookHub(
+        book_shards,
+        depth=config("BOOK_DEPTH", cast=int, default=100),
+        retention=config("BOOK_HISTORY_RETENTION", cast=int, default=60 * 60),
+        max_rate=config("MAX_PUBLISH_RATE", cast=float, default=10),
+        endpoints=kraken_endpoints,
+        known=asset_pairs.known,
+        release_delay=config("PAIR_RELEASE_DELAY", cast=float, default=30),
+    )
+else:
+    book_hub = OrderbookHub(
+        depth=config("BOOK_DEPTH", cast=int, default=100),
+        retention=config("BOOK_HISTORY_RETENTION", cast=int, default=60 * 60),
+        max_rate=config("MAX_PUBLISH_RATE", cast=float, default=10),
+        recorder=recorder,
+        heatmap_bucket=config("HEATMAP_BUCKET", cast=float, default=0) or None,
+        heatmap_width=config("HEATMAP_WIDTH", cast=int, default=200),
+        known=asset_pairs.known,
+        release_delay=config("PAIR_RELEASE_DELAY", cast=float, default=30),
+    )
+spread_hub = SpreadHub(
+    capacity=config("SPREAD_CAPACITY", cast=int, default=262_144),
+    release_delay=config("PAIR_RELEASE_DELAY", cast=float, default=30),
+)
+signal_engine = SignalEngine(
+    retention=config("BOOK_HISTORY_RETENTION", cast=int, default=60 * 60),
+    release_delay=config("PAIR_RELEASE_DELAY", cast=float, default=30),
+)
+rest_client = RestClient(max_workers=config("REST_MAX_WORKERS", cast=int, default=8))
 
 
 async def homepage(request):
@@ -46,15 +116,54 @@ def openapi_schema(request):
 @contextlib.asynccontextmanager
 async def lifespan(app):
     global kraken_manager
-    kraken_manager = await get_kraken_manager(pairs=pairs, config=config)
+    if recorder is not None:
+        recorder.start()
+    asset_pairs.start(lambda: rest_client.call("asset_pairs", Market().get_asset_pairs))
+    kraken_manager = await get_kraken_manager(
+        pairs=pairs, config=config, recorder=recorder, quote=spread_hub.quote
+    )
+    candle_hub.start(kraken_manager.bot.router)
+    trade_flow_hub.start(kraken_manager.bot.router)
+    await book_hub.start(pairs)
+    if not book_hub.keeps_books:
+        logger.warning("The liquidity heatmap is not served with BOOK_SHARDS")
+    signal_engine.start(book_hub, kraken_manager.bot.router)
+    await spread_hub.start(kraken_manager.bot.router, pairs)
+    await order_state.start(kraken_manager.bot.router)
     yield
+    asset_pairs.close()
+    await order_state.close()
+    rest_client.shutdown()
+    if recorder is not None:
+        await recorder.close()
     await kraken_manager.save_exit()
 
 
+async def fetch_open_orders():
+    return await rest_client.call("orders", kraken_manager.bot.get_open_orders)
+
+
+async def fetch_open_positions():
+    return await rest_client.call("positions", kraken_manager.bot.get_open_positions)
+
+
+# seeded from REST, then kept current by the openOrders and ownTrades channels
+order_state = OrderState(
+    fetch_open_orders,
+    fetch_open_positions,
+    reconcile_interval=config("ORDERS_RECONCILE_INTERVAL", cast=float, default=60),
+    max_rate=config("MAX_PUBLISH_RATE", cast=float, default=10),
+)
+
+
 async def list_orders(request):
     global kraken_manager
     if kraken_manager and kraken_manager.bot:
-        orders = kraken_manager.bot.get_open_orders()
+        try:
+            orders = await order_state.get_orders()
+        except asyncio.TimeoutError:
+            logger.error("Open orders request timed out")
+            return JSONResponse([], status_code=504)
         return JSONResponse(orders)
     else:
         logger.error("kraken_manager is not available")
@@ -64,7 +173,11 @@ async def list_orders(request):
 async def list_positions(request):
     global kraken_manager
     if kraken_manager and kraken_manager.bot:
-        positions = kraken_manager.bot.get_open_positions()
+        try:
+            positions = await order_state.get_positions()
+        except asyncio.TimeoutError:
+            logger.error("Open positions request timed out")
+            return JSONResponse([], status_code=504)
         return JSONResponse(positions)
     else:
         logger.error("kraken_manager is not available")
@@ -121,24 +234,279 @@ def transform_ohlc_tradingview(data, pair):
     }
 
 
+def transform_ohlc_columnar(data, pair):
+    return {"pair": pair, **columnar(parse_rows(data[pair]))}
+
+
+OHLC_TRANSFORMS = {
+    "tradingview": transform_ohlc_tradingview,
+    "columnar": transform_ohlc_columnar,
+}
+
+
+def fetch_ohlc_payload(pair, interval, format):
+    ohlc_data = kraken_manager.bot.get_ohlc(pair, interval)
+    return encode(OHLC_TRANSFORMS[format](ohlc_data, pair))
+
+
+async def fetch_ohlc(pair, interval, format):
+    # fetched, transformed and encoded in the REST thread pool
+    return await rest_client.call("ohlc", fetch_ohlc_payload, pair, interval, format)
+
+
+ohlc_cache = OhlcCache(
+    fetch_ohlc, max_entries=config("OHLC_CACHE_ENTRIES", cast=int, default=256)
+)
+
+
+async def fetch_ohlc_rows(pair, interval):
+    ohlc_data = await rest_client.call(
+        "ohlc", kraken_manager.bot.get_ohlc, pair, interval
+    )
+    return ohlc_data[pair]
+
+
+# intervals of the candle store never leave the process after seeding
+candle_hub = CandleHub(
+    fetch_ohlc_rows,
+    capacity=config("CANDLE_CAPACITY", cast=int, default=5000),
+    max_rate=config("MAX_PUBLISH_RATE", cast=float, default=10),
+    release_delay=config("PAIR_RELEASE_DELAY", cast=float, default=30),
+)
+
+trade_flow_hub = TradeFlowHub(
+    bucket=config("TRADE_BUCKET", cast=float, default=0) or None,
+    capacity=config("TRADE_CAPACITY", cast=int, default=262_144),
+    max_rate=config("MAX_PUBLISH_RATE", cast=float, default=10),
+    release_delay=config("PAIR_RELEASE_DELAY", cast=float, default=30),
+)
+
+
+def parse_interval(value):
+    """The OHLC interval in minutes of a query parameter, ``None`` if invalid"""
+    try:
+        interval = int(value)
+    except (TypeError, ValueError):
+        return None
+    return interval if interval in KRAKEN_INTERVALS else None
+
+
 async def list_ohlc(request):
     global kraken_manager
     if kraken_manager and kraken_manager.bot:
-        pair = request.query_params["pair"]
-        interval = request.query_params["interval"]
-        if pair and interval:
-            ohlc_data = kraken_manager.bot.get_ohlc(pair, interval)
-
-            ohlc_data_transformed = transform_ohlc_tradingview(ohlc_data, pair)
-
-            return JSONResponse(ohlc_data_transformed)
-        else:
+        pair = request.query_params.get("pair")
+        format = request.query_params.get("format", "tradingview")
+        if format not in OHLC_TRANSFORMS:
+            logger.error("Unknown OHLC format %s", format)
+            return JSONResponse([], status_code=400)
+        if not pair or "interval" not in request.query_params:
             logger.error("Pair and interval parameters should be provided.")
+            return JSONResponse(
+                {"error": "pair and interval are required"}, status_code=400
+            )
+        if not asset_pairs.known(pair):
+            return JSONResponse({"error": "unknown pair"}, status_code=400)
+        interval = parse_interval(request.query_params["interval"])
+        if interval is None:
+            return JSONResponse(
+                {"error": f"interval must be one of {KRAKEN_INTERVALS}"},
+                status_code=400,
+            )
+        try:
+            if candle_hub.serves(interval):
+                payload = encode(await candle_hub.get_payload(pair, interval, format))
+                age = 0
+            else:
+                payload, age = await ohlc_cache.get(pair, interval, format)
+        except asyncio.TimeoutError:
+            logger.error("OHLC request timed out")
+            return JSONResponse([], status_code=504)
+
+        return Response(
+            payload,
+            media_type="application/json",
+            headers={"Age": str(int(age))},
+        )
     else:
         logger.error("kraken_manager is not available")
         return JSONResponse([])
 
 
+async def ohlc_cache_stats(request):
+    return JSONResponse(ohlc_cache.stats())
+
+
+async def metrics(request):
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+
+async def list_book_history(request):
+    pair = request.query_params.get("pair")
+    if not pair:
+        logger.error("Pair parameter should be provided.")
+        return JSONResponse([])
+    return JSONResponse(book_hub.get_history(pair))
+
+
+async def get_heatmap(request):
+    params = request.query_params
+    pair = params.get("pair")
+    if not pair:
+        logger.error("Pair parameter should be provided.")
+        return JSONResponse({"error": "pair is required"}, status_code=400)
+    try:
+        resolution = int(params.get("resolution", 1))
+        start = float(params["start"]) if "start" in params else None
+        end = float(params["end"]) if "end" in params else None
+        rows = int(params.get("rows", MAX_QUERY_ROWS))
+    except ValueError:
+        return JSONResponse({"error": "invalid range"}, status_code=400)
+    if not book_hub.keeps_books:
+        # the shards keep the heatmaps
+        return JSONResponse(
+            {"error": "unsupported with sharded order books"}, status_code=503
+        )
+    heatmap = book_hub.get_heatmap(pair, resolution, start, end, rows)
+    if heatmap is None:
+        return JSONResponse({"error": "no heatmap"}, status_code=404)
+    return JSONResponse(heatmap)
+
+
+async def get_trade_flow(request):
+    pair = request.query_params.get("pair")
+    if not pair:
+        logger.error("Pair parameter should be provided.")
+        return JSONResponse({"error": "pair is required"}, status_code=400)
+    if not asset_pairs.known(pair):
+        return JSONResponse({"error": "unknown pair"}, status_code=400)
+    return Response(
+        encode(await trade_flow_hub.get_payload(pair)), media_type="application/json"
+    )
+
+
+async def list_signal_history(request):
+    name = request.query_params.get("name")
+    pair = request.query_params.get("pair")
+    if not pair or not signal_engine.serves(name):
+        logger.error("Pair and a known signal name should be provided.")
+        return JSONResponse({"error": "pair and name are required"}, status_code=400)
+    if not asset_pairs.known(pair):
+        return JSONResponse({"error": "unknown pair"}, status_code=400)
+    if not signal_engine.available(name):
+        return JSONResponse(
+            {"error": "unsupported with sharded order books"}, status_code=503
+        )
+    return Response(
+        encode(await signal_engine.get_history(name, pair)),
+        media_type="application/json",
+    )
+
+
+async def list_spread_history(request):
+    params = request.query_params
+    pair = params.get("pair")
+    if not pair:
+        logger.error("Pair parameter should be provided.")
+        return JSONResponse({"error": "pair is required"}, status_code=400)
+    try:
+        points = int(params.get("points", HISTORY_POINTS))
+        seconds = float(params["seconds"]) if "seconds" in params else None
+    except ValueError:
+        return JSONResponse({"error": "invalid range"}, status_code=400)
+    if points < 1 or (seconds is not None and not 0 < seconds < math.inf):
+        return JSONResponse({"error": "invalid range"}, status_code=400)
+    if not asset_pairs.known(pair):
+        return JSONResponse({"error": "unknown pair"}, status_code=400)
+    return Response(
+        encode(await spread_hub.get_history(pair, points, seconds)),
+        media_type="application/json",
+    )
+
+
+async def orderbook_websocket(websocket):
+    await book_hub.serve(websocket, pairs)
+
+
+async def channel_websocket(websocket, subscription, pair=None):
+    global kraken_manager
+    if kraken_manager and kraken_manager.bot:
+        await kraken_manager.bot.router.serve(websocket, subscription, pair)
+    else:
+        logger.error("kraken_manager is not available")
+        await websocket.close()
+
+
+async def ohlc_websocket(websocket):
+    interval = parse_interval(websocket.query_params.get("interval", 1))
+    if interval is None or not asset_pairs.known(websocket.query_params.get("pair")):
+        logger.error("Invalid OHLC subscription %s", websocket.query_params)
+        # policy violation
+        await websocket.close(code=1008)
+        return
+    if candle_hub.serves(interval):
+        await candle_hub.serve(websocket, websocket.query_params["pair"], interval)
+        return
+    await channel_websocket(
+        websocket,
+        {"name": "ohlc", "interval": interval},
+        websocket.query_params["pair"],
+    )
+
+
+async def close_unknown_pair(websocket):
+    """
+    Closes a websocket without a known ``pair`` parameter, returns the pair
+    otherwise
+    """
+    pair = websocket.query_params.get("pair")
+    if not asset_pairs.known(pair):
+        logger.error("Unknown pair %s", pair)
+        # policy violation
+        await websocket.close(code=1008)
+        return None
+    return pair
+
+
+async def spread_websocket(websocket):
+    pair = await close_unknown_pair(websocket)
+    if pair is not None:
+        await channel_websocket(websocket, {"name": "spread"}, pair)
+
+
+async def trades_websocket(websocket):
+    await channel_websocket(websocket, {"name": "ownTrades"})
+
+
+async def trade_flow_websocket(websocket):
+    pair = await close_unknown_pair(websocket)
+    if pair is not None:
+        await trade_flow_hub.serve(websocket, pair)
+
+
+async def signals_websocket(websocket):
+    name = websocket.query_params.get("name")
+    if not signal_engine.serves(name):
+        logger.error("Unknown signal %s", name)
+        await websocket.close()
+        return
+    if not signal_engine.available(name):
+        logger.error("Signal %s is not computed with sharded order books", name)
+        # try again later
+        await websocket.close(code=1013)
+        return
+    pair = await close_unknown_pair(websocket)
+    if pair is not None:
+        await signal_engine.serve(websocket, name, pair)
+
+
+async def orders_websocket(websocket):
+    await channel_websocket(websocket, {"name": "openOrders"})
+
+
+async def order_state_websocket(websocket):
+    await order_state.serve(websocket)
+
+
 async def get_kraken_token(request):
     return JSONResponse(get_token(config))
 
@@ -150,6 +518,21 @@ if __name__ == "__main__":
             Route("/orders", endpoint=list_orders, methods=["GET"]),
             Route("/positions", endpoint=list_positions, methods=["GET"]),
             Route("/ohlc", endpoint=list_ohlc, methods=["GET"]),
+            Route("/ohlc_cache", endpoint=ohlc_cache_stats, methods=["GET"]),
+            Route("/book_history", endpoint=list_book_history, methods=["GET"]),
+            Route("/heatmap", endpoint=get_heatmap, methods=["GET"]),
+            Route("/trade_flow", endpoint=get_trade_flow, methods=["GET"]),
+            Route("/signals", endpoint=list_signal_history, methods=["GET"]),
+            Route("/spread_history", endpoint=list_spread_history, methods=["GET"]),
+            Route("/metrics", endpoint=metrics, methods=["GET"]),
+            WebSocketRoute("/ws_orderbook", endpoint=orderbook_websocket),
+            WebSocketRoute("/ws_ohlc", endpoint=ohlc_websocket),
+            WebSocketRoute("/ws_spread", endpoint=spread_websocket),
+            WebSocketRoute("/ws_trades", endpoint=trades_websocket),
+            WebSocketRoute("/ws_trade_flow", endpoint=trade_flow_websocket),
+            WebSocketRoute("/ws_signals", endpoint=signals_websocket),
+            WebSocketRoute("/ws_orders", endpoint=orders_websocket),
+            WebSocketRoute("/ws_order_state", endpoint=order_state_websocket),
             Route("/schema", endpoint=openapi_schema, include_in_schema=False),
             Route("/token", endpoint=get_kraken_token, methods=["GET"]),
         ),
@@ -0,0 +1,334 @@
+"""
+End-to-end latency benchmark of the order book fan-out.
+
+A feed of Kraken v2 book messages (synthetic from :mod:`mock_kraken` or a
+recording) is injected into ``Orderbook.on_message`` of an offline
+:class:`OrderbookHub` at a fixed rate per pair. Simulated websocket
+consumers are subscribed to the books; the latency of a frame is the time
+from the injection of the update it reflects (the moment the message
+would arrive from Kraken) to the moment it is handed to the socket, so it
+covers the SDK book update, ``transform_book``, serialization, the
+conflation of the :class:`Subscriber` outboxes and the send, but not the
+network.
+
+Every configuration of the sweep runs in a fresh process and reports
+p50/p99/p99.9 latency, processed updates/s, delivered frames/s, CPU time
+per update and peak RSS. The feed is generated before the measurement, so
+CPU time is spent by the backend code paths (and the trivial consumers).
+
+Run from the backend directory::
+
+    python -m benchmarks.latency [--feed synthetic|recordings/]
+        [--depths 10 25 100 500] [--pairs 1 5 20] [--clients 1 10 100 500]
+        [--rate 100|max] [--duration 10] [--max-rate 10]
+        [--protocol json|delta] [--output latency.json]
+
+Each client watches one book (round robin over the pairs). With a
+recording the pairs of the recording are used and ``--pairs`` is ignored.
+With ``--rate max`` the synthetic feed has ``1000 * (duration + warmup)``
+updates per pair, which are injected as fast as the backend takes them.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import platform
+import resource
+import struct
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from handlers.book_protocol import HEADER
+from handlers.broadcast import Subscriber, decode
+from handlers.orderbook import OrderbookHub
+from handlers.recorder import RecordedMarket, read
+
+PERCENTILES = (50, 99, 99.9)
+# seq of the delta protocol header (after kind, version and depth)
+DELTA_SEQ = struct.Struct("<I")
+DELTA_SEQ_OFFSET = 4
+
+
+class ConsumerSocket:
+    """A websocket consumer that records the latency of every book frame"""
+
+    def __init__(self, injected, latencies):
+        self.injected = injected
+        self.latencies = latencies
+        self.frames = 0
+        self.bytes = 0
+
+    async def send_text(self, data):
+        now = time.perf_counter()
+        self.frames += 1
+        self.bytes += len(data)
+        # cheaper than decoding the whole book
+        start = data.index('"pair":"') + 8
+        pair = data[start : data.index('"', start)]
+        start = data.rindex('"checksum":') + 11
+        checksum = int(data[start : data.index(",", start)])
+        self.record(now, (pair, checksum))
+
+    async def send_bytes(self, data):
+        now = time.perf_counter()
+        self.frames += 1
+        self.bytes += len(data)
+        (seq,) = DELTA_SEQ.unpack_from(data, DELTA_SEQ_OFFSET)
+        length = data[HEADER.size]
+        pair = bytes(data[HEADER.size + 1 : HEADER.size + 1 + length]).decode()
+        self.record(now, (pair, seq))
+
+    def record(self, now, key):
+        injected = self.injected.get(key)
+        if injected is not None:
+            self.latencies.append(now - injected)
+
+    async def close(self):
+        pass
+
+
+class FeedConnection:
+    """Collects the messages the mock exchange sends to one connection"""
+
+    def __init__(self):
+        self.messages = []
+
+    def send(self, data):
+        self.messages.append(data)
+
+
+def synthetic_feed(pairs, depth, count, seed=1):
+    """``count`` book messages per pair from the mock exchange, round robin"""
+    from mock_kraken.server import MockKraken
+
+    mock = MockKraken(pairs, depth=max(depth, 1000), seed=seed)
+    market = RecordedMarket()
+    market.on_message(mock.rest_assetpairs({"pair": ",".join(pairs)}))
+    feeds = {}
+    for pair in pairs:
+        feeds[pair] = FeedConnection()
+        mock.view(pair, depth).v2.add(feeds[pair])
+        book = mock.book(pair)
+        feeds[pair].messages.append(
+            mock.book_v2(
+                pair,
+                book,
+                {side: book.view(side, depth) for side in ("bid", "ask")},
+                book.checksum(),
+            )
+        )
+
+    while any(len(feed.messages) <= count for feed in feeds.values()):
+        now = time.time()
+        for pair in pairs:
+            m = mock.market(pair)
+            m.step(now)
+            mock.publish(pair, m.book)
+            m.trades.clear()
+
+    messages = []
+    for pair in pairs:
+        messages.append(
+            [
+                message if isinstance(message, dict) else decode(message.encode())
+                for message in feeds[pair].messages[: count + 1]
+            ]
+        )
+    feed = [
+        message
+        for batch in itertools.zip_longest(*messages)
+        for message in batch
+        if message is not None
+    ]
+    return feed, market
+
+
+def recorded_feed(directory):
+    """The book messages and asset pairs of a recording"""
+    market = RecordedMarket()
+    feed = []
+    for _, source, message in read(directory):
+        if source == "meta":
+            market.on_message(message)
+        elif source == "book":
+            feed.append(message)
+    return feed, market
+
+
+def percentiles(latencies):
+    if not latencies:
+        return {f"p{p:g}": None for p in PERCENTILES}
+    values = np.percentile(np.array(latencies) * 1000, PERCENTILES)
+    return {f"p{p:g}": round(float(v), 3) for p, v in zip(PERCENTILES, values)}
+
+
+async def measure(config):
+    depth = config["depth"]
+    rate = config["rate"]
+    warmup = config["warmup"]
+    if config["feed"] == "synthetic":
+        pairs = ["P{}/USD".format(i) for i in range(config["pairs"])]
+        count = int((rate or 1000) * (config["duration"] + warmup))
+        feed, market = synthetic_feed(pairs, depth, count)
+    else:
+        feed, market = recorded_feed(config["feed"])
+        pairs = list(market.asset_pairs)
+
+    hub = OrderbookHub(depth=depth, max_rate=config["max_rate"])
+    await hub.start_offline(pairs, market)
+
+    injected = {}
+    latencies = []
+    sockets = []
+    subscribers = []
+    delta = config["protocol"] == "delta"
+    for i in range(config["clients"]):
+        ws = ConsumerSocket(injected, latencies)
+        subscriber = Subscriber(ws, max_rate=config["max_rate"], stream="book")
+        subscriber.start()
+        await hub.subscribe(subscriber, [pairs[i % len(pairs)]], delta=delta)
+        sockets.append(ws)
+        subscribers.append(subscriber)
+
+    loop = asyncio.get_running_loop()
+    interval = 1 / (rate * len(pairs)) if rate else 0
+    # the first updates (the snapshots and the warmup) are not measured
+    first = int(len(feed) * warmup / (config["duration"] + warmup))
+    started = loop.time()
+    for n, message in enumerate(feed):
+        if interval:
+            delay = started + n * interval - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            elif n % 100 == 0:
+                await asyncio.sleep(0)
+        elif n % 10 == 0:
+            # lets the sender tasks run at full speed
+            await asyncio.sleep(0)
+        if n == first:
+            latencies.clear()
+            frames = sum(ws.frames for ws in sockets)
+            wall, cpu = time.perf_counter(), time.process_time()
+
+        now = time.perf_counter()
+        await hub.orderbook.on_message(message)
+        pair = message["data"][0]["symbol"]
+        state = hub.pairs[pair]
+        # frames are matched by seq (delta) or checksum (JSON)
+        injected[(pair, state.snapshot.seq if delta else state.checksum)] = now
+
+    elapsed = time.perf_counter() - wall
+    cpu = time.process_time() - cpu
+    updates = len(feed) - first
+    frames = sum(ws.frames for ws in sockets) - frames
+    # the last frames still waiting for a send slot
+    await asyncio.sleep(2 / config["max_rate"] if config["max_rate"] else 0.1)
+    for subscriber in subscribers:
+        subscriber.close()
+
+    return {
+        **config,
+        "pairs": len(pairs),
+        "updates": updates,
+        "updates_per_sec": round(updates / elapsed, 1),
+        "frames": frames,
+        "frames_per_sec": round(frames / elapsed, 1),
+        "latency_ms": percentiles(latencies),
+        "latency_samples": len(latencies),
+        "cpu_per_update_us": round(cpu / updates * 1e6, 1),
+        "conflated": sum(subscriber.conflated for subscriber in subscribers),
+        "dropped": sum(subscriber.dropped for subscriber in subscribers),
+        # kilobytes on Linux
+        "rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def run(config):
+    return asyncio.run(measure(config))
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--feed", default="synthetic", help="synthetic or a recording")
+    parser.add_argument("--depths", type=int, nargs="+", default=[10, 25, 100, 500])
+    parser.add_argument("--pairs", type=int, nargs="+", default=[1, 5, 20])
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 10, 100, 500])
+    parser.add_argument(
+        "--rate", default="100", help="book updates per second and pair, or max"
+    )
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds")
+    parser.add_argument("--warmup", type=float, default=1.0, help="seconds")
+    parser.add_argument("--max-rate", type=float, default=10.0)
+    parser.add_argument("--protocol", choices=("json", "delta"), default="json")
+    parser.add_argument("--output", default="latency.json")
+    args = parser.parse_args()
+
+    pairs = args.pairs if args.feed == "synthetic" else [None]
+    configs = [
+        {
+            "feed": args.feed,
+            "depth": depth,
+            "pairs": n,
+            "clients": clients,
+            "rate": None if args.rate == "max" else float(args.rate),
+            "duration": args.duration,
+            "warmup": args.warmup,
+            "max_rate": args.max_rate or None,
+            "protocol": args.protocol,
+        }
+        for depth, n, clients in itertools.product(args.depths, pairs, args.clients)
+    ]
+
+    results = []
+    # a fresh process per configuration, for independent RSS and caches
+    with ProcessPoolExecutor(max_workers=1, max_tasks_per_child=1) as executor:
+        for result in executor.map(run, configs):
+            latency = result["latency_ms"]
+            print(
+                "depth {depth:4} pairs {pairs:3} clients {clients:4}: "
+                "{updates_per_sec:9.1f} updates/s {frames_per_sec:9.1f} frames/s "
+                "p50 {p50} p99 {p99} p99.9 {p999} ms "
+                "{cpu_per_update_us} us/update {rss_mb} MB".format(
+                    **result,
+                    p50=latency["p50"],
+                    p99=latency["p99"],
+                    p999=latency["p99.9"],
+                ),
+                flush=True,
+            )
+            results.append(result)
+
+    with open(args.output, "w") as f:
+        json.dump(
+            {
+                "revision": git_revision(),
+                "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                "python": sys.version.split()[0],
+                "platform": platform.platform(),
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+    print(f"results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+Replays a recording through the order book and channel code paths.
+
+The book messages go through ``Orderbook.on_message`` of an offline
+:class:`OrderbookHub` and the v1 channel messages through the
+``ChannelRouter``, without a Kraken connection. Useful for profiling and for
+reproducing what a recorded session did.
+
+Run from the backend directory::
+
+    python -m benchmarks.replay recordings/ [--speed max|N] [--clients 10]
+        [--depth 100] [--profile]
+
+Recordings are made by the backend when ``RECORD_DIR`` is set.
+"""
+
+import argparse
+import asyncio
+import cProfile
+import pstats
+import time
+
+from handlers.broadcast import Subscriber
+from handlers.channels import ChannelRouter
+from handlers.orderbook import OrderbookHub
+from handlers.recorder import RecordedMarket, replay
+
+
+class NullWebSocket:
+    def __init__(self):
+        self.frames = 0
+        self.bytes = 0
+
+    async def send_text(self, data):
+        self.frames += 1
+        self.bytes += len(data)
+
+    async def send_bytes(self, data):
+        self.frames += 1
+        self.bytes += len(data)
+
+    async def close(self):
+        pass
+
+
+class NullClient:
+    async def subscribe(self, subscription, pair=None):
+        pass
+
+    async def unsubscribe(self, subscription, pair=None):
+        pass
+
+
+async def run(directory, speed, depth, clients, max_rate):
+    market = RecordedMarket()
+    hub = OrderbookHub(depth=depth, max_rate=max_rate)
+    await hub.start_offline([], market)
+    router = ChannelRouter(NullClient(), max_rate=max_rate)
+
+    sockets = [NullWebSocket() for _ in range(clients)]
+    subscribers = [Subscriber(ws, max_rate=max_rate) for ws in sockets]
+    for subscriber in subscribers:
+        subscriber.start()
+
+    async def on_meta(message):
+        market.on_message(message)
+        for subscriber in subscribers:
+            await hub.subscribe(subscriber, list(message))
+
+    started = time.perf_counter()
+    count = await replay(
+        directory,
+        {
+            "meta": on_meta,
+            "book": hub.orderbook.on_message,
+            "kraken": router.on_message,
+        },
+        speed=speed,
+    )
+    elapsed = time.perf_counter() - started
+    await asyncio.sleep(0.1)
+    for subscriber in subscribers:
+        subscriber.close()
+
+    print(f"messages: {count} in {elapsed:.2f}s ({count / elapsed:.0f}/s)")
+    for pair, state in hub.pairs.items():
+        print(f"{pair}: {state.snapshot.seq} book updates")
+    if sockets:
+        frames = sum(ws.frames for ws in sockets)
+        sent = sum(ws.bytes for ws in sockets)
+        print(f"clients: {clients}, {frames} frames, {sent / 1e6:.1f} MB sent")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("directory", help="recording directory")
+    parser.add_argument("--speed", default="max", help="max or a speed factor")
+    parser.add_argument("--depth", type=int, default=100)
+    parser.add_argument("--clients", type=int, default=0)
+    parser.add_argument("--max-rate", type=float, default=None)
+    parser.add_argument("--profile", action="store_true")
+    args = parser.parse_args()
+
+    speed = None if args.speed == "max" else float(args.speed)
+    coroutine = run(args.directory, speed, args.depth, args.clients, args.max_rate)
+    if not args.profile:
+        asyncio.run(coroutine)
+        return
+    with cProfile.Profile() as profile:
+        asyncio.run(coroutine)
+    pstats.Stats(profile).sort_stats("cumulative").print_stats(30)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+Micro-benchmark of the book payload serialization.
+
+Compares the previous per-socket ``ws.send_json(json.dumps(payload))`` (the
+payload is encoded, then the resulting string is encoded again for every
+socket) with the broadcast path that encodes a payload once.
+
+Run from the backend directory::
+
+    python -m benchmarks.serialization [--book book.json] [--clients 1 10 100]
+
+``--book`` takes a book recorded from ``OrderbookClientV2.get(pair)``
+(``{"bid": {price: [volume, timestamp]}, "ask": {...}, "price_decimals": ...,
+"qty_decimals": ...}``). Without it a depth 100 book is generated.
+"""
+
+import argparse
+import json
+import random
+import timeit
+
+from handlers import broadcast
+from handlers.book import Book
+from handlers.broadcast import Frame
+from handlers.orderbook import PairState
+
+DEPTH = 100
+
+
+def generate_book(depth=DEPTH, mid=42000.0, seed=1):
+    rnd = random.Random(seed)
+    return {
+        "bid": {
+            "{:.1f}".format(mid - 0.1 * (i + 1)): (
+                "{:.8f}".format(rnd.uniform(0, 5)),
+                None,
+            )
+            for i in range(depth)
+        },
+        "ask": {
+            "{:.1f}".format(mid + 0.1 * i): ("{:.8f}".format(rnd.uniform(0, 5)), None)
+            for i in range(depth)
+        },
+        "valid": True,
+        "price_decimals": 1,
+        "qty_decimals": 8,
+    }
+
+
+def load_book(path):
+    with open(path) as f:
+        book = json.load(f)
+    book.setdefault("valid", True)
+    return book
+
+
+def book_payload(book, pair="XBT/USD"):
+    """Runs the book through the regular transform to get a realistic payload"""
+    message = {
+        "type": "snapshot",
+        "data": [
+            {
+                "symbol": pair,
+                "bids": [
+                    {"price": float(p), "qty": float(v[0])}
+                    for p, v in book["bid"].items()
+                ],
+                "asks": [
+                    {"price": float(p), "qty": float(v[0])}
+                    for p, v in book["ask"].items()
+                ],
+                "checksum": 0,
+            }
+        ],
+    }
+    depth = max(len(book["bid"]), len(book["ask"]))
+    local = Book(pair, book["price_decimals"], book["qty_decimals"], depth)
+    local.apply(message)
+    return PairState(pair, depth).transform_book(local, message)
+
+
+def double_encoding(payload, clients):
+    # ws.send_json(json.dumps(payload)) for every socket
+    for _ in range(clients):
+        json.dumps(json.dumps(payload))
+
+
+def encode_once(payload, clients):
+    frame = Frame(payload)
+    for _ in range(clients):
+        frame.text
+
+
+def measure(func, payload, clients, number):
+    timer = timeit.Timer(lambda: func(payload, clients))
+    return min(timer.repeat(repeat=5, number=number)) / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--book", help="recorded book (JSON)")
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--number", type=int, default=200)
+    args = parser.parse_args()
+
+    payload = book_payload(load_book(args.book) if args.book else generate_book())
+    size = len(Frame(payload).data)
+    print(f"payload: {len(payload['data'])} levels, {size} bytes")
+
+    backends = [("stdlib", None)]
+    if broadcast.orjson is not None:
+        backends.append(("orjson", broadcast.orjson))
+
+    print(
+        f"{'clients':>8} {'double encoding':>16} "
+        + " ".join(f"{'once/' + name:>14}" for name, _ in backends)
+    )
+    for clients in args.clients:
+        old = measure(double_encoding, payload, clients, args.number)
+        new = []
+        for _, module in backends:
+            broadcast.orjson = module
+            new.append(measure(encode_once, payload, clients, args.number))
+        print(f"{clients:>8} {old:>14.1f}us " + " ".join(f"{t:>12.1f}us" for t in new))
+    broadcast.orjson = backends[-1][1]
+
+
+if __name__ == "__main__":
+    main()
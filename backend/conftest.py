@@ -0,0 +1 @@
+# makes the backend packages (handlers, mock_kraken) importable from tests/
@@ -0,0 +1,234 @@
+"""
+Local order book of a pair, kept from Kraken v2 book messages.
+
+Prices are integer ticks (``price * 10 ** price_decimals``) and quantities
+integer lots (``qty * 10 ** qty_decimals``), so levels are compared and
+checksummed without formatting floats. Every side is a pair of
+preallocated arrays sorted by ascending price with the free space on the
+side of the best price: the bids grow to the right, the asks to the left.
+
+- a level is found with a binary search, O(log n)
+- changing the quantity of a level touches a single element, inserting or
+  removing a level only moves the levels between it and the best price,
+  which is where almost all changes happen
+- the best level is at a fixed end, O(1)
+- levels beyond ``depth`` are dropped from the worst end, O(1)
+- :meth:`BookSide.top` returns views of the best ``n`` levels, nothing is
+  copied
+
+Consumers that keep running aggregates of a side register a watcher in
+:attr:`BookSide.watchers`: its ``change(ticks, lots)`` is called with the
+signed quantity change of every level (levels dropped beyond ``depth``
+included) and its ``clear()`` when a snapshot replaces the side. Watchers
+run inside :meth:`Book.apply`, so they are registered with a
+:meth:`Book.copy` that is kept up to date outside the hot path, not with
+the books of the hub.
+"""
+
+from __future__ import annotations
+
+from typing import Optional
+
+import numpy as np
+
+# free space of the arrays, in multiples of the depth
+HEADROOM = 3
+
+
+class BookSide:
+    """The levels of one side of a book, at most ``depth`` of them"""
+
+    def __init__(self: BookSide, bid: bool, depth: int) -> None:
+        self.bid: bool = bid
+        self.depth: int = depth
+        capacity = (HEADROOM + 1) * depth
+        self.ticks: np.ndarray = np.zeros(capacity, dtype=np.int64)
+        self.qty: np.ndarray = np.zeros(capacity, dtype=np.int64)
+        # levels are ticks[lo:hi]
+        self.lo: int = 0
+        self.hi: int = 0
+        # lots added to and removed from levels by updates, since the start
+        self.added: int = 0
+        self.removed: int = 0
+        self.watchers: list = []
+        self.clear()
+
+    def __len__(self: BookSide) -> int:
+        return self.hi - self.lo
+
+    def clear(self: BookSide) -> None:
+        # empty at the far end of the free space
+        self.lo = self.hi = 0 if self.bid else len(self.ticks)
+        for watcher in self.watchers:
+            watcher.clear()
+
+    def set(self: BookSide, ticks: int, qty: int) -> None:
+        """Sets the quantity of a level, a quantity of 0 removes the level"""
+        lo, hi = self.lo, self.hi
+        i = lo + int(np.searchsorted(self.ticks[lo:hi], ticks))
+        present = i < hi and self.ticks[i] == ticks
+        if present:
+            change = qty - int(self.qty[i]) if qty > 0 else -int(self.qty[i])
+            if change > 0:
+                self.added += change
+            else:
+                self.removed -= change
+            for watcher in self.watchers:
+                watcher.change(ticks, change)
+            if qty > 0:
+                self.qty[i] = qty
+            elif self.bid:
+                self._move(i + 1, hi, -1)
+                self.hi -= 1
+            else:
+                self._move(lo, i, 1)
+                self.lo += 1
+            return
+        if qty <= 0:
+            return
+
+        self.added += qty
+        for watcher in self.watchers:
+            watcher.change(ticks, qty)
+        if self.bid:
+            if hi == len(self.ticks):
+                i -= self._compact()
+            self._move(i, self.hi, 1)
+            self.ticks[i], self.qty[i] = ticks, qty
+            self.hi += 1
+            if len(self) > self.depth:
+                self._drop(self.lo)
+                self.lo += 1
+        else:
+            if lo == 0:
+                i += self._compact()
+            self._move(self.lo, i, -1)
+            self.ticks[i - 1], self.qty[i - 1] = ticks, qty
+            self.lo -= 1
+            if len(self) > self.depth:
+                self.hi -= 1
+                self._drop(self.hi)
+
+    def _drop(self: BookSide, i: int) -> None:
+        """Tells the watchers about the level at ``i`` leaving the depth"""
+        for watcher in self.watchers:
+            watcher.change(int(self.ticks[i]), -int(self.qty[i]))
+
+    def _move(self: BookSide, start: int, stop: int, offset: int) -> None:
+        if start < stop:
+            self.ticks[start + offset : stop + offset] = self.ticks[start:stop]
+            self.qty[start + offset : stop + offset] = self.qty[start:stop]
+
+    def _compact(self: BookSide) -> int:
+        """Moves the levels to the worst end, returns how far they moved"""
+        count = len(self)
+        start = 0 if self.bid else len(self.ticks) - count
+        offset = start - self.lo
+        self.ticks[start : start + count] = self.ticks[self.lo : self.hi]
+        self.qty[start : start + count] = self.qty[self.lo : self.hi]
+        self.lo, self.hi = start, start + count
+        return -offset if self.bid else offset
+
+    def copy(self: BookSide) -> BookSide:
+        """The same levels in new arrays, without watchers"""
+        side = BookSide(self.bid, self.depth)
+        side.ticks[:], side.qty[:] = self.ticks, self.qty
+        side.lo, side.hi = self.lo, self.hi
+        side.added, side.removed = self.added, self.removed
+        return side
+
+    def best(self: BookSide) -> Optional[tuple[int, int]]:
+        """Ticks and quantity of the best level"""
+        if self.hi == self.lo:
+            return None
+        i = self.hi - 1 if self.bid else self.lo
+        return int(self.ticks[i]), int(self.qty[i])
+
+    def levels(self: BookSide) -> tuple[np.ndarray, np.ndarray]:
+        """Views of the ticks and quantities of all levels, ascending price"""
+        return self.ticks[self.lo : self.hi], self.qty[self.lo : self.hi]
+
+    def top(self: BookSide, n: int) -> tuple[np.ndarray, np.ndarray]:
+        """Views of the ticks and quantities of the best ``n`` levels, best first"""
+        if self.bid:
+            start = max(self.lo, self.hi - n)
+            return self.ticks[start : self.hi][::-1], self.qty[start : self.hi][::-1]
+        stop = min(self.hi, self.lo + n)
+        return self.ticks[self.lo : stop], self.qty[self.lo : stop]
+
+
+class Book:
+    """Both sides of the book of a pair, see the module documentation"""
+
+    def __init__(
+        self: Book, pair: str, price_decimals: int, qty_decimals: int, depth: int
+    ) -> None:
+        self.pair: str = pair
+        self.price_decimals: int = price_decimals
+        self.qty_decimals: int = qty_decimals
+        self.depth: int = depth
+        self.price_scale: int = 10**price_decimals
+        self.qty_scale: int = 10**qty_decimals
+        self.bid: BookSide = BookSide(True, depth)
+        self.ask: BookSide = BookSide(False, depth)
+
+    def copy(self: Book) -> Book:
+        book = Book(self.pair, self.price_decimals, self.qty_decimals, self.depth)
+        book.bid, book.ask = self.bid.copy(), self.ask.copy()
+        return book
+
+    def side(self: Book, side: str) -> BookSide:
+        return self.bid if side == "bid" else self.ask
+
+    def ticks(self: Book, price: float) -> int:
+        return round(price * self.price_scale)
+
+    def price(self: Book, ticks: int | np.ndarray) -> float | np.ndarray:
+        # dividing by the exact power of ten gives the float of the decimal price
+        return ticks / self.price_scale
+
+    def volume(self: Book, qty: int | np.ndarray) -> float | np.ndarray:
+        return qty / self.qty_scale
+
+    def apply(self: Book, message: dict) -> None:
+        """
+        Applies a book message, like Kraken the asks first and the book
+        truncated to ``depth`` after every level.
+        """
+        data = message["data"][0]
+        snapshot = message["type"] == "snapshot"
+        if snapshot:
+            self.bid.clear()
+            self.ask.clear()
+            # a snapshot neither adds nor removes volume
+            totals = [(side.added, side.removed) for side in (self.bid, self.ask)]
+        price_scale, qty_scale = self.price_scale, self.qty_scale
+        for side, orders in ((self.ask, data["asks"]), (self.bid, data["bids"])):
+            for order in orders:
+                side.set(
+                    round(order["price"] * price_scale),
+                    round(order["qty"] * qty_scale),
+                )
+        if snapshot:
+            for side, (added, removed) in zip((self.bid, self.ask), totals):
+                side.added, side.removed = added, removed
+
+    def best_bid(self: Book) -> Optional[tuple[float, float]]:
+        best = self.bid.best()
+        return None if best is None else (self.price(best[0]), self.volume(best[1]))
+
+    def best_ask(self: Book) -> Optional[tuple[float, float]]:
+        best = self.ask.best()
+        return None if best is None else (self.price(best[0]), self.volume(best[1]))
+
+    def checksum_string(self: Book, side: str, n: int = 10) -> str:
+        """
+        The best ``n`` levels of a side as they enter the Kraken checksum:
+        the formatted price and quantity without the dot and leading zeros,
+        which are the digits of the integer ticks and lots.
+        """
+        ticks, qty = self.side(side).top(n)
+        return "".join(
+            str(price) + str(volume)
+            for price, volume in zip(ticks.tolist(), qty.tolist())
+        )
@@ -0,0 +1,52 @@
+from __future__ import annotations
+
+from binascii import crc32
+from typing import Optional
+
+from handlers.book import Book
+
+# levels of each side covered by the Kraken checksum
+CHECKSUM_DEPTH = 10
+
+
+class BookChecksum:
+    """
+    Incremental verification of the CRC32 Kraken sends with every v2 book
+    message (the 10 best asks followed by the 10 best bids).
+
+    The checksum string of a side is only rebuilt when a message touches a
+    price within its 10 best levels, updates further down the book reuse
+    the string of the previous message. The CRC of the bids continues the
+    CRC of the asks, so the strings are never concatenated.
+    """
+
+    def __init__(self: BookChecksum) -> None:
+        self._parts: dict[str, bytes] = {"ask": b"", "bid": b""}
+        # price of the 10th level of each side, None if the side is shorter
+        self._bounds: dict[str, Optional[float]] = {"ask": None, "bid": None}
+        self.checksum: int = 0
+
+    def verify(self: BookChecksum, book: Book, message: dict) -> bool:
+        """Whether ``book`` after ``message`` has the checksum of the message"""
+        data = message["data"][0]
+        snapshot = message["type"] == "snapshot"
+        for side, orders in (("ask", data["asks"]), ("bid", data["bids"])):
+            if snapshot or self._touches(side, orders):
+                self._rebuild(side, book)
+        self.checksum = crc32(self._parts["bid"], crc32(self._parts["ask"]))
+        return self.checksum == int(data["checksum"])
+
+    def _touches(self: BookChecksum, side: str, orders: list[dict]) -> bool:
+        bound = self._bounds[side]
+        if bound is None:
+            return True
+        if side == "ask":
+            return any(order["price"] <= bound for order in orders)
+        return any(order["price"] >= bound for order in orders)
+
+    def _rebuild(self: BookChecksum, side: str, book: Book) -> None:
+        self._parts[side] = book.checksum_string(side, CHECKSUM_DEPTH).encode()
+        ticks, _ = book.side(side).top(CHECKSUM_DEPTH)
+        self._bounds[side] = (
+            book.price(int(ticks[-1])) if len(ticks) == CHECKSUM_DEPTH else None
+        )
@@ -0,0 +1,189 @@
+"""
+Compact binary order book protocol.
+
+Clients opt in by connecting to ``/ws_orderbook?protocol=delta``. For every
+subscribed pair the client first gets a snapshot frame with all levels of the
+ladder, afterwards only delta frames with the levels that changed since the
+last frame sent to that client. Frames are binary websocket messages,
+little-endian::
+
+    header          HEADER (see below)
+    pair            u8 length + utf-8 bytes, zero padded to a multiple of 8
+    price           f64[count]
+    bid             i64[count]
+    ask             i64[count]
+    bid_change      i64[count]
+    ask_change      i64[count]
+    bid_changed_at  u32[count]
+    ask_changed_at  u32[count]
+    index           u16[count]
+
+``kind`` is 0 for a snapshot and 1 for a delta, ``seq`` is the book update
+the frame reflects and ``base`` the ``seq`` of the previous frame of that
+pair the delta applies to. A client whose last ``seq`` differs from ``base``
+missed a frame and sends ``{"event": "resync", "pair": ...}`` to get a new
+snapshot. ``checksum`` is the Kraken checksum of that update, verified by
+the server. After a checksum mismatch the client gets the JSON text message
+``{"event": "resync", "pair": ..., "reason": "checksum"}`` and the next
+frame of the pair is a snapshot of the resubscribed book.
+
+Rows are ladder indices in ``[0, 2 * depth)``, ordered by descending price;
+only rows in ``[start, stop)`` are in use. Instead of ``*_ps`` and
+``*_ps_history`` every row carries the last volume change of the side and
+the update it happened at (``*_changed_at``), from which the client derives
+them with ``since = seq - *_changed_at``: if the volume is 0 both are 0, if
+``since`` exceeds the cleanup interval (50) ``ps = 0`` and
+``history = (since - 51) % 51``, otherwise ``ps = change`` and
+``history = since``.
+"""
+
+from __future__ import annotations
+
+import struct
+from typing import Any, Optional
+
+import numpy as np
+
+from handlers.book_snapshot import BookSnapshot
+from handlers.broadcast import Frame
+from handlers.pairs import MAX_PAIR_LENGTH
+
+SNAPSHOT = 0
+DELTA = 1
+VERSION = 2
+
+# kind, version, depth, seq, base, checksum, start, stop, count,
+# bid_volume_total, ask_volume_total, best_bid, best_ask,
+# time, imbalance, large_volume
+HEADER = struct.Struct("<BBHIIIHHHxxqqddddd")
+
+FIELDS = (
+    "kind",
+    "version",
+    "depth",
+    "seq",
+    "base",
+    "checksum",
+    "start",
+    "stop",
+    "count",
+    "bid_volume_total",
+    "ask_volume_total",
+    "best_bid",
+    "best_ask",
+    "time",
+    "imbalance",
+    "large_volume",
+)
+
+COLUMNS = (
+    ("price", "<f8"),
+    # volumes in lots, 32 bits overflow for pairs with a large supply
+    ("bid", "<i8"),
+    ("ask", "<i8"),
+    ("bid_change", "<i8"),
+    ("ask_change", "<i8"),
+    ("bid_changed_at", "<u4"),
+    ("ask_changed_at", "<u4"),
+)
+
+
+def _encode_pair(pair: str) -> bytes:
+    raw = pair.encode()
+    if len(raw) > MAX_PAIR_LENGTH:
+        raise ValueError(
+            "pair of {} bytes, at most {} fit a frame".format(len(raw), MAX_PAIR_LENGTH)
+        )
+    data = bytes([len(raw)]) + raw
+    return data + bytes(-len(data) % 8)
+
+
+def decode_frame(data: bytes) -> dict[str, Any]:
+    """
+    Decodes a frame into its header fields, ``pair``, the columns and
+    ``index``. The columns are read-only views of ``data``.
+    """
+    frame: dict[str, Any] = dict(zip(FIELDS, HEADER.unpack_from(data)))
+    offset = HEADER.size
+    length = data[offset]
+    frame["pair"] = bytes(data[offset + 1 : offset + 1 + length]).decode()
+    offset += 1 + length + (-(1 + length) % 8)
+    count = frame["count"]
+    for name, dtype in (*COLUMNS, ("index", "<u2")):
+        frame[name] = np.frombuffer(data, dtype=dtype, count=count, offset=offset)
+        offset += count * np.dtype(dtype).itemsize
+    return frame
+
+
+class BookDeltaStream:
+    """
+    Per client and pair encoder of the binary protocol. Remembers the ladder
+    last sent to the client and encodes only the rows that differ from it.
+    """
+
+    def __init__(self: BookDeltaStream, state: Any) -> None:
+        self.state: Any = state
+        self._pair: bytes = _encode_pair(state.pair)
+        self._sent: dict[str, np.ndarray] = {
+            name: np.zeros_like(getattr(state.snapshot, name)) for name, _ in COLUMNS
+        }
+        self._start: int = 0
+        self._stop: int = 0
+        self.seq: Optional[int] = None
+
+    def resync(self: BookDeltaStream) -> None:
+        """Sends a snapshot with the next frame"""
+        self.seq = None
+
+    def render(self: BookDeltaStream) -> Optional[Frame]:
+        """Encodes the current ladder of the pair, ``None`` if nothing changed"""
+        state = self.state
+        snapshot: BookSnapshot = state.snapshot
+        if snapshot.seq == 0 or snapshot.seq == self.seq:
+            return None
+
+        start, stop = snapshot.start, snapshot.stop
+        if self.seq is None:
+            kind = SNAPSHOT
+            rows = np.arange(start, stop)
+        else:
+            kind = DELTA
+            changed = np.zeros(stop - start, dtype=bool)
+            for name, _ in COLUMNS:
+                current = getattr(snapshot, name)[start:stop]
+                changed |= current != self._sent[name][start:stop]
+            # rows that were not in use for the client are always sent
+            index = np.arange(start, stop)
+            changed |= (index < self._start) | (index >= self._stop)
+            rows = index[changed]
+
+        parts = [
+            HEADER.pack(
+                kind,
+                VERSION,
+                snapshot.depth,
+                snapshot.seq,
+                self.seq or 0,
+                int(state.checksum) & 0xFFFFFFFF,
+                start,
+                stop,
+                len(rows),
+                snapshot.bid_volume_total,
+                snapshot.ask_volume_total,
+                snapshot.best_bid,
+                snapshot.best_ask,
+                state.imbalance["time"],
+                state.imbalance["value"],
+                state.large_volume["value"],
+            ),
+            self._pair,
+        ]
+        for name, dtype in COLUMNS:
+            column = getattr(snapshot, name)[rows]
+            self._sent[name][rows] = column
+            parts.append(column.astype(dtype).tobytes())
+        parts.append(rows.astype("<u2").tobytes())
+
+        self.seq = snapshot.seq
+        self._start, self._stop = start, stop
+        return Frame.from_bytes(b"".join(parts))
@@ -0,0 +1,158 @@
+from __future__ import annotations
+
+import numpy as np
+
+from handlers.book import Book
+from handlers.pulling_stacking import PullingStackingTracker
+
+
+class BookSnapshot:
+    """
+    Preallocated price ladder of a single pair.
+
+    The ladder holds ``2 * depth`` rows ordered by descending price: the asks
+    occupy the upper half (best ask at ``depth - 1``) and the bids the lower
+    half (best bid at ``depth``). All columns are updated in place on every
+    book update, dicts are only built in :func:`to_rows`.
+    """
+
+    def __init__(self: BookSnapshot, depth: int) -> None:
+        self.depth: int = depth
+        size = 2 * depth
+
+        self.price = np.zeros(size, dtype=np.float64)
+        self.bid = np.zeros(size, dtype=np.int64)
+        self.ask = np.zeros(size, dtype=np.int64)
+        self.bid_ps = np.zeros(size, dtype=np.int64)
+        self.ask_ps = np.zeros(size, dtype=np.int64)
+        self.bid_ps_history = np.zeros(size, dtype=np.int64)
+        self.ask_ps_history = np.zeros(size, dtype=np.int64)
+        # last volume change of each level and the update it happened at
+        self.bid_change = np.zeros(size, dtype=np.int64)
+        self.ask_change = np.zeros(size, dtype=np.int64)
+        self.bid_changed_at = np.zeros(size, dtype=np.int64)
+        self.ask_changed_at = np.zeros(size, dtype=np.int64)
+
+        self.pulling_stacking = PullingStackingTracker(depth)
+
+        # raw (unrounded) volumes of each side, best level first
+        self._bid_raw = np.zeros(depth, dtype=np.float64)
+        self._ask_raw = np.zeros(depth, dtype=np.float64)
+        self._side_price = np.zeros(depth, dtype=np.float64)
+
+        self.start = depth
+        self.stop = depth
+        self.bid_volume_total = 0
+        self.ask_volume_total = 0
+        self.best_bid = 0.0
+        self.best_ask = 0.0
+
+    def update(self: BookSnapshot, book: Book, message: dict) -> None:
+        """Loads the best levels of the book into the ladder and recomputes it"""
+        depth = self.depth
+        self.pulling_stacking.update(message, book)
+
+        bid_ticks, bid_qty = book.bid.top(depth)
+        ask_ticks, ask_qty = book.ask.top(depth)
+        n_bid = len(bid_ticks)
+        n_ask = len(ask_ticks)
+        self.start = depth - n_ask
+        self.stop = depth + n_bid
+
+        # bids: best bid first, written top-down below the spread
+        np.divide(bid_ticks, book.price_scale, out=self._side_price[:n_bid])
+        np.divide(bid_qty, book.qty_scale, out=self._bid_raw[:n_bid])
+        self.price[depth : self.stop] = self._side_price[:n_bid]
+        self.bid[depth : self.stop] = np.rint(self._bid_raw[:n_bid])
+        self.bid[self.start : depth] = 0
+        self.pulling_stacking.fill(
+            "bid",
+            self._side_price[:n_bid].tolist(),
+            self.bid[depth : self.stop],
+            self.bid_ps[depth : self.stop],
+            self.bid_ps_history[depth : self.stop],
+            self.bid_change[depth : self.stop],
+            self.bid_changed_at[depth : self.stop],
+        )
+        self.bid_ps[self.start : depth] = 0
+        self.bid_ps_history[self.start : depth] = 0
+        self.bid_change[self.start : depth] = 0
+        self.bid_changed_at[self.start : depth] = 0
+
+        # asks: best ask first, written bottom-up above the spread
+        np.divide(ask_ticks, book.price_scale, out=self._side_price[:n_ask])
+        np.divide(ask_qty, book.qty_scale, out=self._ask_raw[:n_ask])
+        self.price[self.start : depth] = self._side_price[:n_ask][::-1]
+        self.ask[self.start : depth] = np.rint(self._ask_raw[:n_ask][::-1])
+        self.ask[depth : self.stop] = 0
+        self.pulling_stacking.fill(
+            "ask",
+            self._side_price[:n_ask][::-1].tolist(),
+            self.ask[self.start : depth],
+            self.ask_ps[self.start : depth],
+            self.ask_ps_history[self.start : depth],
+            self.ask_change[self.start : depth],
+            self.ask_changed_at[self.start : depth],
+        )
+        self.ask_ps[depth : self.stop] = 0
+        self.ask_ps_history[depth : self.stop] = 0
+        self.ask_change[depth : self.stop] = 0
+        self.ask_changed_at[depth : self.stop] = 0
+
+        # totals are computed from the unrounded volumes
+        self.bid_volume_total = round(float(self._bid_raw[:n_bid].sum()))
+        self.ask_volume_total = round(float(self._ask_raw[:n_ask].sum()))
+
+        self.best_bid = float(self.price[depth]) if n_bid else 0.0
+        self.best_ask = float(self.price[depth - 1]) if n_ask else 0.0
+
+    @property
+    def seq(self: BookSnapshot) -> int:
+        """Number of book updates applied so far"""
+        return self.pulling_stacking.seq
+
+    @property
+    def peg_price(self: BookSnapshot) -> float:
+        return (self.best_bid + self.best_ask) / 2
+
+    @property
+    def best_bid_volume(self: BookSnapshot) -> int:
+        return int(self.bid[self.depth]) if self.stop > self.depth else 0
+
+    @property
+    def best_ask_volume(self: BookSnapshot) -> int:
+        return int(self.ask[self.depth - 1]) if self.start < self.depth else 0
+
+    def total_percentages(self: BookSnapshot) -> tuple[int, int]:
+        """Returns the ask and bid share of the total volume in percent"""
+        total = self.ask_volume_total + self.bid_volume_total
+        if total == 0:
+            return 0, 0
+        return (
+            round(self.ask_volume_total / total * 100),
+            round(self.bid_volume_total / total * 100),
+        )
+
+    def to_rows(self: BookSnapshot) -> list[dict]:
+        """Serializes the ladder into one dict per level"""
+        rows = slice(self.start, self.stop)
+        return [
+            {
+                "bid": bid,
+                "price": price,
+                "ask": ask,
+                "ask_ps": ask_ps,
+                "bid_ps": bid_ps,
+                "ask_ps_history": ask_ps_history,
+                "bid_ps_history": bid_ps_history,
+            }
+            for bid, price, ask, ask_ps, bid_ps, ask_ps_history, bid_ps_history in zip(
+                self.bid[rows].tolist(),
+                self.price[rows].tolist(),
+                self.ask[rows].tolist(),
+                self.ask_ps[rows].tolist(),
+                self.bid_ps[rows].tolist(),
+                self.ask_ps_history[rows].tolist(),
+                self.bid_ps_history[rows].tolist(),
+            )
+        ]
@@ -0,0 +1,254 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import time
+from collections import deque
+from typing import Any, Callable, Iterable, Optional
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, fall back to the stdlib encoder
+    orjson = None
+
+from handlers.metrics import counter, gauge, histogram
+
+SERIALIZE_SECONDS = histogram(
+    "websocket_serialize_seconds", "Time to encode a frame", ("stream",)
+)
+SEND_SECONDS = histogram(
+    "websocket_send_seconds", "Time to hand a frame to the socket", ("stream",)
+)
+CONFLATED = counter(
+    "websocket_conflated_total", "Frames replaced by a newer frame", ("stream",)
+)
+DROPPED = counter(
+    "websocket_dropped_total", "Frames dropped for slow clients", ("stream",)
+)
+# started and not yet closed subscribers, for the gauges
+_subscribers: set[Subscriber] = set()
+
+
+def by_stream(value: Callable[[Subscriber], float]) -> Callable[[], dict]:
+    def collect() -> dict[tuple, float]:
+        values: dict[tuple, float] = {}
+        for subscriber in _subscribers:
+            key = (subscriber.stream,)
+            values[key] = values.get(key, 0) + value(subscriber)
+        return values
+
+    return collect
+
+
+gauge(
+    "websocket_clients",
+    "Connected websocket clients",
+    ("stream",),
+    by_stream(lambda subscriber: 1),
+)
+gauge(
+    "websocket_outbox_frames",
+    "Frames waiting in the outboxes of the websocket clients",
+    ("stream",),
+    by_stream(lambda subscriber: subscriber.depth),
+)
+
+
+def encode(payload: Any) -> bytes:
+    """Encodes ``payload`` to JSON bytes, using orjson if it is installed"""
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload, separators=(",", ":")).encode()
+
+
+def decode(data: bytes) -> Any:
+    """Decodes JSON bytes, using orjson if it is installed"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+class Frame:
+    """A payload encoded once and shared by every subscriber"""
+
+    __slots__ = ("data", "binary", "_text")
+
+    def __init__(self: Frame, payload: Any) -> None:
+        self.data: bytes = encode(payload)
+        self.binary: bool = False
+        self._text: str | None = None
+
+    @classmethod
+    def from_bytes(cls: type[Frame], data: bytes, binary: bool = True) -> Frame:
+        """A frame of encoded data, sent as a binary message or as JSON text"""
+        frame = cls.__new__(cls)
+        frame.data = data
+        frame.binary = binary
+        frame._text = None
+        return frame
+
+    @property
+    def text(self: Frame) -> str:
+        # ASGI text frames take a str, decode once for all sockets
+        if self._text is None:
+            self._text = self.data.decode()
+        return self._text
+
+
+async def send(ws: Any, payload: Any | Frame) -> None:
+    """
+    Sends ``payload`` to ``ws`` as a single frame: JSON text, or binary for
+    frames made with ``Frame.from_bytes``
+    """
+    frame = payload if isinstance(payload, Frame) else Frame(payload)
+    if frame.binary:
+        await ws.send_bytes(frame.data)
+    else:
+        await ws.send_text(frame.text)
+
+
+class Subscriber:
+    """
+    A websocket client with its own bounded outbox.
+
+    :func:`publish` never waits for the socket, a sender task drains the
+    outbox at most ``max_rate`` times per second. Frames published with a
+    ``key`` are conflated: only the latest frame per key is kept (book and
+    spread snapshots). Frames without a key are all delivered in order
+    (trades and orders); if more than ``max_queue`` of them pile up the client
+    is considered too slow and is disconnected.
+
+    Instead of a frame a callable can be published with a key, it is called
+    when the outbox is drained and returns the frame to send or ``None``.
+
+    ``stream`` labels the metrics of the client (``book``, ``spread``, ...).
+    """
+
+    def __init__(
+        self: Subscriber,
+        ws: Any,
+        max_rate: Optional[float] = None,
+        max_queue: int = 10_000,
+        stream: str = "other",
+    ) -> None:
+        self.ws: Any = ws
+        self.stream: str = stream
+        self.max_rate: Optional[float] = max_rate
+        self.max_queue: int = max_queue
+        self.closed: bool = False
+        self.conflated: int = 0
+        self.dropped: int = 0
+
+        self._latest: dict[Any, Frame | Callable[[], Optional[Frame]]] = {}
+        self._queue: deque[Frame] = deque()
+        self._pending: asyncio.Event = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self: Subscriber) -> None:
+        self._task = asyncio.create_task(self._run())
+        _subscribers.add(self)
+
+    def publish(
+        self: Subscriber, frame: Frame | Callable[[], Optional[Frame]], key: Any = None
+    ) -> None:
+        if self.closed:
+            return
+        if key is not None:
+            if key in self._latest:
+                self.conflated += 1
+                CONFLATED.inc(self.stream)
+            self._latest[key] = frame
+        elif len(self._queue) >= self.max_queue:
+            self.dropped += len(self._queue)
+            DROPPED.inc(self.stream, amount=len(self._queue))
+            logging.warning("Disconnecting slow websocket client")
+            self.close()
+            return
+        else:
+            self._queue.append(frame)
+        self._pending.set()
+
+    def discard(self: Subscriber, key: Any) -> None:
+        """Drops the frame waiting under ``key``, if any"""
+        self._latest.pop(key, None)
+
+    @property
+    def depth(self: Subscriber) -> int:
+        """Number of frames waiting to be sent"""
+        return len(self._queue) + len(self._latest)
+
+    async def _run(self: Subscriber) -> None:
+        interval = 1 / self.max_rate if self.max_rate else 0
+        loop = asyncio.get_running_loop()
+        try:
+            while not self.closed:
+                await self._pending.wait()
+                self._pending.clear()
+                started = loop.time()
+
+                while self._queue:
+                    await self._send(self._queue.popleft())
+                latest, self._latest = self._latest, {}
+                for frame in latest.values():
+                    if not isinstance(frame, Frame):
+                        serialize_started = time.perf_counter()
+                        frame = frame()
+                        SERIALIZE_SECONDS.observe(
+                            time.perf_counter() - serialize_started, self.stream
+                        )
+                    if frame is not None:
+                        await self._send(frame)
+
+                if interval:
+                    await asyncio.sleep(max(0, interval - (loop.time() - started)))
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logging.warning("Websocket send failed: %s", e)
+            self._task = None
+            self.close()
+
+    async def _send(self: Subscriber, frame: Frame) -> None:
+        started = time.perf_counter()
+        await send(self.ws, frame)
+        SEND_SECONDS.observe(time.perf_counter() - started, self.stream)
+
+    def close(self: Subscriber) -> None:
+        """Stops the sender task and closes the socket"""
+        if self.closed:
+            return
+        self.closed = True
+        _subscribers.discard(self)
+        self._queue.clear()
+        self._latest.clear()
+        if self._task is not None:
+            self._task.cancel()
+        asyncio.create_task(self._close_socket())
+
+    async def _close_socket(self: Subscriber) -> None:
+        try:
+            await self.ws.close()
+        except Exception:
+            pass
+
+
+def publish(
+    subscribers: Iterable[Subscriber],
+    payload: Any | Frame,
+    key: Any = None,
+    stream: str = "other",
+) -> Frame:
+    """
+    Queues ``payload`` for all ``subscribers`` without waiting for any socket.
+    The payload is encoded once, the time it takes is recorded for ``stream``.
+    """
+    if isinstance(payload, Frame):
+        frame = payload
+    else:
+        started = time.perf_counter()
+        frame = Frame(payload)
+        SERIALIZE_SECONDS.observe(time.perf_counter() - started, stream)
+    for subscriber in subscribers:
+        subscriber.publish(frame, key)
+    return frame
@@ -0,0 +1,352 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Optional
+
+import numpy as np
+from starlette.websockets import WebSocketDisconnect
+
+from handlers.broadcast import Subscriber, publish
+from handlers.pairs import RELEASE_DELAY, PairUsers
+
+# columns of a candle, as in the Kraken REST OHLC response
+FIELDS = ("time", "open", "high", "low", "close", "vwap", "volume", "count")
+TIME, OPEN, HIGH, LOW, CLOSE, VWAP, VOLUME, COUNT = range(len(FIELDS))
+
+# intervals in minutes served from the store, rolled up from 1 minute candles
+INTERVALS = (1, 5, 15, 30, 60, 240, 1440)
+# intervals in minutes Kraken serves OHLC data for
+KRAKEN_INTERVALS = (*INTERVALS, 10080, 21600)
+CANDLE_CAPACITY = 5000
+
+
+def merge(base: Optional[list], minute: list, start: float) -> list:
+    """The candle starting at ``start`` made of ``base`` followed by ``minute``"""
+    if base is None:
+        return [start, *minute[OPEN:]]
+    volume = base[VOLUME] + minute[VOLUME]
+    notional = base[VWAP] * base[VOLUME] + minute[VWAP] * minute[VOLUME]
+    return [
+        start,
+        base[OPEN],
+        max(base[HIGH], minute[HIGH]),
+        min(base[LOW], minute[LOW]),
+        minute[CLOSE],
+        notional / volume if volume else minute[CLOSE],
+        volume,
+        base[COUNT] + minute[COUNT],
+    ]
+
+
+def subtract(candle: list, minute: list) -> Optional[list]:
+    """
+    ``candle`` without its last (still open) ``minute``. High and low can't
+    be taken out, they are kept as both only grow while the minute is open.
+    """
+    if candle[TIME] == minute[TIME]:
+        return None
+    volume = max(0.0, candle[VOLUME] - minute[VOLUME])
+    notional = candle[VWAP] * candle[VOLUME] - minute[VWAP] * minute[VOLUME]
+    return [
+        candle[TIME],
+        candle[OPEN],
+        candle[HIGH],
+        candle[LOW],
+        candle[CLOSE],
+        notional / volume if volume else candle[VWAP],
+        volume,
+        max(0.0, candle[COUNT] - minute[COUNT]),
+    ]
+
+
+def parse_rows(rows: list[list]) -> np.ndarray:
+    """Kraken REST OHLC rows (numbers and decimal strings) as a float array"""
+    if not rows:
+        return np.zeros((0, len(FIELDS)))
+    # numpy parses a whole column of decimal strings at once, much faster
+    # than float() per value or a string array of mixed rows
+    return np.column_stack(
+        [np.array(column, dtype=np.float64) for column in zip(*rows)]
+    )
+
+
+def columnar(candles: np.ndarray) -> dict:
+    """Candles, one per row, as parallel arrays per field"""
+    payload = {name: candles[:, i].tolist() for i, name in enumerate(FIELDS)}
+    payload["time"] = candles[:, TIME].astype(np.int64).tolist()
+    payload["count"] = candles[:, COUNT].astype(np.int64).tolist()
+    return payload
+
+
+class CandleSeries:
+    """
+    Candles of one interval: the closed candles in preallocated columns and
+    the open candle, which is the candle of the previous minutes of the
+    interval (``base``) merged with the latest state of the current minute.
+    """
+
+    def __init__(self: CandleSeries, interval: int, capacity: int) -> None:
+        self.interval: int = interval
+        self.columns: np.ndarray = np.zeros((capacity, len(FIELDS)))
+        self._head: int = 0
+        self._count: int = 0
+        self.base: Optional[list] = None
+        self.minute: Optional[list] = None
+        self.current: Optional[list] = None
+
+    def __len__(self: CandleSeries) -> int:
+        return self._count + (self.current is not None)
+
+    def bucket(self: CandleSeries, t: float) -> float:
+        seconds = self.interval * 60
+        return t - t % seconds
+
+    def append(self: CandleSeries, candle: list) -> None:
+        self.columns[self._head] = candle
+        self._head = (self._head + 1) % len(self.columns)
+        self._count = min(self._count + 1, len(self.columns))
+
+    def seed(self: CandleSeries, rows: list[list], minute: list) -> None:
+        """Seeds from REST rows of this interval and the open 1 minute candle"""
+        candles = parse_rows(rows[-len(self.columns) :])
+        closed = len(candles) - 1 if len(candles) else 0
+        self.columns[:closed] = candles[:closed]
+        self._count = closed
+        self._head = closed % len(self.columns)
+        current = candles[-1].tolist() if len(candles) else None
+        if current is not None and self.bucket(minute[TIME]) != current[TIME]:
+            # the open candle of the REST response closed in the meantime
+            self.append(current)
+            current = None
+        self.base = subtract(current, minute) if current is not None else None
+        self.minute = minute
+        self.current = merge(self.base, minute, self.bucket(minute[TIME]))
+
+    def update(self: CandleSeries, minute: list) -> bool:
+        """Applies the latest state of a 1 minute candle"""
+        if self.minute is not None and minute[TIME] != self.minute[TIME]:
+            if minute[TIME] < self.minute[TIME]:
+                return False
+            # the previous minute is final
+            if self.bucket(minute[TIME]) != self.current[TIME]:
+                self.append(self.current)
+                self.base = None
+            else:
+                self.base = merge(self.base, self.minute, self.current[TIME])
+        self.minute = minute
+        self.current = merge(self.base, minute, self.bucket(minute[TIME]))
+        return True
+
+    def arrays(self: CandleSeries) -> np.ndarray:
+        """Returns a copy of all candles in chronological order, one per row"""
+        capacity = len(self.columns)
+        order = (np.arange(self._count) + self._head - self._count) % capacity
+        candles = self.columns[order]
+        if self.current is not None:
+            candles = np.vstack([candles, self.current])
+        return candles
+
+
+class CandleStore:
+    """Candles of all served intervals of a single pair"""
+
+    def __init__(
+        self: CandleStore,
+        pair: str,
+        intervals: tuple[int, ...] = INTERVALS,
+        capacity: int = CANDLE_CAPACITY,
+    ) -> None:
+        self.pair: str = pair
+        self.series: dict[int, CandleSeries] = {
+            interval: CandleSeries(interval, capacity) for interval in intervals
+        }
+        self.seeded: bool = False
+        self.clients: dict[int, set[Subscriber]] = {}
+        # latest state of the 1 minute candles received while seeding
+        self._pending: dict[float, tuple[list, Any]] = {}
+
+    def seed(self: CandleStore, rows: dict[int, list[list]]) -> None:
+        minute = [float(value) for value in rows[1][-1]]
+        for interval, series in self.series.items():
+            series.seed(rows[interval], minute)
+        self.seeded = True
+        for minute, time in self._pending.values():
+            self.on_minute(minute, time)
+        self._pending = {}
+
+    def on_message(self: CandleStore, payload: list) -> None:
+        """Applies a Kraken ``ohlc-1`` message payload"""
+        # [time, etime, open, high, low, close, vwap, volume, count]
+        etime = float(payload[1])
+        minute = [etime - 60, *(float(value) for value in payload[2:])]
+        if not self.seeded:
+            self._pending[minute[TIME]] = (minute, payload[0])
+            return
+        self.on_minute(minute, payload[0])
+
+    def on_minute(self: CandleStore, minute: list, time: Any) -> None:
+        for interval, series in self.series.items():
+            if not series.update(minute):
+                continue
+            clients = self.clients.get(interval)
+            if clients:
+                publish(clients, self.live_candle(interval, time), stream="candles")
+
+    def live_candle(self: CandleStore, interval: int, time: Any) -> list:
+        """The open candle in the layout of the Kraken ohlc channel"""
+        candle = self.series[interval].current
+        return [
+            float(time),
+            candle[TIME] + interval * 60,
+            candle[OPEN],
+            candle[HIGH],
+            candle[LOW],
+            candle[CLOSE],
+            candle[VWAP],
+            candle[VOLUME],
+            int(candle[COUNT]),
+        ]
+
+    def to_columnar(self: CandleStore, interval: int) -> dict:
+        return {
+            "pair": self.pair,
+            "interval": interval,
+            **columnar(self.series[interval].arrays()),
+        }
+
+    def to_tradingview(self: CandleStore, interval: int) -> dict:
+        """Candles in the layout of ``transform_ohlc_tradingview``"""
+        candles = self.series[interval].arrays()
+        times = candles[:, TIME].astype(np.int64).tolist()
+        columns = {name: candles[:, i].tolist() for i, name in enumerate(FIELDS)}
+        return {
+            "candlestick": [
+                {"time": t, "open": o, "high": h, "low": lo, "close": c}
+                for t, o, h, lo, c in zip(
+                    times,
+                    columns["open"],
+                    columns["high"],
+                    columns["low"],
+                    columns["close"],
+                )
+            ],
+            "volume": [
+                {"time": t, "value": v} for t, v in zip(times, columns["volume"])
+            ],
+            "trade_count": [
+                {"time": t, "value": v} for t, v in zip(times, columns["count"])
+            ],
+            "vwap": [{"time": t, "value": v} for t, v in zip(times, columns["vwap"])],
+        }
+
+
+class CandleHub:
+    """
+    Server side candles of every pair, for all :data:`INTERVALS` from a
+    single ``ohlc-1`` subscription per pair.
+
+    A pair is seeded once from REST (one request per interval) on its first
+    use. Afterwards history requests are served from memory and websocket
+    clients get the open candle of their interval on every 1 minute update.
+    The store and the subscription are dropped a while after the last client
+    or request, see :class:`PairUsers`.
+    """
+
+    def __init__(
+        self: CandleHub,
+        fetch: Callable[[str, int], Awaitable[list[list]]],
+        intervals: tuple[int, ...] = INTERVALS,
+        capacity: int = CANDLE_CAPACITY,
+        max_rate: Optional[float] = None,
+        release_delay: float = RELEASE_DELAY,
+    ) -> None:
+        self.fetch: Callable[[str, int], Awaitable[list[list]]] = fetch
+        self.intervals: tuple[int, ...] = intervals
+        self.capacity: int = capacity
+        self.max_rate: Optional[float] = max_rate
+        self.router: Any = None
+        self.stores: dict[str, CandleStore] = {}
+        self.users: PairUsers = PairUsers(self._remove_pair, release_delay)
+        self._listeners: dict[str, Callable] = {}
+        self._seeding: dict[str, asyncio.Task] = {}
+
+    def start(self: CandleHub, router: Any) -> None:
+        self.router = router
+
+    def serves(self: CandleHub, interval: int) -> bool:
+        return self.router is not None and interval in self.intervals
+
+    async def store(self: CandleHub, pair: str) -> CandleStore:
+        """The seeded store of ``pair``, created on first use"""
+        store = self.stores.get(pair)
+        if store is not None and store.seeded:
+            return store
+        if pair not in self._seeding:
+            self._seeding[pair] = asyncio.ensure_future(self._add_pair(pair))
+        return await asyncio.shield(self._seeding[pair])
+
+    async def _add_pair(self: CandleHub, pair: str) -> CandleStore:
+        try:
+            await self.users.settled(pair)
+            store = self.stores.get(pair)
+            if store is None:
+                store = self.stores[pair] = CandleStore(
+                    pair, self.intervals, self.capacity
+                )
+                listener = self._listeners[pair] = self._listener(store)
+                await self.router.subscribe(
+                    listener, {"name": "ohlc", "interval": 1}, pair
+                )
+            logging.info("Seeding the candles of %s", pair)
+            rows = await asyncio.gather(
+                *(self.fetch(pair, interval) for interval in self.intervals)
+            )
+            store.seed(dict(zip(self.intervals, rows)))
+            return store
+        finally:
+            del self._seeding[pair]
+
+    async def _remove_pair(self: CandleHub, pair: str) -> None:
+        self.stores.pop(pair, None)
+        listener = self._listeners.pop(pair, None)
+        if listener is not None:
+            logging.info("Dropping the candles of %s", pair)
+            await self.router.unsubscribe(
+                listener, {"name": "ohlc", "interval": 1}, pair
+            )
+
+    def _listener(self: CandleHub, store: CandleStore) -> Callable:
+        def on_message(pair: str, payload: list) -> None:
+            store.on_message(payload)
+
+        return on_message
+
+    async def get_payload(
+        self: CandleHub, pair: str, interval: int, format: str = "tradingview"
+    ) -> dict:
+        store = await self.store(pair)
+        self.users.touch(pair)
+        if format == "columnar":
+            return store.to_columnar(interval)
+        return store.to_tradingview(interval)
+
+    async def serve(self: CandleHub, ws: Any, pair: str, interval: int) -> None:
+        """Streams the open candle of ``pair`` and ``interval`` to a client"""
+        await ws.accept()
+        subscriber = Subscriber(ws, max_rate=self.max_rate, stream="candles")
+        subscriber.start()
+        store = None
+        self.users.acquire(pair)
+        try:
+            store = await self.store(pair)
+            store.clients.setdefault(interval, set()).add(subscriber)
+            while True:
+                await ws.receive_text()
+        except WebSocketDisconnect:
+            pass
+        finally:
+            if store is not None:
+                store.clients[interval].discard(subscriber)
+            self.users.release(pair)
+            subscriber.close()
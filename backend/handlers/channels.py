@@ -0,0 +1,188 @@
+from __future__ import annotations
+
+import logging
+import time
+from typing import Any, Callable, Optional, Union
+
+from starlette.websockets import WebSocketDisconnect
+
+from handlers.broadcast import Subscriber, publish
+from handlers.metrics import KRAKEN_LAG, KRAKEN_MESSAGES
+
+# channels where only the latest message matters, slow clients skip the rest
+CONFLATED_CHANNELS = {"spread"}
+
+
+def channel_name(subscription: dict) -> str:
+    """The channel name Kraken uses in the messages of ``subscription``"""
+    name = subscription["name"]
+    if name == "ohlc":
+        return "ohlc-{}".format(subscription.get("interval", 1))
+    if name == "book":
+        return "book-{}".format(subscription.get("depth", 10))
+    return name
+
+
+def pair_key(pair: str) -> str:
+    """
+    A pair name comparable across the Kraken notations: ``XXBTZUSD``,
+    ``XBTUSD``, ``XBT/USD`` and ``BTC/USD`` are all ``BTCUSD``
+    """
+    pair = pair.replace("/", "").upper()
+    if len(pair) == 8 and pair[0] in "XZ" and pair[4] in "XZ":
+        # legacy names with a class prefix per asset
+        pair = pair[1:4] + pair[5:]
+    return pair.replace("XBT", "BTC").replace("XDG", "DOGE")
+
+
+def exchange_time(channel: str, payload: Any) -> Optional[float]:
+    """Kraken timestamp of a public channel payload, ``None`` if it has none"""
+    try:
+        if channel == "spread":
+            return float(payload[2])
+        if channel == "trade":
+            # the last trade of the batch
+            return float(payload[-1][2])
+        if channel.startswith("ohlc"):
+            return float(payload[0])
+    except (IndexError, TypeError, ValueError):
+        pass
+    return None
+
+
+class ChannelRouter:
+    """
+    Shares the connections of one Kraken websocket client between all
+    consumers of its channels.
+
+    Consumers subscribe to a channel and pair (``None`` for the private
+    ``ownTrades`` and ``openOrders`` channels). They are either websocket
+    :class:`Subscriber` clients, which get every message encoded once, or
+    callables ``callback(pair, payload)`` for consumers inside the process.
+    Subscriptions are reference counted: the upstream subscription is sent
+    for the first consumer of a channel and pair and removed with the last.
+
+    Callables registered with :meth:`on_subscribed` are called for every
+    ``subscribed`` status of a channel, including the resubscriptions of the
+    client after a reconnect.
+    """
+
+    def __init__(self: ChannelRouter, client: Any, max_rate: Optional[float] = None):
+        self.client: Any = client
+        self.max_rate: Optional[float] = max_rate
+        self.clients: dict[tuple, set[Subscriber]] = {}
+        self.listeners: dict[tuple, set[Callable]] = {}
+        # channel id -> (channel name, pair) from the subscription status
+        self._channel_ids: dict[int, tuple] = {}
+        # channel name -> callbacks of its subscribed statuses
+        self._subscribed: dict[str, list[Callable[[], None]]] = {}
+
+    def count(self: ChannelRouter, key: tuple) -> int:
+        return len(self.clients.get(key, ())) + len(self.listeners.get(key, ()))
+
+    async def subscribe(
+        self: ChannelRouter,
+        consumer: Union[Subscriber, Callable],
+        subscription: dict,
+        pair: Optional[str] = None,
+    ) -> None:
+        key = (channel_name(subscription), pair)
+        first = self.count(key) == 0
+        consumers = self.clients if isinstance(consumer, Subscriber) else self.listeners
+        consumers.setdefault(key, set()).add(consumer)
+        if first:
+            logging.info("Subscribing to %s %s", key[0], pair or "")
+            await self.client.subscribe(
+                subscription=subscription, pair=[pair] if pair else None
+            )
+
+    async def unsubscribe(
+        self: ChannelRouter,
+        consumer: Union[Subscriber, Callable],
+        subscription: dict,
+        pair: Optional[str] = None,
+    ) -> None:
+        key = (channel_name(subscription), pair)
+        consumers = self.clients if isinstance(consumer, Subscriber) else self.listeners
+        if consumer not in consumers.get(key, ()):
+            return
+        consumers[key].discard(consumer)
+        if not consumers[key]:
+            del consumers[key]
+        if self.count(key) == 0:
+            logging.info("Unsubscribing from %s %s", key[0], pair or "")
+            await self.client.unsubscribe(
+                subscription=subscription, pair=[pair] if pair else None
+            )
+
+    def on_subscribed(
+        self: ChannelRouter, name: str, callback: Callable[[], None]
+    ) -> None:
+        """Calls ``callback()`` whenever the channel ``name`` is (re)subscribed"""
+        self._subscribed.setdefault(name, []).append(callback)
+
+    def on_message(self: ChannelRouter, message: Union[dict, list]) -> bool:
+        """
+        Routes a message of the client to the consumers of its channel.
+        Returns ``False`` for messages that are not channel data (events).
+        """
+        if isinstance(message, dict):
+            if (
+                message.get("event") == "subscriptionStatus"
+                and message.get("status") == "subscribed"
+            ):
+                if "channelID" in message:
+                    self._channel_ids[message["channelID"]] = (
+                        message["channelName"],
+                        message.get("pair"),
+                    )
+                for callback in self._subscribed.get(message.get("channelName"), ()):
+                    callback()
+            return False
+        if not isinstance(message, list) or len(message) < 3:
+            return False
+
+        if isinstance(message[0], int):
+            # public: [channel id, payload(s)..., channel name, pair]
+            key = self._channel_ids.get(message[0], (message[-2], message[-1]))
+            payload = message[1] if len(message) == 4 else message[1:-2]
+        else:
+            # private: [payload, channel name, {"sequence": n}]
+            key = (message[1], None)
+            payload = message[0]
+
+        KRAKEN_MESSAGES.inc(key[0])
+        sent = exchange_time(key[0], payload)
+        if sent is not None:
+            KRAKEN_LAG.observe(time.time() - sent, key[0])
+
+        clients = self.clients.get(key)
+        if clients:
+            publish(
+                clients,
+                payload,
+                key=key if key[0] in CONFLATED_CHANNELS else None,
+                stream=key[0],
+            )
+        for listener in self.listeners.get(key, ()):
+            listener(key[1], payload)
+        return True
+
+    async def serve(
+        self: ChannelRouter, ws: Any, subscription: dict, pair: Optional[str] = None
+    ) -> None:
+        """Serves a websocket client that streams a single channel and pair"""
+        await ws.accept()
+        subscriber = Subscriber(
+            ws, max_rate=self.max_rate, stream=channel_name(subscription)
+        )
+        subscriber.start()
+        try:
+            await self.subscribe(subscriber, subscription, pair)
+            while True:
+                await ws.receive_text()
+        except WebSocketDisconnect:
+            pass
+        finally:
+            await self.unsubscribe(subscriber, subscription, pair)
+            subscriber.close()
@@ -0,0 +1,34 @@
+import logging
+import os
+from typing import Optional
+
+from kraken.base_api import KrakenSpotBaseAPI
+from kraken.spot.websocket import KrakenSpotWSClientBase
+
+
+def use_kraken_endpoints(
+    rest_url: Optional[str] = None,
+    ws_url: Optional[str] = None,
+    ca_file: Optional[str] = None,
+) -> None:
+    """
+    Points the Kraken clients at other endpoints, e.g. the local mock of
+    ``python -m mock_kraken``. Must run before the first client is created.
+
+    ``ws_url`` is the host of the websocket APIs without scheme (the client
+    always connects with ``wss://``), served at ``/public``, ``/public/v2``
+    and ``/private``. ``ca_file`` is trusted for both REST and websockets,
+    for endpoints with a self-signed certificate.
+    """
+    if rest_url:
+        KrakenSpotBaseAPI.URL = rest_url
+        logging.info("Kraken REST API at %s", rest_url)
+    if ws_url:
+        host = ws_url.removeprefix("wss://").rstrip("/")
+        KrakenSpotWSClientBase.PROD_ENV_URL = f"{host}/public"
+        KrakenSpotWSClientBase.AUTH_PROD_ENV_URL = f"{host}/private"
+        logging.info("Kraken websocket API at %s", host)
+    if ca_file:
+        # read by requests and by the default SSL context of websockets
+        os.environ["REQUESTS_CA_BUNDLE"] = ca_file
+        os.environ["SSL_CERT_FILE"] = ca_file
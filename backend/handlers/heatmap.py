@@ -0,0 +1,317 @@
+"""
+Liquidity heatmap: resting volume per price bucket over time.
+
+Every book update replaces the bucketed volume of the book (both sides
+summed per bucket of ``bucket`` ticks). The volume is averaged over time
+into rows of 1 second, which are averaged into rows of 10 seconds and
+those into rows of 1 minute. Rows are kept in a ring buffer per tier, so
+the memory of a pair is fixed::
+
+    sum(capacity of the tiers) * width * 4 bytes
+
+A row covers ``width`` buckets around the mid price when its slot opens;
+rows of the coarser tiers are aligned to their first row, volume outside
+the window of a row is left out. :meth:`Heatmap.query` returns a window of
+a tier as a dense time x price matrix, of at most ``MAX_QUERY_ROWS`` rows
+(the latest ones) and ``MAX_QUERY_BUCKETS`` buckets.
+"""
+
+from __future__ import annotations
+
+import math
+from typing import Optional
+
+import numpy as np
+
+from handlers.book import Book
+
+# seconds per row and rows kept, 15 minutes of 1s, 3 hours of 10s and a
+# day of 1m rows
+TIERS = ((1, 900), (10, 1080), (60, 1440))
+WIDTH = 200
+# buckets of a query at most, around the last mid price
+MAX_QUERY_BUCKETS = 2000
+# rows of a query at most, the latest ones
+MAX_QUERY_ROWS = 300
+
+
+def nice_step(value: float) -> float:
+    """The largest 1, 2 or 5 times a power of ten that is at most ``value``"""
+    magnitude = 10 ** math.floor(math.log10(value))
+    return max(s for s in (1, 2, 5) if s * magnitude <= value) * magnitude
+
+
+def auto_bucket(book: Book, mid: float) -> int:
+    """Ticks per bucket for a pair: about a basis point of the price, 1-2-5 rounded"""
+    return max(1, int(nice_step(max(mid * 1e-4 * book.price_scale, 1))))
+
+
+def add_shifted(
+    target: np.ndarray, source: np.ndarray, shift: int, weight: float
+) -> None:
+    """``target[i] += weight * source[i + shift]`` where both are defined"""
+    start = max(0, -shift)
+    stop = min(len(target), len(source) - shift)
+    if start < stop:
+        target[start:stop] += weight * source[start + shift : stop + shift]
+
+
+class HeatmapTier:
+    """Rows of one time resolution in a ring buffer, and the row being built"""
+
+    def __init__(self: HeatmapTier, resolution: int, capacity: int, width: int) -> None:
+        self.resolution: int = resolution
+        self.capacity: int = capacity
+        self.width: int = width
+        self.time = np.zeros(capacity, dtype=np.float64)
+        self.base = np.zeros(capacity, dtype=np.int64)
+        self.mid = np.zeros(capacity, dtype=np.float64)
+        self.volume = np.zeros((capacity, width), dtype=np.float32)
+        self._head: int = 0
+        self._count: int = 0
+
+        # the open slot
+        self.slot: Optional[float] = None
+        self.slot_base: int = 0
+        self.slot_mid: float = 0.0
+        self._sum = np.zeros(width, dtype=np.float64)
+        self._weight: float = 0.0
+
+    def __len__(self: HeatmapTier) -> int:
+        return self._count
+
+    @property
+    def weight(self: HeatmapTier) -> float:
+        """Seconds of volume in the open slot"""
+        return self._weight
+
+    def open(self: HeatmapTier, slot: float, base: int, mid: float) -> None:
+        self.slot = slot
+        self.slot_base = base
+        self.slot_mid = mid
+        self._sum[:] = 0
+        self._weight = 0.0
+
+    def add(
+        self: HeatmapTier, base: int, volume: np.ndarray, weight: float, mid: float
+    ) -> None:
+        """Adds ``volume`` (``width`` buckets from ``base``) for ``weight`` seconds"""
+        add_shifted(self._sum, volume, self.slot_base - base, weight)
+        self._weight += weight
+        self.slot_mid = mid
+
+    def close(self: HeatmapTier) -> Optional[np.ndarray]:
+        """Stores the open slot as a row and returns it, ``None`` if it is empty"""
+        if self.slot is None or not self._weight:
+            self.slot = None
+            return None
+        i = self._head
+        row = self._sum / self._weight
+        self.time[i] = self.slot
+        self.base[i] = self.slot_base
+        self.mid[i] = self.slot_mid
+        self.volume[i] = row
+        self._head = (i + 1) % self.capacity
+        self._count = min(self._count + 1, self.capacity)
+        self.slot = None
+        return row
+
+    def rows(self: HeatmapTier, start: float, end: float) -> np.ndarray:
+        """Ring indices of the rows with ``start <= time < end``, oldest first"""
+        first = (self._head - self._count) % self.capacity
+        order = (np.arange(self._count) + first) % self.capacity
+        times = self.time[order]
+        lo, hi = np.searchsorted(times, [start, end], side="left")
+        return order[lo:hi]
+
+
+class Heatmap:
+    """The liquidity heatmap of a single pair, see the module documentation"""
+
+    def __init__(
+        self: Heatmap,
+        bucket: Optional[float] = None,
+        width: int = WIDTH,
+        tiers: tuple[tuple[int, int], ...] = TIERS,
+    ) -> None:
+        # price per bucket, automatic if None
+        self.bucket: Optional[float] = bucket
+        self.width: int = width
+        self.tiers: list[HeatmapTier] = [
+            HeatmapTier(resolution, capacity, width) for resolution, capacity in tiers
+        ]
+        self.bucket_ticks: int = 0
+        self.price_scale: int = 1
+        # bucket indices and volumes of the current book, and the time they
+        # are valid from
+        self._buckets = np.zeros(0, dtype=np.int64)
+        self._volumes = np.zeros(0, dtype=np.float64)
+        self._dense = np.zeros(width, dtype=np.float64)
+        self._mid: float = 0.0
+        self._last: Optional[float] = None
+
+    def update(self: Heatmap, book: Book, t: float) -> None:
+        """Records ``book`` as the state from ``t`` on"""
+        bid, ask = book.bid.best(), book.ask.best()
+        if bid is None or ask is None:
+            return
+        if not self.bucket_ticks:
+            self.price_scale = book.price_scale
+            mid = book.price((bid[0] + ask[0]) / 2)
+            self.bucket_ticks = (
+                max(1, round(self.bucket * book.price_scale))
+                if self.bucket
+                else auto_bucket(book, mid)
+            )
+        if self._last is not None:
+            self._advance(t)
+
+        parts = [book.side(side).top(book.depth) for side in ("bid", "ask")]
+        self._buckets = (
+            np.concatenate([ticks for ticks, _ in parts]) // self.bucket_ticks
+        )
+        self._volumes = (
+            np.concatenate([qty for _, qty in parts]).astype(np.float64)
+            / book.qty_scale
+        )
+        self._mid = (bid[0] + ask[0]) / 2 / book.price_scale
+        first = self.tiers[0]
+        if first.slot is None:
+            resolution = first.resolution
+            first.open(t - t % resolution, self._window(), self._mid)
+        self._densify()
+        self._last = t
+
+    def _window(self: Heatmap) -> int:
+        """First bucket of a row centered on the current mid price"""
+        return int(self._mid * self.price_scale) // self.bucket_ticks - self.width // 2
+
+    def _densify(self: Heatmap) -> None:
+        """The current volume aligned to the open 1 second row"""
+        index = self._buckets - self.tiers[0].slot_base
+        inside = (index >= 0) & (index < self.width)
+        self._dense = np.bincount(
+            index[inside], weights=self._volumes[inside], minlength=self.width
+        )
+
+    def _advance(self: Heatmap, t: float) -> None:
+        """Accumulates the current volume up to ``t``, closing the rows passed"""
+        first = self.tiers[0]
+        resolution = first.resolution
+        if t - self._last > first.capacity * resolution:
+            # a gap longer than the finest tier: the open rows are finished
+            # and rolled up, then the tiers start over
+            end = first.slot + resolution
+            first.add(first.slot_base, self._dense, end - self._last, self._mid)
+            self._flush()
+            first.open(t - t % resolution, self._window(), self._mid)
+            self._densify()
+            return
+        while self._last < t:
+            end = first.slot + resolution
+            stop = min(t, end)
+            first.add(first.slot_base, self._dense, stop - self._last, self._mid)
+            self._last = stop
+            if stop < end:
+                break
+            base, weight = first.slot_base, first.weight
+            row = first.close()
+            if row is not None:
+                self._cascade(1, end - resolution, base, row, weight)
+            first.open(end, self._window(), self._mid)
+            self._densify()
+
+    def _flush(self: Heatmap) -> None:
+        """Closes the open rows of all tiers, each rolled into the coarser ones"""
+        for level, tier in enumerate(self.tiers):
+            slot, base, weight = tier.slot, tier.slot_base, tier.weight
+            row = tier.close()
+            if row is not None:
+                self._cascade(level + 1, slot, base, row, weight)
+
+    def _cascade(
+        self: Heatmap,
+        level: int,
+        start: float,
+        base: int,
+        row: np.ndarray,
+        weight: float,
+    ) -> None:
+        """
+        Adds a closed row of the tier below ``level``, which covers ``weight``
+        seconds, to the coarser tiers
+        """
+        if level >= len(self.tiers):
+            return
+        tier = self.tiers[level]
+        slot = start - start % tier.resolution
+        if tier.slot is not None and tier.slot != slot:
+            closed_base, closed_slot = tier.slot_base, tier.slot
+            closed_weight = tier.weight
+            closed = tier.close()
+            if closed is not None:
+                self._cascade(
+                    level + 1, closed_slot, closed_base, closed, closed_weight
+                )
+        if tier.slot is None:
+            tier.open(slot, base, self._mid)
+        tier.add(base, row, weight, self._mid)
+
+    def query(
+        self: Heatmap,
+        resolution: int,
+        start: Optional[float] = None,
+        end: Optional[float] = None,
+        max_rows: int = MAX_QUERY_ROWS,
+    ) -> Optional[dict]:
+        """
+        The rows of the tier of ``resolution`` seconds with ``start <= time
+        < end`` as a dense matrix over the buckets they cover, ``None`` for
+        an unknown resolution. Of more than ``max_rows`` rows (clamped to
+        ``MAX_QUERY_ROWS``) only the latest are returned and ``truncated`` is
+        set.
+        """
+        tier = next((t for t in self.tiers if t.resolution == resolution), None)
+        if tier is None:
+            return None
+        rows = tier.rows(
+            start if start is not None else -math.inf,
+            end if end is not None else math.inf,
+        )
+        max_rows = min(max(max_rows, 1), MAX_QUERY_ROWS)
+        truncated = len(rows) > max_rows
+        if truncated:
+            rows = rows[-max_rows:]
+        bucket = self.bucket_ticks / self.price_scale if self.bucket_ticks else None
+        if not len(rows):
+            return {
+                "resolution": resolution,
+                "bucket": bucket,
+                "price_start": None,
+                "time": [],
+                "mid": [],
+                "volume": [],
+                "truncated": False,
+            }
+
+        bases = tier.base[rows]
+        lo, hi = int(bases.min()), int(bases.max()) + self.width
+        if hi - lo > MAX_QUERY_BUCKETS:
+            # around the last mid price
+            center = int(tier.mid[rows[-1]] * self.price_scale) // self.bucket_ticks
+            lo = center - MAX_QUERY_BUCKETS // 2
+            hi = lo + MAX_QUERY_BUCKETS
+        matrix = np.zeros((len(rows), hi - lo), dtype=np.float32)
+        for n, (i, base) in enumerate(zip(rows.tolist(), bases.tolist())):
+            add_shifted(matrix[n], tier.volume[i], lo - base, 1.0)
+
+        return {
+            "resolution": resolution,
+            "bucket": bucket,
+            # lower price of the first bucket
+            "price_start": lo * self.bucket_ticks / self.price_scale,
+            "time": tier.time[rows].tolist(),
+            "mid": tier.mid[rows].tolist(),
+            "volume": matrix.round(8).tolist(),
+            "truncated": truncated,
+        }
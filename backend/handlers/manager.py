@@ -1,7 +1,6 @@
 from __future__ import annotations
 
 import asyncio
-import json
 import logging
 import logging.config
 
@@ -14,7 +13,11 @@ import urllib3
 
 
 from kraken.exceptions import KrakenAuthenticationError  # , KrakenPermissionDeniedError
-from kraken.spot import KrakenSpotWSClientV1, Market, Trade, User
+from kraken.spot import KrakenSpotWSClientV1, Market, User
+
+from handlers.channels import ChannelRouter
+from handlers.order_entry import OrderEntry, OrderError
+from handlers.metrics import KRAKEN_MESSAGES, KRAKEN_RECONNECTS
 
 
 class BotStatus(Enum):
@@ -32,8 +35,21 @@ class TradingBot(KrakenSpotWSClientV1):
         # self.__config: dict = config
 
         self.__user: User = User(key=config["key"], secret=config["secret"])
-        self.__trade: Trade = Trade(key=config["key"], secret=config["secret"])
         self.__market: Market = Market(key=config["key"], secret=config["secret"])
+        # the only Kraken websocket connections of the process, shared by all
+        # websocket clients of the dashboard
+        self.router: ChannelRouter = ChannelRouter(
+            self, max_rate=config.get("max_rate")
+        )
+        # orders go over the private connection of this client
+        self.order_entry: OrderEntry = OrderEntry(
+            self,
+            timeout=config.get("order_timeout") or 5.0,
+            quote=config.get("quote"),
+        )
+        self.recorder = config.get("recorder")
+        # systemStatus messages received, one per (re)connect
+        self._connects: int = 0
 
     def get_open_positions(self):
         open_positions = self.__user.get_open_positions()
@@ -46,83 +62,92 @@ class TradingBot(KrakenSpotWSClientV1):
     def get_open_orders(self):
         open_orders = self.__user.get_open_orders()
         if "open" in open_orders:
-            return json.dumps(open_orders["open"])
-        return json.dumps(open_orders)
-
-    def cancel_pending_order(self, txid):
-        return self.__trade.cancel_order(txid)
-
-    def cancel_all_pending_orders(self):
-        return self.__trade.cancel_all_orders()
-
-    def close_position(self, value, flat=False, market=False):
+            return open_orders["open"]
+        return open_orders
+
+    async def cancel_pending_order(self, txid):
+        return await self.order_entry.cancel_order([txid])
+
+    async def cancel_all_pending_orders(self):
+        return await self.order_entry.cancel_all()
+
+    async def get_best_bid_ask(self, pair):
+        """
+        Best bid and ask from the local top of book, the REST ticker if it is
+        not kept or its latest quote is stale
+        """
+        best = self.order_entry.best(pair)
+        if best is not None:
+            return best
+        logging.info("No local top of book for {}, asking the ticker".format(pair))
+        loop = asyncio.get_running_loop()
+        ticker = await loop.run_in_executor(
+            None, lambda: self.__market.get_ticker(pair=pair)
+        )
+        if pair not in ticker:
+            return None
+        return float(ticker[pair]["b"][0]), float(ticker[pair]["a"][0])
+
+    async def close_position(self, value, flat=False, market=False):
+        """
+        Closes a position with a reduce-only order: a market order, or a limit
+        order at the best bid or ask (crossing the spread if ``flat``).
+        Returns the status of the order, ``None`` if it was not placed.
+        """
         if flat:
             logging.info("[bold]Flattening...")
         pair = value["pair"]
         current_position_side = value["type"]
         new_position_side = "sell" if current_position_side == "buy" else "buy"
+        leverage = int(float(value["leverage"]))
         if market:
-            # NOTE: this was not tested yet!
-            res = self.__trade.create_order(
-                ordertype="market",
-                side=new_position_side,
-                pair=pair,
-                volume=float(value["vol"]),
-                leverage=leverage,
-                reduce_only=True,
-                validate=True,
-            )
-            logging.info(
-                "[bold]Sending market {} order for pair {} ...[/bold]".format(
-                    new_position_side, pair
-                )
-            )
-            return res
-        ticker = self.__market.get_ticker(pair=pair)
-
-        if pair in ticker:
+            ordertype, price = "market", None
+        else:
+            best = await self.get_best_bid_ask(pair)
+            if best is None:
+                logging.info("[bold red]No bid/ask for {}[/bold red]".format(pair))
+                return None
             logging.info("[bold]Got the current bid/ask for {}[/bold]".format(pair))
-            best_bid = ticker[pair]["b"][0]
-            best_ask = ticker[pair]["a"][0]
+            best_bid, best_ask = best
+            ordertype = "limit"
             price = (
-                float(best_bid if new_position_side == "sell" else best_ask)
+                (best_bid if new_position_side == "sell" else best_ask)
                 if flat
-                else float(best_ask if new_position_side == "sell" else best_bid)
+                else (best_ask if new_position_side == "sell" else best_bid)
             )
 
-            logging.info(
-                "[bold]Sending {} order for pair {} with price {} ...[/bold]".format(
-                    new_position_side, pair, price
-                )
+        logging.info(
+            "[bold]Sending {} {} order for pair {} with price {} ...[/bold]".format(
+                ordertype, new_position_side, pair, price
             )
-
-            leverage = int(float(value["leverage"]))
-
-            res = self.__trade.create_order(
-                ordertype="limit",
+        )
+        try:
+            res = await self.order_entry.add_order(
+                ordertype=ordertype,
                 side=new_position_side,
                 pair=pair,
                 volume=float(value["vol"]),
                 price=price,
                 leverage=leverage,
                 reduce_only=True,
-                # validate=True,
             )
+        except (OrderError, asyncio.TimeoutError) as error:
+            logging.info("[bold red] Error during order creation.[/bold red]")
+            logging.info(error)
+            return None
+
+        logging.info(
+            "[bold]Order {} to {} pair {} at price {} has been created.[/bold]".format(
+                res.get("txid"), new_position_side, pair, price
+            )
+        )
+        return res
 
-            if res and "txid" in res:
-                logging.info(
-                    "[bold]Order {} to {} pair {} at price {} has been created.[/bold]".format(
-                        res["txid"], new_position_side, pair, price
-                    )
-                )
-            else:
-                logging.info("[bold red] Error during order creation.[/bold red]")
-                logging.info(res)
-            return res
-
-    def add_order(self, ordertype, side, pair, price, volume, leverage, reduce_only):
+    async def add_order(
+        self, ordertype, side, pair, price, volume, leverage, reduce_only
+    ):
         logging.info("Adding order...")
-        return self.__trade.create_order(
+        return await self.order_entry.add_order(
             ordertype=ordertype,
             side=side,
             pair=pair,
@@ -130,14 +155,26 @@ class TradingBot(KrakenSpotWSClientV1):
             price=price,
             leverage=leverage,
             reduce_only=reduce_only,
-            # validate=True,
         )
 
     async def on_message(self: TradingBot, message: Union[dict, list]) -> None:
         """Receives all messages of the websocket connection(s)"""
+        if self.recorder is not None:
+            self.recorder.record("kraken", message)
         if isinstance(message, dict) and "event" in message:
+            KRAKEN_MESSAGES.inc(message["event"])
             if message["event"] in {"heartbeat", "pong"}:
                 return
+            if self.order_entry.on_message(message):
+                return
+            if message["event"] == "systemStatus":
+                self._connects += 1
+                connections = sum(
+                    connection is not None
+                    for connection in (self._pub_conn, self._priv_conn)
+                )
+                if self._connects > connections:
+                    KRAKEN_RECONNECTS.inc("v1")
             if "error" in message:
                 # handle exceptions/errors sent by websocket connection …
                 self.__status = BotStatus.ERROR
@@ -145,7 +182,10 @@ class TradingBot(KrakenSpotWSClientV1):
             if "status" in message and message["status"] == "online":
                 self.__status = BotStatus.ONLINE
 
-        logging.info(message)
+        if self.router.on_message(message):
+            return
+
+        logging.debug(message)
 
     def save_exit(self: TradingBot, reason: Optional[str] = "") -> None:
         """controlled shutdown of the strategy"""
@@ -197,12 +237,17 @@ class Manager:
             self.bot.save_exit(reason=reason)
 
 
-async def get_kraken_manager(pairs, config) -> Manager:
+async def get_kraken_manager(pairs, config, recorder=None, quote=None) -> Manager:
     manager: Manager = Manager(
         config={
             "key": config("SPOT_API_KEY", cast=str),
             "secret": config("SPOT_SECRET_KEY", cast=str),
             "pairs": pairs,
+            "max_rate": config("MAX_PUBLISH_RATE", cast=float, default=10),
+            "recorder": recorder,
+            "order_timeout": config("ORDER_TIMEOUT", cast=float, default=5),
+            # best bid and ask of a pair from the local top of book
+            "quote": quote,
         },
     )
 
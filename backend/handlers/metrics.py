@@ -0,0 +1,195 @@
+"""
+Lightweight metrics exposed in the Prometheus text format on ``/metrics``.
+
+Counters and histograms are updated inline on the hot paths, so they are
+kept to a dict lookup and a few additions: label values are positional and
+histograms have fixed buckets. Gauges are computed by a callback when the
+metrics are scraped instead of being maintained on every change.
+"""
+
+from __future__ import annotations
+
+import bisect
+from typing import Callable, Iterable, Optional
+
+# seconds, from microseconds (a single book transform) to seconds (lag)
+DURATION_BUCKETS = (
+    0.00001,
+    0.000025,
+    0.00005,
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+)
+LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def escape(value: str) -> str:
+    return str(value).replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
+
+
+def format_labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    labels = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+class Metric:
+    type: str = "untyped"
+
+    def __init__(
+        self: Metric, name: str, help: str, labels: tuple[str, ...] = ()
+    ) -> None:
+        self.name: str = name
+        self.help: str = help
+        self.labels: tuple[str, ...] = labels
+
+    def samples(self: Metric) -> Iterable[str]:
+        return ()
+
+    def render(self: Metric) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(
+        self: Counter, name: str, help: str, labels: tuple[str, ...] = ()
+    ) -> None:
+        super().__init__(name, help, labels)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self: Counter, *labels: str, amount: float = 1) -> None:
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self: Counter, *labels: str) -> float:
+        return self._values.get(labels, 0)
+
+    def samples(self: Counter) -> Iterable[str]:
+        for labels, value in self._values.items():
+            yield f"{self.name}{format_labels(self.labels, labels)} {value}"
+
+
+class Gauge(Metric):
+    """A gauge read from ``callback`` (label values -> value) when scraped"""
+
+    type = "gauge"
+
+    def __init__(
+        self: Gauge,
+        name: str,
+        help: str,
+        labels: tuple[str, ...] = (),
+        callback: Optional[Callable[[], dict[tuple, float]]] = None,
+    ) -> None:
+        super().__init__(name, help, labels)
+        self.callback: Optional[Callable[[], dict[tuple, float]]] = callback
+
+    def samples(self: Gauge) -> Iterable[str]:
+        if self.callback is None:
+            return
+        for labels, value in self.callback().items():
+            yield f"{self.name}{format_labels(self.labels, labels)} {value}"
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self: Histogram,
+        name: str,
+        help: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DURATION_BUCKETS,
+    ) -> None:
+        super().__init__(name, help, labels)
+        self.buckets: tuple[float, ...] = buckets
+        # label values -> [count per bucket (the last one is +Inf), sum]
+        self._series: dict[tuple, list] = {}
+
+    def observe(self: Histogram, value: float, *labels: str) -> None:
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def samples(self: Histogram) -> Iterable[str]:
+        for labels, (counts, total) in self._series.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                le = format_labels(self.labels, labels, f'le="{bound}"')
+                yield f"{self.name}_bucket{le} {cumulative}"
+            names = format_labels(self.labels, labels)
+            yield f"{self.name}_sum{names} {total}"
+            yield f"{self.name}_count{names} {cumulative}"
+
+
+class Registry:
+    def __init__(self: Registry) -> None:
+        self.metrics: dict[str, Metric] = {}
+
+    def register(self: Registry, metric: Metric) -> Metric:
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self: Registry) -> str:
+        return "\n".join(metric.render() for metric in self.metrics.values()) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def counter(name: str, help: str, labels: tuple[str, ...] = ()) -> Counter:
+    return REGISTRY.register(Counter(name, help, labels))
+
+
+def gauge(
+    name: str,
+    help: str,
+    labels: tuple[str, ...] = (),
+    callback: Optional[Callable[[], dict[tuple, float]]] = None,
+) -> Gauge:
+    return REGISTRY.register(Gauge(name, help, labels, callback))
+
+
+def histogram(
+    name: str,
+    help: str,
+    labels: tuple[str, ...] = (),
+    buckets: tuple[float, ...] = DURATION_BUCKETS,
+) -> Histogram:
+    return REGISTRY.register(Histogram(name, help, labels, buckets))
+
+
+# upstream Kraken messages, shared by the order book and the channel router
+KRAKEN_MESSAGES = counter(
+    "kraken_messages_total", "Messages received from Kraken", ("channel",)
+)
+KRAKEN_LAG = histogram(
+    "kraken_message_lag_seconds",
+    "Time from the exchange timestamp of a message to its handler",
+    ("channel",),
+    LAG_BUCKETS,
+)
+KRAKEN_RECONNECTS = counter(
+    "kraken_reconnects_total", "Reconnects of the Kraken websocket clients", ("api",)
+)
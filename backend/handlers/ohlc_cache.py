@@ -0,0 +1,123 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable
+
+
+def candle_close(interval: int, now: float) -> float:
+    """Unix time the current candle of ``interval`` minutes closes at"""
+    seconds = interval * 60
+    return (now // seconds + 1) * seconds
+
+
+# entries kept by default, a few formats of every pair and interval served
+MAX_ENTRIES = 256
+
+
+class OhlcCache:
+    """
+    Cache of encoded OHLC responses keyed by ``(pair, interval, format)``.
+
+    An entry expires when the current candle of its interval closes, live
+    updates of the open candle come from the ohlc websocket channel.
+    Concurrent misses of the same key share a single call of ``fetch``,
+    which returns the encoded payload. Failed fetches are not cached.
+
+    Expired entries are dropped whenever an entry is added, beyond
+    ``max_entries`` the least recently used entries are evicted.
+    """
+
+    def __init__(
+        self: OhlcCache,
+        fetch: Callable[[str, int, str], Awaitable[bytes]],
+        clock: Callable[[], float] = time.time,
+        max_entries: int = MAX_ENTRIES,
+    ) -> None:
+        self.fetch: Callable[[str, int, str], Awaitable[bytes]] = fetch
+        self.clock: Callable[[], float] = clock
+        self.max_entries: int = max_entries
+        # (pair, interval, format) -> (payload, fetched at, expires at), least
+        # recently used first
+        self._entries: OrderedDict[tuple[str, int, str], tuple[bytes, float, float]] = (
+            OrderedDict()
+        )
+        self._inflight: dict[tuple[str, int, str], asyncio.Future] = {}
+        self.hits: int = 0
+        self.misses: int = 0
+        self.coalesced: int = 0
+        self.evicted: int = 0
+
+    async def get(
+        self: OhlcCache, pair: str, interval: int, format: str = "tradingview"
+    ) -> tuple[bytes, float]:
+        """Returns the encoded payload and its age in seconds"""
+        key = (pair, interval, format)
+        now = self.clock()
+        entry = self._entries.get(key)
+        if entry is not None and now < entry[2]:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[0], now - entry[1]
+
+        task = self._inflight.get(key)
+        if task is None:
+            self.misses += 1
+            # the fetch runs in its own task, a client going away while
+            # waiting does not cancel it for the others
+            task = asyncio.ensure_future(self._fetch(key))
+            self._inflight[key] = task
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task), 0.0
+
+    async def _fetch(self: OhlcCache, key: tuple[str, int, str]) -> bytes:
+        pair, interval, _ = key
+        try:
+            payload = await self.fetch(*key)
+            fetched = self.clock()
+            self._store(key, (payload, fetched, candle_close(interval, fetched)))
+            return payload
+        finally:
+            del self._inflight[key]
+
+    def _store(
+        self: OhlcCache,
+        key: tuple[str, int, str],
+        entry: tuple[bytes, float, float],
+    ) -> None:
+        fetched = entry[1]
+        expired = [
+            k for k, (_, _, expires) in self._entries.items() if expires <= fetched
+        ]
+        for k in expired:
+            del self._entries[k]
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evicted += 1
+
+    def stats(self: OhlcCache) -> dict[str, Any]:
+        now = self.clock()
+        entries = []
+        for key, (payload, fetched, expires) in self._entries.items():
+            pair, interval, format = key
+            entries.append(
+                {
+                    "pair": pair,
+                    "interval": interval,
+                    "format": format,
+                    "age": now - fetched,
+                    "expires_in": max(0.0, expires - now),
+                    "size": len(payload),
+                }
+            )
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evicted": self.evicted,
+            "entries": entries,
+        }
@@ -0,0 +1,146 @@
+"""
+Order entry over the authenticated private websocket connection.
+
+``addOrder``, ``cancelOrder`` and ``cancelAll`` are sent on the private
+connection the bot already keeps for ``openOrders`` and ``ownTrades``, with
+the token the client fetched for that connection, so an order costs no
+REST round trip and no signing. Every request carries its own ``reqid``,
+the status message Kraken answers with the same ``reqid`` resolves it. The
+round trip of every request is observed in ``order_round_trip_seconds``.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import itertools
+import logging
+import time
+from typing import Any, Callable, Optional
+
+from handlers.metrics import LAG_BUCKETS, histogram
+
+ORDER_TIMEOUT = 5.0
+# status events of the order requests
+STATUS_EVENTS = {"addOrderStatus", "cancelOrderStatus", "cancelAllStatus"}
+
+ROUND_TRIP = histogram(
+    "order_round_trip_seconds",
+    "Time from sending an order request to its status message",
+    ("event",),
+    LAG_BUCKETS,
+)
+
+
+class OrderError(Exception):
+    """An order request Kraken answered with an error"""
+
+
+class OrderEntry:
+    """
+    Sends the order requests of ``client``, a connected
+    ``KrakenSpotWSClientV1``, and matches the status messages to them.
+
+    ``quote(pair)`` returns the best bid and ask of a pair from the locally
+    kept top of book, or ``None`` if the pair is not kept or its latest
+    quote is too old to trade on.
+    """
+
+    def __init__(
+        self: OrderEntry,
+        client: Any,
+        timeout: float = ORDER_TIMEOUT,
+        quote: Optional[Callable[[str], Optional[tuple[float, float]]]] = None,
+    ) -> None:
+        self.client: Any = client
+        self.timeout: float = timeout
+        self.quote: Optional[Callable[[str], Optional[tuple[float, float]]]] = quote
+        # reqid -> (status future, request event, send time)
+        self.pending: dict[int, tuple[asyncio.Future, str, float]] = {}
+        self._reqids = itertools.count(1)
+
+    async def request(self: OrderEntry, payload: dict) -> dict:
+        """
+        Sends an order request and returns its status message, with the round
+        trip in seconds as ``latency``. Raises :class:`OrderError` for error
+        statuses and ``asyncio.TimeoutError`` without a status in time.
+        """
+        reqid = next(self._reqids)
+        future = asyncio.get_running_loop().create_future()
+        event = payload["event"]
+        self.pending[reqid] = (future, event, time.perf_counter())
+        try:
+            # the client adds the token of the private connection
+            await asyncio.wait_for(
+                self._send({**payload, "reqid": reqid}, future), self.timeout
+            )
+            return future.result()
+        finally:
+            self.pending.pop(reqid, None)
+
+    async def _send(self: OrderEntry, payload: dict, future: asyncio.Future) -> None:
+        await self.client.send_message(payload, private=True)
+        await future
+
+    def on_message(self: OrderEntry, message: dict) -> bool:
+        """Resolves the request of a status message, ``False`` for other messages"""
+        status = message.get("event") in STATUS_EVENTS
+        if not status and message.get("event") != "error":
+            return False
+        entry = self.pending.pop(message.get("reqid"), None)
+        if entry is None:
+            # timed out already, or a request of someone else
+            return status
+        future, event, sent = entry
+        latency = time.perf_counter() - sent
+        ROUND_TRIP.observe(latency, event)
+        if future.done():
+            return True
+        if message.get("status") == "error" or message.get("event") == "error":
+            logging.error("%s failed after %.1f ms: %s", event, latency * 1000, message)
+            future.set_exception(OrderError(message.get("errorMessage", message)))
+        else:
+            logging.info(
+                "%s %s in %.1f ms", event, message.get("txid", ""), latency * 1000
+            )
+            future.set_result({**message, "latency": latency})
+        return True
+
+    async def add_order(
+        self: OrderEntry,
+        ordertype: str,
+        side: str,
+        pair: str,
+        volume: float,
+        price: Optional[float] = None,
+        leverage: Optional[int] = None,
+        reduce_only: bool = False,
+        validate: bool = False,
+    ) -> dict:
+        payload: dict = {
+            "event": "addOrder",
+            "ordertype": ordertype,
+            "type": side,
+            "pair": pair,
+            "volume": str(volume),
+        }
+        if price is not None:
+            payload["price"] = str(price)
+        if leverage:
+            payload["leverage"] = str(leverage)
+        if reduce_only:
+            payload["reduce_only"] = True
+        if validate:
+            payload["validate"] = "true"
+        return await self.request(payload)
+
+    async def cancel_order(self: OrderEntry, txids: list[str]) -> dict:
+        return await self.request({"event": "cancelOrder", "txid": txids})
+
+    async def cancel_all(self: OrderEntry) -> dict:
+        return await self.request({"event": "cancelAll"})
+
+    def best(self: OrderEntry, pair: str) -> Optional[tuple[float, float]]:
+        """Best bid and ask of ``pair`` from the local top of book"""
+        if self.quote is None:
+            return None
+        return self.quote(pair)
@@ -0,0 +1,424 @@
+"""
+Open orders and positions of the account, kept in memory.
+
+The state is seeded from the Kraken REST ``OpenOrders`` and
+``OpenPositions`` calls and kept current from the private websocket
+channels:
+
+- ``openOrders``: the first message of a subscription is a snapshot of the
+  open orders, the following ones change single fields of an order
+  (status, executed volume, ...). Orders leave the state when they are
+  closed, canceled or expired. After a reconnect the client subscribes
+  again: the new snapshot replaces the orders, and as trades may have been
+  missed meanwhile the state is reconciled.
+- ``ownTrades``: trades of a margin position open a position, add to it or
+  close (part of) it. Trades that cannot be attributed to a position, like
+  ``reduce_only`` fills without a position id, ask for an early
+  reconciliation instead. The first message of a subscription is a
+  snapshot of the latest trades, which may be older than the positions
+  (or not yet in them, before the first REST answer): it is not applied,
+  after a reconnect it asks for a reconciliation.
+
+A background task reconciles the state with REST every
+``reconcile_interval`` seconds. Entries changed by a websocket message while
+a REST call is running keep their websocket state, the REST answer may
+already be stale for them.
+
+Every change gets a sequence number. Websocket clients get a snapshot, then
+only the orders and positions that changed since their previous frame
+(``None`` for removed ones), see :class:`OrderStateStream`.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Optional
+
+from starlette.websockets import WebSocketDisconnect
+
+from handlers.broadcast import Frame, Subscriber
+from handlers.metrics import counter
+
+RECONCILE_INTERVAL = 60.0
+# seconds a trade that could not be attributed waits for a reconciliation,
+# so a burst of fills costs a single REST round trip
+RECONCILE_DELAY = 1.0
+# order statuses that take an order out of the open orders
+DONE = {"closed", "canceled", "expired"}
+# closed orders and trade ids remembered for the trades arriving late
+MEMORY = 1000
+
+CORRECTIONS = counter(
+    "order_state_corrections_total",
+    "Orders and positions a reconciliation had to correct",
+    ("kind",),
+)
+
+
+def merge(target: dict, update: dict) -> None:
+    """Applies the fields of an order update, nested dicts field by field"""
+    for key, value in update.items():
+        current = target.get(key)
+        if isinstance(value, dict) and isinstance(current, dict):
+            target[key] = {**current, **value}
+        else:
+            target[key] = value
+
+
+def leverage(order: dict) -> Optional[str]:
+    """Leverage of an order (``"5"``), ``None`` for spot orders"""
+    value = order.get("descr", {}).get("leverage", "none")
+    if not value or value == "none":
+        return None
+    return value.split(":")[0]
+
+
+class OrderStateStream:
+    """Per client encoder of the state, remembers the sequence last sent"""
+
+    def __init__(self: OrderStateStream, state: OrderState) -> None:
+        self.state: OrderState = state
+        self.seq: Optional[int] = None
+
+    def render(self: OrderStateStream) -> Optional[Frame]:
+        state = self.state
+        if state.seq == self.seq or not state.ready:
+            return None
+        payload = state.to_payload(self.seq)
+        self.seq = state.seq
+        return Frame(payload)
+
+
+class OrderState:
+    """The open orders and positions, see the module documentation"""
+
+    def __init__(
+        self: OrderState,
+        fetch_orders: Callable[[], Awaitable[dict]],
+        fetch_positions: Callable[[], Awaitable[dict]],
+        reconcile_interval: float = RECONCILE_INTERVAL,
+        max_rate: Optional[float] = None,
+    ) -> None:
+        self.fetch_orders: Callable[[], Awaitable[dict]] = fetch_orders
+        self.fetch_positions: Callable[[], Awaitable[dict]] = fetch_positions
+        self.reconcile_interval: float = reconcile_interval
+        self.max_rate: Optional[float] = max_rate
+        self.router: Any = None
+        self.orders: dict[str, dict] = {}
+        self.positions: dict[str, dict] = {}
+        # change number of the latest change, and of the latest change of
+        # every order and position, removed ones included
+        self.seq: int = 0
+        self.changed: dict[tuple[str, str], int] = {}
+        # the state holds a REST answer or an openOrders snapshot
+        self.ready: bool = False
+        self.clients: dict[Subscriber, OrderStateStream] = {}
+
+        # change number of the latest openOrders snapshot
+        self._snapshot: int = 0
+        # whether the ownTrades snapshot of the subscription was received
+        self._trades_snapshot: bool = False
+        # (exchange) time the positions were fetched at, older trades are in
+        # them already
+        self._positions_time: float = 0.0
+        self._closed: OrderedDict[str, dict] = OrderedDict()
+        self._trades: OrderedDict[str, None] = OrderedDict()
+        self._reconciling: Optional[asyncio.Task] = None
+        self._scheduled: Optional[asyncio.TimerHandle] = None
+        self._task: Optional[asyncio.Task] = None
+        # GET /orders answer of change ``_encoded[0]``
+        self._encoded: tuple[int, str] = (-1, "")
+
+    async def start(self: OrderState, router: Any) -> None:
+        """Subscribes to the private channels and seeds the state from REST"""
+        self.router = router
+        router.on_subscribed("openOrders", self._on_subscribed)
+        router.on_subscribed("ownTrades", self._on_trades_subscribed)
+        await router.subscribe(self._on_orders, {"name": "openOrders"})
+        await router.subscribe(self._on_trades, {"name": "ownTrades"})
+        await self._try_reconcile()
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self: OrderState) -> None:
+        if self._task is not None:
+            self._task.cancel()
+        if self._scheduled is not None:
+            self._scheduled.cancel()
+        if self.router is not None:
+            await self.router.unsubscribe(self._on_orders, {"name": "openOrders"})
+            await self.router.unsubscribe(self._on_trades, {"name": "ownTrades"})
+
+    async def _run(self: OrderState) -> None:
+        while True:
+            await asyncio.sleep(self.reconcile_interval)
+            await self._try_reconcile()
+
+    def _change(self: OrderState, kind: str, key: str) -> None:
+        self.seq += 1
+        self.changed[(kind, key)] = self.seq
+
+    def _set_order(self: OrderState, txid: str, order: Optional[dict]) -> None:
+        if order is None:
+            removed = self.orders.pop(txid, None)
+            if removed is None:
+                return
+            self._remember(self._closed, txid, removed)
+        else:
+            self.orders[txid] = order
+        self._change("orders", txid)
+
+    def _set_position(self: OrderState, key: str, position: Optional[dict]) -> None:
+        if position is None:
+            if self.positions.pop(key, None) is None:
+                return
+        else:
+            self.positions[key] = position
+        self._change("positions", key)
+
+    def _remember(self: OrderState, memory: OrderedDict, key: str, value: Any) -> None:
+        memory[key] = value
+        if len(memory) > MEMORY:
+            memory.popitem(last=False)
+
+    def _publish(self: OrderState) -> None:
+        for subscriber, stream in self.clients.items():
+            subscriber.publish(stream.render, key="order_state")
+
+    def _on_subscribed(self: OrderState) -> None:
+        """The next ``openOrders`` message is a snapshot again"""
+        if not self._snapshot:
+            # the first subscription, its snapshot is still to come
+            return
+        logging.info("openOrders resubscribed, waiting for a new snapshot")
+        self._snapshot = 0
+        self.ready = False
+        self.request_reconcile()
+
+    def _on_trades_subscribed(self: OrderState) -> None:
+        """The next ``ownTrades`` message is a snapshot again"""
+        self._trades_snapshot = False
+
+    def _on_orders(self: OrderState, pair: Optional[str], payload: list) -> None:
+        """Applies an ``openOrders`` message, a list of ``{txid: order}``"""
+        orders = {txid: order for entry in payload for txid, order in entry.items()}
+        # the first message of the subscription lists all open orders
+        snapshot = not self._snapshot
+        if snapshot:
+            for txid in list(self.orders):
+                if txid not in orders:
+                    self._set_order(txid, None)
+        for txid, update in orders.items():
+            if update.get("status") in DONE:
+                self._set_order(txid, None)
+                continue
+            if snapshot and self.orders.get(txid) == update:
+                continue
+            order = None if snapshot else self.orders.get(txid)
+            if order is None:
+                if "descr" not in update:
+                    # an update of an order the state never saw
+                    self.request_reconcile()
+                    continue
+                order = {}
+            merge(order, update)
+            self._set_order(txid, order)
+        if snapshot:
+            self._snapshot = self.seq = self.seq + 1
+            self.ready = True
+        self._publish()
+
+    def _on_trades(self: OrderState, pair: Optional[str], payload: list) -> None:
+        """Applies an ``ownTrades`` message, a list of ``{trade id: trade}``"""
+        if not self._trades_snapshot:
+            self._trades_snapshot = True
+            for entry in payload:
+                for trade_id in entry:
+                    self._remember(self._trades, trade_id, None)
+            if self._positions_time:
+                # trades may have been missed while the connection was down
+                self.request_reconcile()
+            return
+        for entry in payload:
+            for trade_id, trade in entry.items():
+                if trade_id in self._trades:
+                    continue
+                self._remember(self._trades, trade_id, None)
+                if float(trade.get("time", 0)) > self._positions_time:
+                    self._apply_trade(trade)
+        self._publish()
+
+    def _apply_trade(self: OrderState, trade: dict) -> None:
+        order = self.orders.get(trade.get("ordertxid")) or self._closed.get(
+            trade.get("ordertxid")
+        )
+        key = trade.get("postxid") or ""
+        position = self.positions.get(key) if key else None
+        volume = float(trade["vol"])
+        if position is not None:
+            if trade["type"] == position["type"]:
+                position = {
+                    **position,
+                    "vol": "{:.8f}".format(float(position["vol"]) + volume),
+                    "cost": "{:.5f}".format(
+                        float(position["cost"]) + float(trade["cost"])
+                    ),
+                    "fee": "{:.5f}".format(
+                        float(position["fee"]) + float(trade["fee"])
+                    ),
+                }
+            else:
+                closed = float(position["vol_closed"]) + volume
+                if closed >= float(position["vol"]) - 1e-12:
+                    position = None
+                else:
+                    position = {**position, "vol_closed": "{:.8f}".format(closed)}
+            self._set_position(key, position)
+        elif key and order is not None and leverage(order):
+            cost = float(trade["cost"])
+            self._set_position(
+                key,
+                {
+                    "ordertxid": trade["ordertxid"],
+                    "posstatus": "open",
+                    "pair": trade["pair"],
+                    "time": trade["time"],
+                    "type": trade["type"],
+                    "ordertype": trade["ordertype"],
+                    "cost": trade["cost"],
+                    "fee": trade["fee"],
+                    "vol": trade["vol"],
+                    "vol_closed": "0.00000000",
+                    "margin": "{:.5f}".format(cost / float(leverage(order))),
+                    "leverage": leverage(order),
+                    "misc": "",
+                    "oflags": "",
+                },
+            )
+        elif order is None or leverage(order):
+            # closes positions the trade does not name, or the order is unknown
+            self.request_reconcile()
+
+    def request_reconcile(self: OrderState) -> None:
+        """Reconciles with REST soon, once for all requests until then"""
+        if self._scheduled is not None or self._reconciling is not None:
+            return
+        loop = asyncio.get_running_loop()
+        self._scheduled = loop.call_later(RECONCILE_DELAY, self._scheduled_reconcile)
+
+    def _scheduled_reconcile(self: OrderState) -> None:
+        self._scheduled = None
+        asyncio.ensure_future(self._try_reconcile())
+
+    async def reconcile(self: OrderState) -> None:
+        """Replaces the state by the REST answers, a single call at a time"""
+        if self._reconciling is None:
+            self._reconciling = asyncio.ensure_future(self._reconcile())
+        await asyncio.shield(self._reconciling)
+
+    async def _try_reconcile(self: OrderState) -> None:
+        try:
+            await self.reconcile()
+        except Exception:
+            logging.exception("Reconciling the open orders and positions failed")
+
+    async def _reconcile(self: OrderState) -> None:
+        try:
+            start, fetched = self.seq, time.time()
+            orders, positions = await asyncio.gather(
+                self.fetch_orders(), self.fetch_positions()
+            )
+            if self._snapshot <= start:
+                # an openOrders snapshot since the call is newer than its answer
+                self._replace("orders", self.orders, orders, start, self._set_order)
+            self._replace(
+                "positions", self.positions, positions, start, self._set_position
+            )
+            self._positions_time = max(self._positions_time, fetched)
+            self.ready = True
+            self._prune()
+            self._publish()
+        finally:
+            self._reconciling = None
+
+    def _prune(self: OrderState) -> None:
+        """Forgets the removed entries every client and the state are past"""
+        sent = [s.seq for s in self.clients.values() if s.seq is not None]
+        last = min(sent, default=self.seq)
+        for (kind, key), seq in list(self.changed.items()):
+            if seq <= last and key not in getattr(self, kind):
+                del self.changed[(kind, key)]
+
+    def _replace(
+        self: OrderState,
+        kind: str,
+        current: dict[str, dict],
+        fetched: dict[str, dict],
+        start: int,
+        setter: Callable[[str, Optional[dict]], None],
+    ) -> None:
+        """Takes the fetched entries, except those changed after ``start``"""
+        for key in set(current) | set(fetched):
+            if self.changed.get((kind, key), 0) > start:
+                continue
+            value = fetched.get(key)
+            if value == current.get(key):
+                continue
+            if self.ready:
+                CORRECTIONS.inc(kind)
+            setter(key, value)
+
+    def to_payload(self: OrderState, since: Optional[int] = None) -> dict:
+        """
+        All orders and positions, or with ``since`` only those changed after
+        change ``since`` (``None`` for the removed ones).
+        """
+        if since is None:
+            return {
+                "type": "snapshot",
+                "seq": self.seq,
+                "orders": self.orders,
+                "positions": self.positions,
+            }
+        payload: dict[str, Any] = {
+            "type": "update",
+            "seq": self.seq,
+            "orders": {},
+            "positions": {},
+        }
+        for (kind, key), seq in self.changed.items():
+            if seq > since:
+                payload[kind][key] = getattr(self, kind).get(key)
+        return payload
+
+    async def get_orders(self: OrderState) -> str:
+        """The open orders as a JSON string, the ``GET /orders`` answer"""
+        if not self.ready:
+            await self.reconcile()
+        if self._encoded[0] != self.seq:
+            self._encoded = (self.seq, json.dumps(self.orders))
+        return self._encoded[1]
+
+    async def get_positions(self: OrderState) -> dict:
+        if not self.ready:
+            await self.reconcile()
+        return self.positions
+
+    async def serve(self: OrderState, ws: Any) -> None:
+        """Streams the orders and positions to a client, a snapshot first"""
+        await ws.accept()
+        subscriber = Subscriber(ws, max_rate=self.max_rate, stream="order_state")
+        subscriber.start()
+        try:
+            self.clients[subscriber] = stream = OrderStateStream(self)
+            subscriber.publish(stream.render, key="order_state")
+            while True:
+                await ws.receive_text()
+        except WebSocketDisconnect:
+            pass
+        finally:
+            self.clients.pop(subscriber, None)
+            subscriber.close()
@@ -1,180 +1,534 @@
-from kraken.spot import OrderbookClientV2
+from kraken.spot import Market, OrderbookClientV2
+from starlette.websockets import WebSocketDisconnect
+from datetime import datetime
 import asyncio
-import json
+import logging
 import time
 
-order_book_websocket = None
-prev_book = None
-imbalance_history = []
-large_volume_history = []
+from handlers.book import Book
+from handlers.book_checksum import BookChecksum
+from handlers.book_protocol import BookDeltaStream
+from handlers.book_snapshot import BookSnapshot
+from handlers.broadcast import Frame, Subscriber, decode, publish
+from handlers.heatmap import MAX_QUERY_ROWS, WIDTH as HEATMAP_WIDTH, Heatmap
+from handlers.metrics import (
+    KRAKEN_LAG,
+    KRAKEN_MESSAGES,
+    KRAKEN_RECONNECTS,
+    counter,
+    histogram,
+)
+from handlers.pairs import MAX_PAIR_LENGTH, RELEASE_DELAY, PairUsers
+from handlers.recorder import RecordingMarket
+from handlers.ring_buffer import RingBuffer
 
-BID_TYPE = 1
-ASK_TYPE = -1
-PULLING_STACKING_CLEANUP_INTERVAL = 50
+# imbalance and large volume points are kept for this many seconds
+HISTORY_RETENTION = 60 * 60
+HISTORY_CAPACITY = 100_000
+# seconds between unsubscribing and resubscribing the book of a pair
+RESYNC_DELAY = 1.0
 
+TRANSFORM_SECONDS = histogram(
+    "book_transform_seconds", "Time to apply a book update and build its payload"
+)
+RESYNCS = counter(
+    "book_resyncs_total", "Books resubscribed after a checksum mismatch", ("pair",)
+)
 
-def pulling_stacking(book):
-    global prev_book
 
+def parse_request(data):
+    """
+    Validates a client request of :meth:`OrderbookHub.serve`, returns the
+    request or an error message
+    """
     try:
-        for b in book:
-            price = b["price"]
-            if b["ask"] != 0:
-                prev_ask = (
-                    prev_book[price]["ask"] if prev_book and price in prev_book else 0
-                )
-                ask_ps = b["ask"] - prev_ask
-
-                if (
-                    prev_book
-                    and ask_ps == 0
-                    and price in prev_book
-                    and "ask_ps" in prev_book[price]
-                    and "ask_ps_history" in prev_book[price]
-                    and prev_book[price]["ask_ps_history"]
-                    < PULLING_STACKING_CLEANUP_INTERVAL
-                ):
-                    b["ask_ps"] = prev_book[price]["ask_ps"]
-                    b["ask_ps_history"] = prev_book[price]["ask_ps_history"] + 1
-
-                else:
-                    b["ask_ps"] = ask_ps
-
-            if b["bid"] != 0:
-                prev_bid = (
-                    prev_book[price]["bid"] if prev_book and price in prev_book else 0
-                )
-                bid_ps = b["bid"] - prev_bid
-                if (
-                    prev_book
-                    and bid_ps == 0
-                    and price in prev_book
-                    and "bid_ps" in prev_book[price]
-                    and "bid_ps_history" in prev_book[price]
-                    and prev_book[price]["bid_ps_history"]
-                    < PULLING_STACKING_CLEANUP_INTERVAL
-                ):
-                    b["bid_ps"] = prev_book[price]["bid_ps"]
-                    b["bid_ps_history"] = prev_book[price]["bid_ps_history"] + 1
-                else:
-                    b["bid_ps"] = bid_ps
-
-    except Exception as e:
-        print("An exception occurred: ", e)
-
-
-def calculate_imbalance(bid_volume, ask_volume):
-    best_bid_volume = bid_volume[0]
-    best_ask_volume = ask_volume[0]
-
-    imbalance = (best_bid_volume - best_ask_volume) / (
-        best_bid_volume + best_ask_volume
-    )
-    t = time.time()
-    imbalance_history.append({"time": t, "value": imbalance})
-    large_volume_history.append(
-        {
-            "time": t,
-            "value": best_bid_volume
+        message = decode(data)
+    except ValueError:
+        return None, "invalid JSON"
+    if not isinstance(message, dict):
+        return None, "expected an object"
+    event = message.get("event")
+    if event in ("subscribe", "unsubscribe"):
+        pairs = message.get("pairs")
+        if not isinstance(pairs, list) or not all(
+            isinstance(pair, str) and pair for pair in pairs
+        ):
+            return None, "pairs must be a list of pairs"
+        if any(len(pair.encode()) > MAX_PAIR_LENGTH for pair in pairs):
+            return None, "pairs must be at most {} bytes".format(MAX_PAIR_LENGTH)
+    elif event == "resync":
+        if not isinstance(message.get("pair"), str):
+            return None, "pair is required"
+    else:
+        return None, "unknown event"
+    return message, None
+
+
+class PairState:
+    """
+    Book ladder, histories and subscribed clients of a single pair, and its
+    liquidity heatmap unless ``heatmap`` is False
+    """
+
+    def __init__(
+        self,
+        pair,
+        depth,
+        retention=HISTORY_RETENTION,
+        heatmap_bucket=None,
+        heatmap_width=HEATMAP_WIDTH,
+        heatmap=True,
+    ):
+        self.pair = pair
+        self.depth = depth
+        self.snapshot = BookSnapshot(depth)
+        self.heatmap = Heatmap(heatmap_bucket, heatmap_width) if heatmap else None
+        self.verifier = BookChecksum()
+        # False from a checksum mismatch until the snapshot of the resubscription
+        self.valid = True
+        self.imbalance_history = RingBuffer(HISTORY_CAPACITY, retention)
+        self.large_volume_history = RingBuffer(HISTORY_CAPACITY, retention)
+        self.checksum = 0
+        self.imbalance = {"time": 0.0, "value": 0.0}
+        self.large_volume = {"time": 0.0, "value": 0.0}
+        # JSON clients and binary delta protocol clients
+        self.clients = set()
+        self.delta_clients = {}
+
+    def calculate_imbalance(self, best_bid_volume, best_ask_volume):
+        """Records the top of book imbalance and returns the new history points"""
+        total_volume = best_bid_volume + best_ask_volume
+        imbalance = (
+            (best_bid_volume - best_ask_volume) / total_volume if total_volume else 0
+        )
+        large_volume = (
+            best_bid_volume
             if imbalance > 0.5
-            else (best_ask_volume if imbalance < -0.5 else 0),
-        }
-    )
-
-
-def transform_book(book, depth, pair, checksum):
-    bids = [(float(i[0]), float(i[1][0])) for i in list(book["bid"].items())]
-    asks = [(float(j[0]), float(j[1][0])) for j in list(book["ask"].items())]
-    bid_volume = [round(j) for _, j in bids]
-    ask_volume = [round(j) for _, j in asks]
-    bid_price = [i for i, _ in bids]
-    ask_price = [i for i, _ in asks]
-    calculate_imbalance(bid_volume, ask_volume)
-    peg_price = (bid_price[0] + ask_price[0]) / 2
-    best_bid = bid_price[0]
-    best_ask = ask_price[0]
-
-    ask_volume.reverse()
-    ask_price.reverse()
-
-    bid_volume_total = round(sum(j for _, j in bids))
-    ask_volume_total = round(sum(j for _, j in asks))
-
-    order_book_depth = depth
-    bids = [0] * order_book_depth + bid_volume
-    price = ask_price + bid_price
-    asks = ask_volume + [0] * order_book_depth
-    res = []
-
-    for bid, price, ask in zip(bids, price, asks):
-        res.append(
-            {
-                "bid": bid,
-                "price": price,
-                "ask": ask,
-                "ask_ps": 0,
-                "bid_ps": 0,
-                "ask_ps_history": 0,
-                "bid_ps_history": 0,
-            }
+            else (best_ask_volume if imbalance < -0.5 else 0)
+        )
+        t = time.time()
+        self.imbalance_history.push(t, imbalance)
+        self.large_volume_history.push(t, large_volume)
+        self.imbalance = {"time": t, "value": imbalance}
+        self.large_volume = {"time": t, "value": large_volume}
+        return self.imbalance, self.large_volume
+
+    def update(self, book, message):
+        """Applies a book update to the ladder and the histories"""
+        self.snapshot.update(book, message)
+        self.checksum = message["data"][0]["checksum"]
+        self.calculate_imbalance(
+            self.snapshot.best_bid_volume, self.snapshot.best_ask_volume
         )
+        if self.heatmap is not None:
+            self.heatmap.update(book, self.imbalance["time"])
 
-    asks_total_percentage = round(
-        (ask_volume_total / (ask_volume_total + bid_volume_total)) * 100
-    )
-
-    bids_total_percentage = round(
-        (bid_volume_total / (ask_volume_total + bid_volume_total)) * 100
-    )
-
-    pulling_stacking(res)
-
-    res_dict = {}
-    for entry in res:
-        res_dict[entry["price"]] = entry
-
-    global prev_book
-    prev_book = res_dict
-
-    return {
-        "data": res,
-        "depth": depth,
-        "ask_volume_total": ask_volume_total,
-        "bid_volume_total": bid_volume_total,
-        "ask_volume_total_percentage": asks_total_percentage,
-        "bids_volume_total_percentage": bids_total_percentage,
-        "pair": pair,
-        "peg_price": peg_price,
-        "price_decimals": book["price_decimals"],
-        "qty_decimals": book["qty_decimals"],
-        "valid": book["valid"],
-        "checksum": checksum,
-        "best_bid": best_bid,
-        "best_ask": best_ask,
-        "imbalance_history": imbalance_history,
-        "large_volume_history": large_volume_history,
-    }
+    def transform_book(self, book, message):
+        self.update(book, message)
+        return self.to_payload(book)
+
+    def to_payload(self, book):
+        """The JSON book payload of the current ladder"""
+        snapshot = self.snapshot
+        asks_total_percentage, bids_total_percentage = snapshot.total_percentages()
+
+        return {
+            "data": snapshot.to_rows(),
+            "depth": self.depth,
+            "ask_volume_total": snapshot.ask_volume_total,
+            "bid_volume_total": snapshot.bid_volume_total,
+            "ask_volume_total_percentage": asks_total_percentage,
+            "bids_volume_total_percentage": bids_total_percentage,
+            "pair": self.pair,
+            "peg_price": snapshot.peg_price,
+            "price_decimals": book.price_decimals,
+            "qty_decimals": book.qty_decimals,
+            "valid": self.valid,
+            "checksum": self.checksum,
+            "best_bid": snapshot.best_bid,
+            "best_ask": snapshot.best_ask,
+            # only the points added by this update, see get_history for backfill
+            "imbalance_history": [self.imbalance],
+            "large_volume_history": [self.large_volume],
+        }
+
+    def get_history(self):
+        """Returns the retained imbalance and large volume history"""
+        return {
+            "pair": self.pair,
+            "imbalance_history": self.imbalance_history.to_points(),
+            "large_volume_history": self.large_volume_history.to_points(),
+        }
+
+
+class OfflineClient:
+    """Stands in for the websocket client of an order book fed from a replay"""
+
+    exception_occur = False
+
+    async def subscribe(self, params) -> None:
+        pass
+
+    async def unsubscribe(self, params) -> None:
+        pass
 
 
 class Orderbook(OrderbookClientV2):
-    async def on_book_update(self, pair, message) -> None:
-        book = self.get(pair=pair)
-        book_ts = transform_book(
-            book, depth=self.depth, pair=pair, checksum=message["data"][0]["checksum"]
+    """
+    The Kraken v2 book subscriptions of the hub. Only the subscriptions of
+    the SDK client are used, book messages are applied to a :class:`Book`
+    per pair instead of the SDK book, which sorts a whole side for every
+    level of a message.
+    """
+
+    def __init__(self, hub, depth, market=None):
+        super().__init__(depth=depth)
+        self.hub = hub
+        self.books = {}
+        self.live = True
+        # status messages received, one per (re)connect
+        self.connects = 0
+        if market is not None:
+            # the SDK looks up the decimals of a pair with this REST client
+            self._OrderbookClientV2__market = market
+
+    def disconnect(self) -> None:
+        """Drops the Kraken connection, messages are fed to on_message directly"""
+        for connection in (self.ws_client._pub_conn, self.ws_client._priv_conn):
+            if connection is not None:
+                connection.task.cancel()
+        self.ws_client = OfflineClient()
+        self.live = False
+
+    async def on_message(self, message) -> None:
+        received = time.time()
+        # subscribe acknowledgements have a method instead of a channel
+        channel = message.get("channel") or message.get("method", "event")
+        KRAKEN_MESSAGES.inc(channel)
+        if channel == "status":
+            self.connects += 1
+            if self.connects > 1:
+                KRAKEN_RECONNECTS.inc("v2")
+        elif channel == "book" and self.live and message.get("type") == "update":
+            # snapshots carry no timestamp
+            timestamp = message["data"][0].get("timestamp")
+            if timestamp:
+                KRAKEN_LAG.observe(
+                    received - datetime.fromisoformat(timestamp).timestamp(), "book"
+                )
+        await self.on_book_message(message)
+        if self.hub.recorder is not None:
+            # recorded after the asset pair lookup of a new book, which a
+            # replay needs first
+            self.hub.recorder.record("book", message, received)
+
+    async def on_book_message(self, message) -> None:
+        if (
+            message.get("method") in {"subscribe", "unsubscribe"}
+            and message.get("success")
+            and message.get("result", {}).get("channel") == "book"
+        ):
+            # a new subscription starts with a snapshot
+            self.books.pop(message["result"]["symbol"], None)
+            return
+        if message.get("channel") != "book" or message.get("type") not in {
+            "snapshot",
+            "update",
+        }:
+            return
+
+        pair = message["data"][0]["symbol"]
+        book = self.books.get(pair)
+        if book is None:
+            # the decimals of the pair, prices and quantities are integers
+            # of these
+            info = self._OrderbookClientV2__market.get_asset_pairs(pair=pair)[pair]
+            book = self.books[pair] = Book(
+                pair,
+                int(info["pair_decimals"]),
+                int(info["lot_decimals"]),
+                self.depth,
+            )
+        book.apply(message)
+        await self.hub.on_book_update(pair, book, message)
+
+    def get(self, pair):
+        return self.books.get(pair)
+
+    async def resubscribe(self, pair) -> None:
+        """Replaces the book of ``pair`` with a new snapshot, other pairs are untouched"""
+        await self.remove_book(pairs=[pair])
+        await asyncio.sleep(RESYNC_DELAY)
+        await self.add_book(pairs=[pair])
+
+
+class OrderbookHub:
+    """
+    Shares one upstream book subscription between all websocket clients.
+
+    Every pair has its own :class:`PairState`. Each book update is transformed
+    once and the result is queued for all clients subscribed to that pair.
+    Clients only get the latest book of a pair, at most ``max_rate`` times
+    per second.
+
+    The checksum of every update is verified before anything is published.
+    On a mismatch the clients of the pair get
+    ``{"event": "resync", "pair": ..., "reason": "checksum"}`` instead of the
+    book, only that pair is resubscribed and its updates are ignored until
+    the new snapshot arrives.
+
+    Pairs other than the ones the hub was started with are subscribed for
+    their first client and unsubscribed a while after the last one left,
+    see :class:`PairUsers`. Clients can only subscribe to the pairs
+    ``known(pair)`` accepts. Hubs made with ``heatmap=False`` keep no
+    liquidity heatmaps.
+    """
+
+    # the books, heatmaps and listeners are in this process
+    keeps_books = True
+
+    def __init__(
+        self,
+        depth=100,
+        retention=HISTORY_RETENTION,
+        max_rate=None,
+        recorder=None,
+        heatmap_bucket=None,
+        heatmap_width=HEATMAP_WIDTH,
+        known=None,
+        release_delay=RELEASE_DELAY,
+        heatmap=True,
+    ):
+        self.depth = depth
+        self.retention = retention
+        # price per heatmap bucket, None picks one per pair
+        self.heatmap_bucket = heatmap_bucket
+        self.heatmap_width = heatmap_width
+        self.keeps_heatmaps = heatmap
+        self.max_rate = max_rate
+        self.recorder = recorder
+        self.pairs = {}
+        self.orderbook = None
+        # callables listener(pair, state, book, message) called after every
+        # published update, they must not block
+        self.listeners = []
+        self._resyncs = {}
+        self.known = known
+        # clients and other users of every pair
+        self.users = PairUsers(self.remove_pair, release_delay)
+
+    async def start(self, pairs) -> None:
+        market = None
+        if self.recorder is not None:
+            market = RecordingMarket(Market(), self.recorder)
+        self.orderbook = Orderbook(hub=self, depth=self.depth, market=market)
+        self.users.pin(pairs)
+        await self.add_pairs(pairs)
+
+    async def start_offline(self, pairs, market) -> None:
+        """
+        Starts without a Kraken connection, book messages of a replay are
+        passed to ``self.orderbook.on_message``.
+        """
+        self.orderbook = Orderbook(hub=self, depth=self.depth, market=market)
+        self.orderbook.disconnect()
+        self.users.pin(pairs)
+        await self.add_pairs(pairs)
+
+    async def add_pairs(self, pairs) -> None:
+        for pair in pairs:
+            # an unsubscription still running is sent first
+            await self.users.settled(pair)
+        new_pairs = [pair for pair in pairs if pair not in self.pairs]
+        if not new_pairs:
+            return
+        for pair in new_pairs:
+            self.pairs[pair] = PairState(
+                pair,
+                self.depth,
+                self.retention,
+                heatmap_bucket=self.heatmap_bucket,
+                heatmap_width=self.heatmap_width,
+                heatmap=self.keeps_heatmaps,
+            )
+        logging.info("Subscribing to the order book of %s", new_pairs)
+        await self.orderbook.add_book(pairs=new_pairs)
+
+    async def remove_pairs(self, pairs) -> None:
+        """Drops the books of ``pairs`` along with their clients"""
+        pairs = [pair for pair in pairs if self.pairs.pop(pair, None) is not None]
+        if not pairs:
+            return
+        for pair in pairs:
+            task = self._resyncs.pop(pair, None)
+            if task is not None:
+                task.cancel()
+        logging.info("Unsubscribing from the order book of %s", pairs)
+        await self.orderbook.remove_book(pairs=pairs)
+
+    async def remove_pair(self, pair) -> None:
+        """Drops the book of a pair that has had no users for a while"""
+        await self.remove_pairs([pair])
+
+    def subscribed(self, subscriber, pair):
+        state = self.pairs.get(pair)
+        return state is not None and (
+            subscriber in state.clients or subscriber in state.delta_clients
+        )
+
+    async def subscribe(self, subscriber, pairs, delta=False) -> None:
+        pairs = list(dict.fromkeys(pairs))
+        new_pairs = [pair for pair in pairs if not self.subscribed(subscriber, pair)]
+        for pair in new_pairs:
+            self.users.acquire(pair)
+        try:
+            await self.add_pairs(pairs)
+        except BaseException:
+            for pair in new_pairs:
+                self.users.release(pair)
+            raise
+        for pair in pairs:
+            state = self.pairs[pair]
+            if not delta:
+                state.clients.add(subscriber)
+            elif subscriber not in state.delta_clients:
+                # the first frame of a delta stream is a snapshot
+                stream = state.delta_clients[subscriber] = BookDeltaStream(state)
+                subscriber.publish(stream.render, key=("book", pair))
+
+    def unsubscribe(self, subscriber, pairs=None) -> None:
+        for pair in pairs if pairs is not None else list(self.pairs):
+            if self.subscribed(subscriber, pair):
+                self.pairs[pair].clients.discard(subscriber)
+                self.pairs[pair].delta_clients.pop(subscriber, None)
+                self.users.release(pair)
+
+    def resync(self, subscriber, pair) -> None:
+        """Sends a new snapshot to a delta protocol client"""
+        state = self.pairs.get(pair)
+        if state is None or subscriber not in state.delta_clients:
+            return
+        stream = state.delta_clients[subscriber]
+        stream.resync()
+        subscriber.publish(stream.render, key=("book", pair))
+
+    async def on_book_update(self, pair, book, message) -> None:
+        state = self.pairs.get(pair)
+        if state is None:
+            return
+        if not state.valid and message["type"] != "snapshot":
+            # updates of the invalid book until the resubscription
+            return
+        started = time.perf_counter()
+        if not state.verifier.verify(book, message):
+            self.invalidate(state)
+            return
+        state.valid = True
+        state.update(book, message)
+        payload = state.to_payload(book) if state.clients else None
+        TRANSFORM_SECONDS.observe(time.perf_counter() - started)
+        if payload is not None:
+            publish(state.clients, payload, key=("book", pair), stream="book")
+        for subscriber, stream in state.delta_clients.items():
+            subscriber.publish(stream.render, key=("book", pair))
+        for listener in self.listeners:
+            listener(pair, state, book, message)
+
+    def invalidate(self, state) -> None:
+        """Withholds the book of a pair after a checksum mismatch and resyncs it"""
+        pair = state.pair
+        logging.warning("Checksum mismatch of the %s book, resubscribing", pair)
+        RESYNCS.inc(pair)
+        state.valid = False
+        # drops the book frames still waiting in the outboxes, the notice has
+        # its own key so the snapshot of the resubscribed book cannot replace it
+        for subscriber in state.clients:
+            subscriber.discard(("book", pair))
+        notice = publish(
+            state.clients,
+            {"event": "resync", "pair": pair, "reason": "checksum"},
+            key=("resync", pair),
+            stream="book",
         )
-        if book_ts and order_book_websocket:
-            await order_book_websocket.send_json(json.dumps(book_ts))
+        for subscriber, stream in state.delta_clients.items():
+            stream.resync()
+            subscriber.discard(("book", pair))
+            subscriber.publish(notice, key=("resync", pair))
+        if pair not in self._resyncs:
+            task = asyncio.create_task(self.orderbook.resubscribe(pair))
+            task.add_done_callback(lambda _: self._resyncs.pop(pair, None))
+            self._resyncs[pair] = task
 
+    def get_history(self, pair):
+        if pair not in self.pairs:
+            return {"pair": pair, "imbalance_history": [], "large_volume_history": []}
+        return self.pairs[pair].get_history()
 
-async def start_book(pairs, ws, depth=100) -> None:
-    global order_book_websocket
-    order_book_websocket = ws
-    orderbook = Orderbook(depth=depth)
-    print("created orderbook")
+    def get_heatmap(
+        self, pair, resolution, start=None, end=None, max_rows=MAX_QUERY_ROWS
+    ):
+        """
+        A window of the liquidity heatmap of a pair, see :meth:`Heatmap.query`.
+        ``None`` if the pair has no heatmap or the resolution is not kept.
+        """
+        state = self.pairs.get(pair)
+        if state is None or state.heatmap is None:
+            return None
+        result = state.heatmap.query(resolution, start, end, max_rows)
+        if result is not None:
+            result["pair"] = pair
+        return result
+
+    async def serve(self, ws, pairs) -> None:
+        """
+        Serves a websocket client. The client is subscribed to ``pairs`` and
+        can change its subscription by sending
+        ``{"event": "subscribe" | "unsubscribe", "pairs": [...]}``.
+
+        Clients connecting with ``?protocol=delta`` get the binary delta
+        protocol of :mod:`handlers.book_protocol` instead of JSON books and
+        can request a new snapshot with ``{"event": "resync", "pair": ...}``.
+        Malformed requests and unknown pairs are answered with
+        ``{"event": "error", "error"}``.
+        """
+        await ws.accept()
+        delta = ws.query_params.get("protocol") == "delta"
+        subscriber = Subscriber(ws, max_rate=self.max_rate, stream="book")
+        subscriber.start()
+        await self.subscribe(subscriber, pairs, delta=delta)
+        try:
+            while True:
+                received = await ws.receive()
+                if received["type"] == "websocket.disconnect":
+                    break
+                message, error = parse_request(
+                    received.get("text") or received.get("bytes") or ""
+                )
+                if error is None and message["event"] == "subscribe":
+                    error = self.check_pairs(message["pairs"])
+                if error is not None:
+                    subscriber.publish(Frame({"event": "error", "error": error}))
+                elif message["event"] == "subscribe":
+                    await self.subscribe(subscriber, message["pairs"], delta=delta)
+                elif message["event"] == "unsubscribe":
+                    self.unsubscribe(subscriber, message["pairs"])
+                elif message["event"] == "resync":
+                    self.resync(subscriber, message["pair"])
+        except WebSocketDisconnect:
+            pass
+        finally:
+            self.unsubscribe(subscriber)
+            subscriber.close()
 
-    await orderbook.add_book(
-        pairs=pairs  # we can also subscribe to more currency pairs
-    )
+    def check_pairs(self, pairs):
+        """An error message if clients may not subscribe to one of ``pairs``"""
+        unknown = [
+            pair for pair in pairs if self.known is not None and not self.known(pair)
+        ]
+        if unknown:
+            return "unknown pairs {}".format(", ".join(unknown)[:200])
+        return None
 
-    while not orderbook.exception_occur:
-        await asyncio.sleep(10)
+    @property
+    def exception_occur(self) -> bool:
+        return self.orderbook is not None and self.orderbook.exception_occur
@@ -0,0 +1,141 @@
+"""
+The pairs clients can ask for and the lifetime of the state kept per pair.
+
+Hubs create the state of a pair (a book, candles, trade aggregates, ...)
+and its upstream subscription on first use. :class:`PairUsers` counts the
+users of every pair and releases the state once the last one has been gone
+for ``delay`` seconds, so a reconnecting client finds it still there.
+Requests that only read the state :meth:`PairUsers.touch` it instead, it
+lives for ``delay`` seconds after the last one.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+from typing import Awaitable, Callable, Iterable, Optional
+
+# seconds the state of a pair is kept after its last user left
+RELEASE_DELAY = 30.0
+# longest pair name in bytes, the binary book protocol has a 1 byte length
+MAX_PAIR_LENGTH = 255
+# seconds between attempts to load the asset pairs
+LOAD_RETRY = 60.0
+
+
+def notations(wsname: str) -> set[str]:
+    """The websocket v1 name of a Kraken pair and its v2 symbol"""
+    base, _, quote = wsname.partition("/")
+    symbols = {"XBT": "BTC", "XDG": "DOGE"}
+    return {wsname, "{}/{}".format(symbols.get(base, base), symbols.get(quote, quote))}
+
+
+class AssetPairs:
+    """
+    The Kraken pairs, as ``XBT/USD`` or ``BTC/USD``. Until the asset pairs
+    have been loaded only the configured ``pairs`` are known.
+    """
+
+    def __init__(self: AssetPairs, pairs: Iterable[str] = ()) -> None:
+        self.pairs: set[str] = set(pairs)
+        self.loaded: bool = False
+        self._task: Optional[asyncio.Task] = None
+
+    def known(self: AssetPairs, pair: str) -> bool:
+        return (
+            isinstance(pair, str)
+            and len(pair.encode()) <= MAX_PAIR_LENGTH
+            and pair in self.pairs
+        )
+
+    def update(self: AssetPairs, asset_pairs: dict) -> None:
+        """Adds the pairs of a Kraken ``AssetPairs`` result"""
+        for info in asset_pairs.values():
+            if info.get("wsname"):
+                self.pairs |= notations(info["wsname"])
+        self.loaded = True
+
+    def start(self: AssetPairs, fetch: Callable[[], Awaitable[dict]]) -> None:
+        """Loads the asset pairs with ``fetch()``, retried until it succeeds"""
+        self._task = asyncio.create_task(self._load(fetch))
+
+    async def _load(self: AssetPairs, fetch: Callable[[], Awaitable[dict]]) -> None:
+        while True:
+            try:
+                self.update(await fetch())
+                logging.info("Loaded %s asset pairs", len(self.pairs))
+                return
+            except Exception:
+                logging.exception("Loading the asset pairs failed")
+            await asyncio.sleep(LOAD_RETRY)
+
+    def close(self: AssetPairs) -> None:
+        if self._task is not None:
+            self._task.cancel()
+
+
+class PairUsers:
+    """
+    Reference counts of the users of the per-pair state of a hub.
+    ``release(pair)`` is awaited once a pair has had no users for ``delay``
+    seconds, pinned pairs are never released.
+    """
+
+    def __init__(
+        self: PairUsers,
+        release: Callable[[str], Awaitable[None]],
+        delay: float = RELEASE_DELAY,
+    ) -> None:
+        self.release_pair: Callable[[str], Awaitable[None]] = release
+        self.delay: float = delay
+        self.counts: dict[str, int] = {}
+        self.pinned: set[str] = set()
+        # releases waiting for their delay, and the ones running
+        self._pending: dict[str, asyncio.Task] = {}
+        self._releasing: dict[str, asyncio.Task] = {}
+
+    def pin(self: PairUsers, pairs: Iterable[str]) -> None:
+        for pair in pairs:
+            self.pinned.add(pair)
+            self._cancel(pair)
+
+    def acquire(self: PairUsers, pair: str) -> None:
+        self.counts[pair] = self.counts.get(pair, 0) + 1
+        self._cancel(pair)
+
+    def release(self: PairUsers, pair: str) -> None:
+        count = self.counts.get(pair, 0) - 1
+        if count > 0:
+            self.counts[pair] = count
+            return
+        self.counts.pop(pair, None)
+        self.touch(pair)
+
+    def touch(self: PairUsers, pair: str) -> None:
+        """Keeps an unused pair for another ``delay`` seconds"""
+        if self.counts.get(pair) or pair in self.pinned:
+            return
+        self._cancel(pair)
+        self._pending[pair] = asyncio.ensure_future(self._release(pair))
+
+    async def settled(self: PairUsers, pair: str) -> None:
+        """Waits until a running release of ``pair`` is done"""
+        task = self._releasing.get(pair)
+        if task is not None:
+            await asyncio.wait([task])
+
+    def _cancel(self: PairUsers, pair: str) -> None:
+        task = self._pending.pop(pair, None)
+        if task is not None:
+            task.cancel()
+
+    async def _release(self: PairUsers, pair: str) -> None:
+        await asyncio.sleep(self.delay)
+        # from here on the release is not cancelled, new users wait for it
+        self._releasing[pair] = self._pending.pop(pair)
+        try:
+            await self.release_pair(pair)
+        except Exception:
+            logging.exception("Releasing %s failed", pair)
+        finally:
+            del self._releasing[pair]
@@ -0,0 +1,129 @@
+from __future__ import annotations
+
+from typing import Any
+
+import numpy as np
+
+PULLING_STACKING_CLEANUP_INTERVAL = 50
+
+
+class PullingStackingTracker:
+    """
+    Incremental pulling/stacking of a single pair.
+
+    Only the price levels sent in a book message are touched. Every level
+    remembers its last volume change and the update it happened at; the
+    carried over ``*_ps`` and ``*_ps_history`` values of untouched levels are
+    derived from that when the ladder is serialized, so levels age out without
+    being visited on every update.
+
+    A change is kept on a level until the level changes again or it has been
+    carried over ``PULLING_STACKING_CLEANUP_INTERVAL`` times, after which the
+    level starts over with no change.
+    """
+
+    def __init__(self: PullingStackingTracker, depth: int) -> None:
+        self.depth: int = depth
+        self.seq: int = 0
+        # price -> [rounded volume, volume change, seq of the change]
+        self._levels: dict[str, dict[float, list]] = {"bid": {}, "ask": {}}
+        # worst price of each side in the previous ladder
+        self._bounds: dict[str, float | None] = {"bid": None, "ask": None}
+
+    def update(self: PullingStackingTracker, message: dict, book: Any) -> None:
+        """Applies the delta levels of a Kraken v2 book message"""
+        self.seq += 1
+        data = message["data"][0]
+        price_decimals = book.price_decimals
+        qty_decimals = book.qty_decimals
+
+        for side, orders in (("bid", data["bids"]), ("ask", data["asks"])):
+            levels = self._levels[side]
+            bound = self._bounds[side]
+
+            # prices are normalized like the SDK does, only the last entry of
+            # a price level counts
+            delta = {
+                float("{:.{}f}".format(order["price"], price_decimals)): order["qty"]
+                for order in orders
+            }
+            for price, qty in delta.items():
+                amount = float("{:.{}f}".format(qty, qty_decimals))
+                volume = round(amount)
+                level = levels.get(price)
+                if level is not None and not self._in_window(side, price, bound):
+                    level = None
+
+                if amount == 0:
+                    levels.pop(price, None)
+                elif level is None:
+                    levels[price] = [volume, volume, self.seq]
+                elif volume != level[0]:
+                    level[1] = volume - level[0]
+                    level[0] = volume
+                    level[2] = self.seq
+
+            if message["type"] == "snapshot":
+                for price in [p for p in levels if p not in delta]:
+                    del levels[price]
+
+            ticks, _ = book.side(side).top(self.depth)
+            self._bounds[side] = book.price(int(ticks[-1])) if len(ticks) else None
+            if len(levels) > 2 * self.depth:
+                self._prune(side)
+
+    def _in_window(
+        self: PullingStackingTracker, side: str, price: float, bound: float | None
+    ) -> bool:
+        """Whether ``price`` was part of the previous ladder"""
+        if bound is None:
+            return False
+        return price >= bound if side == "bid" else price <= bound
+
+    def _prune(self: PullingStackingTracker, side: str) -> None:
+        """Drops levels that fell out of the book without being removed"""
+        bound = self._bounds[side]
+        levels = self._levels[side]
+        for price in [p for p in levels if not self._in_window(side, p, bound)]:
+            del levels[price]
+
+    def fill(
+        self: PullingStackingTracker,
+        side: str,
+        prices: list[float],
+        volumes: np.ndarray,
+        ps: np.ndarray,
+        history: np.ndarray,
+        change: np.ndarray,
+        changed_at: np.ndarray,
+    ) -> None:
+        """
+        Writes the current ``*_ps`` and ``*_ps_history`` of ``prices`` along
+        with the last volume change of each level and the update it happened
+        at.
+        """
+        levels = self._levels[side]
+        count = len(prices)
+        if not count:
+            return
+
+        states = [levels[price] for price in prices]
+        change[:] = np.fromiter((s[1] for s in states), dtype=np.int64, count=count)
+        changed_at[:] = np.fromiter((s[2] for s in states), dtype=np.int64, count=count)
+        since = self.seq - changed_at
+
+        # after the cleanup interval a level restarts with no change every
+        # PULLING_STACKING_CLEANUP_INTERVAL + 1 updates
+        aged = since > PULLING_STACKING_CLEANUP_INTERVAL
+        present = volumes != 0
+        ps[:] = np.where(present & ~aged, change, 0)
+        history[:] = np.where(
+            present,
+            np.where(
+                aged,
+                (since - PULLING_STACKING_CLEANUP_INTERVAL - 1)
+                % (PULLING_STACKING_CLEANUP_INTERVAL + 1),
+                since,
+            ),
+            0,
+        )
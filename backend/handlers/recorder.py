@@ -0,0 +1,233 @@
+"""
+Recording and replay of the messages received from Kraken.
+
+Messages are appended with their receive time to segment files
+(``000000.rec``, ``000001.rec``, ... in the recording directory). A segment
+starts with :data:`MAGIC` followed by records::
+
+    time        f64     receive time (unix seconds)
+    length      u32     length of the message
+    source      u8      index in SOURCES
+    message     JSON    ``length`` bytes
+
+``book`` messages are fed to ``Orderbook.on_message`` (Kraken v2 book
+channel), ``kraken`` messages to ``TradingBot.on_message`` (Kraken v1
+channels) and ``meta`` records are the asset pair lookups the order book
+client makes, so a book can be replayed without a Kraken connection.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import inspect
+import logging
+import mmap
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Iterator, Optional
+
+from handlers.broadcast import decode, encode
+from handlers.metrics import counter
+
+MAGIC = b"KRAKREC1"
+RECORD = struct.Struct("<dIB")
+SOURCES = ("book", "kraken", "meta")
+
+SEGMENT_SIZE = 64 * 1024 * 1024
+FLUSH_INTERVAL = 0.5
+MAX_PENDING = 64 * 1024 * 1024
+
+DROPPED = counter("recorder_dropped_total", "Records dropped by the recorder")
+
+
+class Recorder:
+    """
+    Append only recorder of raw messages.
+
+    :meth:`record` only encodes the message and queues it, a flush task
+    hands the queued records to a single writer thread every
+    ``flush_interval`` seconds, so disk writes never block the event loop.
+    If more than ``max_pending`` bytes are waiting (the disk can't keep up)
+    records are dropped and counted instead of growing the queue.
+    """
+
+    def __init__(
+        self: Recorder,
+        directory: str | Path,
+        segment_size: int = SEGMENT_SIZE,
+        flush_interval: float = FLUSH_INTERVAL,
+        max_pending: int = MAX_PENDING,
+    ) -> None:
+        self.directory: Path = Path(directory)
+        self.segment_size: int = segment_size
+        self.flush_interval: float = flush_interval
+        self.max_pending: int = max_pending
+        self.recorded: int = 0
+        self.dropped: int = 0
+
+        self._chunks: list[bytes] = []
+        self._pending: int = 0
+        self._file: Any = None
+        self._segment: int = 0
+        self._executor: ThreadPoolExecutor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="recorder"
+        )
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def pending(self: Recorder) -> int:
+        """Bytes waiting for the writer thread"""
+        return self._pending
+
+    def start(self: Recorder) -> None:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        # continue after the segments of earlier runs
+        self._segment = len(segments(self.directory))
+        self._task = asyncio.create_task(self._run())
+        logging.info("Recording Kraken messages to %s", self.directory)
+
+    def record(
+        self: Recorder, source: str, message: Any, received: Optional[float] = None
+    ) -> None:
+        if self._pending > self.max_pending:
+            self.dropped += 1
+            DROPPED.inc()
+            return
+        data = encode(message)
+        self._chunks.append(
+            RECORD.pack(
+                received if received is not None else time.time(),
+                len(data),
+                SOURCES.index(source),
+            )
+            + data
+        )
+        self._pending += RECORD.size + len(data)
+        self.recorded += 1
+
+    async def _run(self: Recorder) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self: Recorder) -> None:
+        if not self._chunks:
+            return
+        chunks, self._chunks = self._chunks, []
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(self._executor, self._write, chunks)
+        finally:
+            self._pending -= sum(len(chunk) for chunk in chunks)
+
+    def _write(self: Recorder, chunks: list[bytes]) -> None:
+        data = b"".join(chunks)
+        if self._file is None or self._file.tell() + len(data) > self.segment_size:
+            self._rotate()
+        self._file.write(data)
+        self._file.flush()
+
+    def _rotate(self: Recorder) -> None:
+        if self._file is not None:
+            self._file.close()
+        path = self.directory / "{:06d}.rec".format(self._segment)
+        self._segment += 1
+        self._file = open(path, "wb")
+        self._file.write(MAGIC)
+
+    async def close(self: Recorder) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+        if self._file is not None:
+            await asyncio.get_running_loop().run_in_executor(
+                self._executor, self._file.close
+            )
+            self._file = None
+        self._executor.shutdown(wait=True)
+
+
+class RecordingMarket:
+    """Records the asset pair lookups of the order book client"""
+
+    def __init__(self: RecordingMarket, market: Any, recorder: Recorder) -> None:
+        self.market: Any = market
+        self.recorder: Recorder = recorder
+
+    def get_asset_pairs(self: RecordingMarket, pair: str) -> dict:
+        asset_pairs = self.market.get_asset_pairs(pair=pair)
+        self.recorder.record("meta", {pair: asset_pairs[pair]})
+        return asset_pairs
+
+
+class RecordedMarket:
+    """Answers the asset pair lookups of the order book client from ``meta``"""
+
+    def __init__(self: RecordedMarket) -> None:
+        self.asset_pairs: dict[str, dict] = {}
+
+    def on_message(self: RecordedMarket, message: dict) -> None:
+        self.asset_pairs.update(message)
+
+    def get_asset_pairs(self: RecordedMarket, pair: str) -> dict:
+        return {pair: self.asset_pairs[pair]}
+
+
+def segments(directory: str | Path) -> list[Path]:
+    return sorted(Path(directory).glob("*.rec"))
+
+
+def read_segment(path: str | Path) -> Iterator[tuple[float, str, Any]]:
+    """Yields ``(receive time, source, message)`` of a memory mapped segment"""
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if data[: len(MAGIC)] != MAGIC:
+                raise ValueError(f"{path} is not a recording segment")
+            offset = len(MAGIC)
+            while offset + RECORD.size <= len(data):
+                received, length, source = RECORD.unpack_from(data, offset)
+                offset += RECORD.size
+                if offset + length > len(data):
+                    # the tail of a segment that is still being written
+                    break
+                yield received, SOURCES[source], decode(data[offset : offset + length])
+                offset += length
+
+
+def read(directory: str | Path) -> Iterator[tuple[float, str, Any]]:
+    for path in segments(directory):
+        yield from read_segment(path)
+
+
+async def replay(
+    directory: str | Path,
+    handlers: dict[str, Callable],
+    speed: Optional[float] = 1.0,
+) -> int:
+    """
+    Feeds a recording to ``handlers`` (source -> callable or coroutine
+    function taking the message). ``speed`` is relative to the recorded
+    time, ``None`` replays as fast as possible. Returns the number of
+    replayed messages.
+    """
+    loop = asyncio.get_running_loop()
+    first = started = None
+    count = 0
+    for received, source, message in read(directory):
+        delay = 0
+        if speed:
+            if first is None:
+                first, started = received, loop.time()
+            delay = (received - first) / speed - (loop.time() - started)
+        # also lets the websocket sender tasks run between messages
+        await asyncio.sleep(max(0, delay))
+        handler = handlers.get(source)
+        if handler is not None:
+            result = handler(message)
+            if inspect.isawaitable(result):
+                await result
+        count += 1
+    return count
@@ -0,0 +1,75 @@
+from __future__ import annotations
+
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+# endpoint -> (timeout in seconds, concurrent upstream calls)
+# private calls are signed with increasing nonces, running them one at a time
+# keeps the nonces in order
+ENDPOINT_LIMITS = {
+    "orders": (5.0, 1),
+    "positions": (5.0, 1),
+    "ohlc": (10.0, 4),
+}
+DEFAULT_LIMIT = (10.0, 2)
+
+
+class RestClient:
+    """
+    Runs the blocking calls of the Kraken REST clients off the event loop.
+
+    The SDK clients keep a persistent ``requests.Session`` (keep-alive
+    connection pool), but every call blocks until Kraken answers. Calls run
+    in a bounded thread pool instead, with a timeout and a limit of
+    concurrent upstream calls per endpoint, so a slow REST response never
+    stalls the websocket streams.
+    """
+
+    def __init__(
+        self: RestClient,
+        max_workers: int = 8,
+        limits: Optional[dict[str, tuple[float, int]]] = None,
+    ) -> None:
+        self.executor: ThreadPoolExecutor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="kraken-rest"
+        )
+        self.limits: dict[str, tuple[float, int]] = {
+            **ENDPOINT_LIMITS,
+            **(limits or {}),
+        }
+        self._semaphores: dict[str, asyncio.Semaphore] = {}
+
+    def _semaphore(self: RestClient, endpoint: str) -> asyncio.Semaphore:
+        if endpoint not in self._semaphores:
+            _, concurrency = self.limits.get(endpoint, DEFAULT_LIMIT)
+            self._semaphores[endpoint] = asyncio.Semaphore(concurrency)
+        return self._semaphores[endpoint]
+
+    async def call(
+        self: RestClient, endpoint: str, func: Callable, *args: Any, **kwargs: Any
+    ) -> Any:
+        """
+        Runs ``func(*args, **kwargs)`` in the thread pool. Raises
+        ``asyncio.TimeoutError`` if the call (including the wait for a free
+        slot of the endpoint) takes longer than the endpoint timeout.
+        """
+        timeout, _ = self.limits.get(endpoint, DEFAULT_LIMIT)
+        semaphore = self._semaphore(endpoint)
+        loop = asyncio.get_running_loop()
+
+        async def run() -> Any:
+            await semaphore.acquire()
+            future = loop.run_in_executor(
+                self.executor, functools.partial(func, *args, **kwargs)
+            )
+            # the slot is freed when the thread is done, not on timeout, so
+            # timed out calls still count against the limit
+            future.add_done_callback(lambda _: semaphore.release())
+            return await asyncio.shield(future)
+
+        return await asyncio.wait_for(run(), timeout)
+
+    def shutdown(self: RestClient) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
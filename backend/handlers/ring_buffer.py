@@ -0,0 +1,50 @@
+from __future__ import annotations
+
+from typing import Optional
+
+import numpy as np
+
+
+class RingBuffer:
+    """
+    Fixed capacity time series with a time and a value column.
+
+    Once ``capacity`` points are stored the oldest point is overwritten.
+    Points older than ``retention`` seconds (relative to the newest point) are
+    left out when the buffer is read.
+    """
+
+    def __init__(
+        self: RingBuffer, capacity: int, retention: Optional[float] = None
+    ) -> None:
+        self.capacity: int = capacity
+        self.retention: Optional[float] = retention
+        self.time = np.zeros(capacity, dtype=np.float64)
+        self.value = np.zeros(capacity, dtype=np.float64)
+        self._head: int = 0
+        self._count: int = 0
+
+    def __len__(self: RingBuffer) -> int:
+        return self._count
+
+    def push(self: RingBuffer, t: float, value: float) -> None:
+        self.time[self._head] = t
+        self.value[self._head] = value
+        self._head = (self._head + 1) % self.capacity
+        self._count = min(self._count + 1, self.capacity)
+
+    def arrays(self: RingBuffer) -> tuple[np.ndarray, np.ndarray]:
+        """Returns copies of the retained points in chronological order"""
+        start = (self._head - self._count) % self.capacity
+        order = (np.arange(self._count) + start) % self.capacity
+        time = self.time[order]
+        value = self.value[order]
+        if self.retention is not None and self._count:
+            first = np.searchsorted(time, time[-1] - self.retention, side="left")
+            time, value = time[first:], value[first:]
+        return time, value
+
+    def to_points(self: RingBuffer) -> list[dict]:
+        """Returns the retained points as ``{"time": ..., "value": ...}``"""
+        time, value = self.arrays()
+        return [{"time": t, "value": v} for t, v in zip(time.tolist(), value.tolist())]
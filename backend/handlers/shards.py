@@ -0,0 +1,447 @@
+"""
+Order books sharded over worker processes.
+
+Every worker runs a regular :class:`OrderbookHub` with its own Kraken
+connection for the pairs assigned to it, so book updates, the ladder and
+the JSON encoding of different pairs use different cores. The front
+process (the one serving the websockets) talks to each worker over a Unix
+socket with messages of ``MESSAGE`` (kind, pair length, data length)
+followed by the pair and the data:
+
+- ``EVENT`` (front to worker): JSON ``{"event": "add" | "remove", "pairs"}``
+  or ``{"event": "json", "pair", "enabled"}``, the latter while the front
+  has JSON clients for the pair
+- ``BOOK_JSON``: the encoded JSON book of an update, forwarded to the JSON
+  clients as is
+- ``BOOK_DELTA``: a frame of :mod:`handlers.book_protocol` for every update,
+  which the front applies to a mirror of the ladder its delta clients are
+  served from
+- ``NOTICE``: a resync notice for the JSON and the delta clients
+
+The front counts the clients of every pair like the single process hub and
+removes a pair from its shard a while after the last one left.
+
+New pairs go to the shard with the lowest update rate. After that the
+shards are rebalanced by moving pairs from the busiest to the least busy
+shard while that narrows the gap between them.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import struct
+import tempfile
+import time
+from typing import Any, Callable, Optional
+
+import numpy as np
+
+from handlers.book_protocol import COLUMNS, decode_frame
+from handlers.broadcast import Frame, encode, publish
+from handlers.endpoints import use_kraken_endpoints
+from handlers.orderbook import HISTORY_CAPACITY, HISTORY_RETENTION, OrderbookHub
+from handlers.pairs import RELEASE_DELAY
+from handlers.ring_buffer import RingBuffer
+
+MESSAGE = struct.Struct("<BBI")
+EVENT = 0
+BOOK_JSON = 1
+BOOK_DELTA = 2
+NOTICE = 3
+
+# bytes a worker buffers for the front before it drops frames
+MAX_BUFFER = 16 * 1024 * 1024
+# seconds a new worker has to connect to the front
+START_TIMEOUT = 30
+
+
+def pack(kind: int, pair: str, data: bytes) -> bytes:
+    raw = pair.encode()
+    return MESSAGE.pack(kind, len(raw), len(data)) + raw + data
+
+
+async def read_message(reader: asyncio.StreamReader) -> tuple[int, str, bytes]:
+    kind, pair_length, length = MESSAGE.unpack(await reader.readexactly(MESSAGE.size))
+    pair = (await reader.readexactly(pair_length)).decode()
+    return kind, pair, await reader.readexactly(length)
+
+
+class ShardLink:
+    """
+    Stands in for the websocket clients of a worker hub and writes their
+    frames to the front.
+    """
+
+    def __init__(
+        self: ShardLink, hub: OrderbookHub, writer: asyncio.StreamWriter, kind: int
+    ) -> None:
+        self.hub: OrderbookHub = hub
+        self.writer: asyncio.StreamWriter = writer
+        self.kind: int = kind
+
+    def publish(self: ShardLink, frame: Any, key: Any = None) -> None:
+        kind, pair = key
+        if kind == "resync" and self.kind == BOOK_JSON:
+            # the delta link, which every pair has, sends the notice
+            return
+        if not isinstance(frame, Frame):
+            frame = frame()
+            if frame is None:
+                return
+        if self.writer.transport.get_write_buffer_size() > MAX_BUFFER:
+            # the front can't keep up, a delta stream continues with a snapshot
+            state = self.hub.pairs.get(pair)
+            if state is not None and self in state.delta_clients:
+                state.delta_clients[self].resync()
+            return
+        kind = NOTICE if kind == "resync" else self.kind
+        self.writer.write(pack(kind, pair, frame.data))
+
+    def discard(self: ShardLink, key: Any) -> None:
+        """Frames are written right away, nothing waits to be discarded"""
+
+
+class ShardWorker:
+    """The books of the pairs of one shard, run in a worker process"""
+
+    def __init__(self: ShardWorker, path: str, depth: int, retention: float) -> None:
+        self.path: str = path
+        # the front does not serve the heatmap with shards
+        self.hub: OrderbookHub = OrderbookHub(
+            depth=depth, retention=retention, heatmap=False
+        )
+
+    async def run(self: ShardWorker) -> None:
+        reader, writer = await asyncio.open_unix_connection(self.path)
+        hub = self.hub
+        await hub.start([])
+        json_link = ShardLink(hub, writer, BOOK_JSON)
+        delta_link = ShardLink(hub, writer, BOOK_DELTA)
+        watchdog = asyncio.create_task(self._watch(writer))
+        try:
+            while True:
+                _, _, data = await read_message(reader)
+                event = json.loads(data)
+                if event["event"] == "add":
+                    await hub.subscribe(delta_link, event["pairs"], delta=True)
+                elif event["event"] == "remove":
+                    hub.unsubscribe(json_link, event["pairs"])
+                    hub.unsubscribe(delta_link, event["pairs"])
+                    await hub.remove_pairs(event["pairs"])
+                elif event["event"] == "json":
+                    if event["enabled"]:
+                        await hub.subscribe(json_link, [event["pair"]])
+                    else:
+                        hub.unsubscribe(json_link, [event["pair"]])
+        except (asyncio.IncompleteReadError, ConnectionError):
+            # the front is gone
+            pass
+        finally:
+            watchdog.cancel()
+
+    async def _watch(self: ShardWorker, writer: asyncio.StreamWriter) -> None:
+        while not self.hub.exception_occur:
+            await asyncio.sleep(1)
+        logging.error("The Kraken connection of the shard failed")
+        writer.close()
+
+
+def run_worker(path: str, depth: int, retention: float, endpoints: dict) -> None:
+    """Entry point of a worker process"""
+    logging.getLogger().setLevel(logging.INFO)
+    use_kraken_endpoints(**endpoints)
+    asyncio.run(ShardWorker(path, depth, retention).run())
+
+
+class MirrorSnapshot:
+    """The ladder of a pair as the frames of its shard describe it"""
+
+    def __init__(self: MirrorSnapshot, depth: int) -> None:
+        self.depth: int = depth
+        for name, _ in COLUMNS:
+            dtype = np.float64 if name == "price" else np.int64
+            setattr(self, name, np.zeros(2 * depth, dtype=dtype))
+        self.seq: int = 0
+        self.start: int = depth
+        self.stop: int = depth
+        self.bid_volume_total: int = 0
+        self.ask_volume_total: int = 0
+        self.best_bid: float = 0.0
+        self.best_ask: float = 0.0
+
+
+class MirrorState:
+    """Stands in for the :class:`PairState` of a pair that a shard keeps"""
+
+    def __init__(
+        self: MirrorState, pair: str, depth: int, retention: float = HISTORY_RETENTION
+    ) -> None:
+        self.pair: str = pair
+        self.snapshot: MirrorSnapshot = MirrorSnapshot(depth)
+        self.imbalance_history: RingBuffer = RingBuffer(HISTORY_CAPACITY, retention)
+        self.large_volume_history: RingBuffer = RingBuffer(HISTORY_CAPACITY, retention)
+        self.checksum: int = 0
+        self.imbalance: dict = {"time": 0.0, "value": 0.0}
+        self.large_volume: dict = {"time": 0.0, "value": 0.0}
+        self.clients: set = set()
+        self.delta_clients: dict = {}
+        # the shards keep the heatmaps, they are not served
+        self.heatmap = None
+        # whether the shard sends JSON books
+        self.json: bool = False
+        self.updates: int = 0
+
+    def apply(self: MirrorState, frame: dict) -> None:
+        snapshot = self.snapshot
+        rows = frame["index"].astype(np.intp)
+        for name, _ in COLUMNS:
+            getattr(snapshot, name)[rows] = frame[name]
+        for name in (
+            "seq",
+            "start",
+            "stop",
+            "bid_volume_total",
+            "ask_volume_total",
+            "best_bid",
+            "best_ask",
+        ):
+            setattr(snapshot, name, frame[name])
+        self.checksum = frame["checksum"]
+        t = frame["time"]
+        self.imbalance = {"time": t, "value": frame["imbalance"]}
+        self.large_volume = {"time": t, "value": frame["large_volume"]}
+        self.imbalance_history.push(t, frame["imbalance"])
+        self.large_volume_history.push(t, frame["large_volume"])
+        self.updates += 1
+
+    def get_history(self: MirrorState) -> dict:
+        return {
+            "pair": self.pair,
+            "imbalance_history": self.imbalance_history.to_points(),
+            "large_volume_history": self.large_volume_history.to_points(),
+        }
+
+
+class ShardedOrderbookHub(OrderbookHub):
+    """
+    An :class:`OrderbookHub` whose books are kept by ``shards`` worker
+    processes, see the module documentation. Clients are served like by the
+    single process hub.
+    """
+
+    # the shards keep the books, no heatmaps or listeners in this process
+    keeps_books = False
+
+    def __init__(
+        self: ShardedOrderbookHub,
+        shards: int,
+        depth: int = 100,
+        retention: float = HISTORY_RETENTION,
+        max_rate: Optional[float] = None,
+        endpoints: Optional[dict] = None,
+        known: Optional[Callable[[str], bool]] = None,
+        release_delay: float = RELEASE_DELAY,
+    ) -> None:
+        super().__init__(
+            depth=depth,
+            retention=retention,
+            max_rate=max_rate,
+            known=known,
+            release_delay=release_delay,
+        )
+        self.shards: int = shards
+        self.endpoints: dict = endpoints or {}
+        # pair -> shard
+        self.assignment: dict[str, int] = {}
+        self._processes: list = []
+        self._writers: list[asyncio.StreamWriter] = []
+        self._readers: list[asyncio.Task] = []
+        # updates of every pair at the last rebalance, for the update rates
+        self._counted: dict[str, int] = {}
+        self._counted_at: float = time.monotonic()
+
+    async def start(self: ShardedOrderbookHub, pairs: list[str]) -> None:
+        directory = tempfile.mkdtemp(prefix="book-shards-")
+        context = multiprocessing.get_context("spawn")
+        for shard in range(self.shards):
+            path = os.path.join(directory, "{}.sock".format(shard))
+            connected = asyncio.get_running_loop().create_future()
+            server = await asyncio.start_unix_server(
+                lambda reader, writer: connected.set_result((reader, writer)), path
+            )
+            process = context.Process(
+                target=run_worker,
+                args=(path, self.depth, self.retention, self.endpoints),
+                name="book-shard-{}".format(shard),
+                daemon=True,
+            )
+            process.start()
+            try:
+                reader, writer = await asyncio.wait_for(connected, START_TIMEOUT)
+            except asyncio.TimeoutError:
+                process.terminate()
+                raise RuntimeError("Order book shard {} did not start".format(shard))
+            finally:
+                server.close()
+            os.unlink(path)
+            self._processes.append(process)
+            self._writers.append(writer)
+            self._readers.append(asyncio.create_task(self._read(shard, reader)))
+        os.rmdir(directory)
+        logging.info("Started %s order book shards", self.shards)
+        self.users.pin(pairs)
+        await self.add_pairs(pairs)
+
+    def _send(self: ShardedOrderbookHub, shard: int, event: dict) -> None:
+        self._writers[shard].write(pack(EVENT, "", encode(event)))
+
+    async def _read(
+        self: ShardedOrderbookHub, shard: int, reader: asyncio.StreamReader
+    ) -> None:
+        try:
+            while True:
+                kind, pair, data = await read_message(reader)
+                state = self.pairs.get(pair)
+                if state is None or self.assignment.get(pair) != shard:
+                    # frames sent before the pair was moved or removed
+                    continue
+                key = ("book", pair)
+                if kind == BOOK_JSON:
+                    if state.clients:
+                        publish(
+                            state.clients, Frame.from_bytes(data, binary=False), key
+                        )
+                elif kind == BOOK_DELTA:
+                    state.apply(decode_frame(data))
+                    for subscriber, stream in state.delta_clients.items():
+                        subscriber.publish(stream.render, key=key)
+                elif kind == NOTICE:
+                    notice = Frame.from_bytes(data, binary=False)
+                    for subscriber in state.clients:
+                        subscriber.discard(key)
+                        subscriber.publish(notice, ("resync", pair))
+                    for subscriber, stream in state.delta_clients.items():
+                        stream.resync()
+                        subscriber.discard(key)
+                        subscriber.publish(notice, ("resync", pair))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            logging.error("Order book shard %s stopped", shard)
+
+    async def add_pairs(self: ShardedOrderbookHub, pairs: list[str]) -> None:
+        for pair in pairs:
+            await self.users.settled(pair)
+        new_pairs = [pair for pair in pairs if pair not in self.pairs]
+        if not new_pairs:
+            return
+        rates = self.rates()
+        # a new pair is expected to be as busy as the average pair
+        expected = sum(rates.values()) / len(rates) if rates else 0.0
+        loads = self.loads(rates)
+        for pair in new_pairs:
+            shard = min(range(self.shards), key=lambda shard: (loads[shard], shard))
+            loads[shard] += expected or 1.0
+            self.pairs[pair] = MirrorState(pair, self.depth, self.retention)
+            self.assignment[pair] = shard
+            self._counted[pair] = 0
+            logging.info("Order book of %s on shard %s", pair, shard)
+            self._send(shard, {"event": "add", "pairs": [pair]})
+        self.rebalance(rates)
+
+    async def remove_pairs(self: ShardedOrderbookHub, pairs: list[str]) -> None:
+        for pair in pairs:
+            if self.pairs.pop(pair, None) is None:
+                continue
+            shard = self.assignment.pop(pair)
+            self._counted.pop(pair, None)
+            logging.info("Removing the order book of %s from shard %s", pair, shard)
+            self._send(shard, {"event": "remove", "pairs": [pair]})
+
+    def rates(self: ShardedOrderbookHub) -> dict[str, float]:
+        """Updates per second of every pair since the last rebalance"""
+        now = time.monotonic()
+        elapsed = max(now - self._counted_at, 1e-3)
+        rates = {}
+        for pair, state in self.pairs.items():
+            rates[pair] = (state.updates - self._counted.get(pair, 0)) / elapsed
+            self._counted[pair] = state.updates
+        self._counted_at = now
+        return rates
+
+    def loads(self: ShardedOrderbookHub, rates: dict[str, float]) -> list[float]:
+        loads = [0.0] * self.shards
+        for pair, shard in self.assignment.items():
+            loads[shard] += rates.get(pair, 0.0)
+        return loads
+
+    def rebalance(self: ShardedOrderbookHub, rates: dict[str, float]) -> None:
+        """
+        Moves pairs from the busiest to the least busy shard while a move
+        narrows the gap between their update rates.
+        """
+        loads = self.loads(rates)
+        for _ in range(len(self.assignment)):
+            busiest = max(range(self.shards), key=loads.__getitem__)
+            idlest = min(range(self.shards), key=loads.__getitem__)
+            gap = loads[busiest] - loads[idlest]
+            # moving a pair narrows the gap if its rate is below the gap
+            candidates = [
+                (abs(gap - 2 * rates[pair]), pair)
+                for pair, shard in self.assignment.items()
+                if shard == busiest and 0 < rates.get(pair, 0.0) < gap
+            ]
+            if not candidates:
+                return
+            _, pair = min(candidates)
+            self.move(pair, idlest)
+            loads[busiest] -= rates[pair]
+            loads[idlest] += rates[pair]
+
+    def move(self: ShardedOrderbookHub, pair: str, shard: int) -> None:
+        """Moves the book of ``pair`` to ``shard``, its clients get a snapshot"""
+        previous = self.assignment[pair]
+        logging.info("Moving the order book of %s to shard %s", pair, shard)
+        self.assignment[pair] = shard
+        self._send(previous, {"event": "remove", "pairs": [pair]})
+        self._send(shard, {"event": "add", "pairs": [pair]})
+        state = self.pairs[pair]
+        if state.json:
+            self._send(shard, {"event": "json", "pair": pair, "enabled": True})
+        for stream in state.delta_clients.values():
+            stream.resync()
+
+    def _update_json(self: ShardedOrderbookHub, pair: str) -> None:
+        """Tells the shard of ``pair`` whether the front has JSON clients"""
+        state = self.pairs.get(pair)
+        if state is None or bool(state.clients) == state.json:
+            return
+        state.json = bool(state.clients)
+        self._send(
+            self.assignment[pair],
+            {"event": "json", "pair": pair, "enabled": state.json},
+        )
+
+    async def subscribe(
+        self: ShardedOrderbookHub,
+        subscriber: Any,
+        pairs: list[str],
+        delta: bool = False,
+    ) -> None:
+        await super().subscribe(subscriber, pairs, delta=delta)
+        for pair in pairs:
+            self._update_json(pair)
+
+    def unsubscribe(
+        self: ShardedOrderbookHub, subscriber: Any, pairs: Optional[list[str]] = None
+    ) -> None:
+        pairs = list(self.pairs) if pairs is None else pairs
+        super().unsubscribe(subscriber, pairs)
+        for pair in pairs:
+            self._update_json(pair)
+
+    @property
+    def exception_occur(self: ShardedOrderbookHub) -> bool:
+        return any(not process.is_alive() for process in self._processes)
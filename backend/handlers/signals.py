@@ -0,0 +1,549 @@
+"""
+Incremental signals over the book, spread and trade streams.
+
+A signal is a :class:`Signal` subclass registered with :func:`register`. It
+names the streams it consumes and the fields it computes, keeps its state in
+preallocated arrays and returns the new field values from its handlers, or
+``None`` if they did not change. Every signal of a pair is its own channel
+(``/ws_signals?name=...&pair=...``) with its own publish rate, and keeps a
+history of its fields.
+
+Book signals never run inside the book update: the :class:`SignalEngine`
+only keeps the book messages of the pair and computes the signals once the
+loop has queued the book frames, for all updates since the last run at
+once. Their state follows the book level by level instead, so a run reads
+O(1) state whatever the depth: the added/removed lot counters of the sides
+and running sums kept by book side watchers (:class:`DecayedDepth`). The
+watchers are registered with a copy of the book that the run brings up to
+date with the kept messages (:attr:`Signal.watches_book`), nothing is added
+to the book update of the hub. Spread and trade signals get every message.
+
+The book signals need the books in the server process, they are not
+computed when a :class:`ShardedOrderbookHub` keeps them.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import math
+import time
+from typing import Any, Optional, Sequence
+
+import numpy as np
+from starlette.websockets import WebSocketDisconnect
+
+from handlers.book import Book, BookSide
+from handlers.broadcast import Frame, Subscriber
+from handlers.pairs import RELEASE_DELAY, PairUsers
+from handlers.ring_buffer import RingBuffer
+
+SIGNAL_CAPACITY = 100_000
+SIGNAL_RETENTION = 60 * 60
+
+SIGNALS: dict[str, type[Signal]] = {}
+
+
+def register(signal: type[Signal]) -> type[Signal]:
+    """Class decorator adding a signal to the ones computed for every pair"""
+    SIGNALS[signal.name] = signal
+    return signal
+
+
+class Signal:
+    """An incremental indicator of a single pair"""
+
+    name: str = ""
+    # streams the signal consumes: "book", "spread" and "trade"
+    streams: tuple[str, ...] = ("book",)
+    fields: tuple[str, ...] = ("value",)
+    # publishes per second and client
+    max_rate: float = 4
+    # whether on_book gets the copy of the book the engine keeps per pair,
+    # whose sides can be watched
+    watches_book: bool = False
+
+    def __init__(self: Signal, pair: str) -> None:
+        self.pair: str = pair
+
+    def on_book(self: Signal, book: Book, t: float) -> Optional[Sequence[float]]:
+        return None
+
+    def on_spread(
+        self: Signal,
+        t: float,
+        bid: float,
+        ask: float,
+        bid_volume: float,
+        ask_volume: float,
+    ) -> Optional[Sequence[float]]:
+        return None
+
+    def on_trades(
+        self: Signal, t: np.ndarray, price: np.ndarray, volume: np.ndarray
+    ) -> Optional[Sequence[float]]:
+        """Trades of a message, negative volumes are sells"""
+        return None
+
+
+class DecayedDepth:
+    """
+    Volume of a book side with every level weighted by
+    ``exp(-distance / scale)``, the distance in ticks from the best price of
+    the side.
+
+    As a watcher of the side it adds ``lots * exp(±(ticks - anchor) /
+    scale)`` of every level change to a running sum, O(1); the weight of the
+    best price relative to the anchor is divided out when the value is read.
+    The sum is rebuilt from the levels, O(depth), when the best price moved
+    too far from the anchor for the float range and every :attr:`REFRESH`
+    changes against rounding drift.
+    """
+
+    # largest exponent of a weight relative to the anchor
+    REBASE = 30.0
+    REFRESH = 100_000
+
+    def __init__(self: DecayedDepth, side: BookSide, scale: float) -> None:
+        self.side: BookSide = side
+        # weights grow towards the best price
+        self.sign: float = 1.0 if side.bid else -1.0
+        self.scale: float = scale
+        self.anchor: int = 0
+        self.sum: float = 0.0
+        self.changes: int = 0
+        self.stale: bool = True
+        side.watchers.append(self)
+
+    def detach(self: DecayedDepth) -> None:
+        self.side.watchers.remove(self)
+
+    def rebuild(self: DecayedDepth) -> None:
+        best = self.side.best()
+        if best is not None:
+            self.anchor = best[0]
+        ticks, qty = self.side.levels()
+        weights = np.exp(self.sign * (ticks - self.anchor) / self.scale)
+        self.sum = float(qty @ weights)
+        self.changes = 0
+        self.stale = False
+
+    def change(self: DecayedDepth, ticks: int, lots: int) -> None:
+        exponent = self.sign * (ticks - self.anchor) / self.scale
+        if exponent > self.REBASE:
+            # past the float range of the anchor, rebuilt on the next read
+            self.stale = True
+            return
+        self.sum += lots * math.exp(exponent)
+        self.changes += 1
+
+    def clear(self: DecayedDepth) -> None:
+        self.sum = 0.0
+
+    def value(self: DecayedDepth) -> float:
+        """The weighted lots of the side"""
+        best = self.side.best()
+        if best is None:
+            return 0.0
+        offset = self.sign * (best[0] - self.anchor) / self.scale
+        if self.stale or abs(offset) > self.REBASE or self.changes > self.REFRESH:
+            self.rebuild()
+            offset = 0.0
+        return max(self.sum, 0.0) * math.exp(-offset)
+
+
+class DecayedBookSignal(Signal):
+    """
+    A signal over the :class:`DecayedDepth` of both sides of the book. The
+    weight halves every :attr:`HALF_DISTANCE` basis points of the price.
+    """
+
+    HALF_DISTANCE = 2.0
+    watches_book = True
+
+    def __init__(self: DecayedBookSignal, pair: str) -> None:
+        super().__init__(pair)
+        self.book: Optional[Book] = None
+        self.bid: Optional[DecayedDepth] = None
+        self.ask: Optional[DecayedDepth] = None
+        # decay length in ticks
+        self.scale: float = 1.0
+
+    def depths(self: DecayedBookSignal, book: Book) -> Optional[tuple[float, float]]:
+        """Weighted lots of the bids and the asks, ``None`` for a one-sided book"""
+        if book is not self.book:
+            bid, ask = book.bid.best(), book.ask.best()
+            if bid is None or ask is None:
+                return None
+            if self.book is not None:
+                self.bid.detach()
+                self.ask.detach()
+            # the first mid price sets the decay length of the pair
+            half = max((bid[0] + ask[0]) / 2 * self.HALF_DISTANCE * 1e-4, 1.0)
+            self.scale = half / math.log(2)
+            self.book = book
+            self.bid = DecayedDepth(book.bid, self.scale)
+            self.ask = DecayedDepth(book.ask, self.scale)
+        return self.bid.value(), self.ask.value()
+
+
+@register
+class WeightedImbalance(DecayedBookSignal):
+    """
+    Bid/ask imbalance over all levels of the book, each weighted by its
+    distance from the best price of its side
+    """
+
+    name = "weighted_imbalance"
+
+    def on_book(self: WeightedImbalance, book: Book, t: float) -> Optional[tuple]:
+        depths = self.depths(book)
+        if depths is None or not sum(depths):
+            return None
+        bid, ask = depths
+        return ((bid - ask) / (bid + ask),)
+
+
+@register
+class Microprice(Signal):
+    """Mid price weighted by the volume on the opposite side of the spread"""
+
+    name = "microprice"
+
+    def on_book(self: Microprice, book: Book, t: float) -> Optional[tuple]:
+        bid, ask = book.bid.best(), book.ask.best()
+        if bid is None or ask is None:
+            return None
+        (bid_ticks, bid_qty), (ask_ticks, ask_qty) = bid, ask
+        ticks = (bid_ticks * ask_qty + ask_ticks * bid_qty) / (bid_qty + ask_qty)
+        return (ticks / book.price_scale,)
+
+
+@register
+class BookSlope(DecayedBookSignal):
+    """
+    Volume per price away from the best price of each side: the weighted
+    volume divided by the total weight of a level at every tick, which is
+    the density of a book with the same volume at every price.
+    """
+
+    name = "slope"
+    fields = ("bid", "ask")
+
+    def on_book(self: BookSlope, book: Book, t: float) -> Optional[tuple]:
+        depths = self.depths(book)
+        if depths is None:
+            return None
+        # weight of a level at every tick from the best price on
+        weight = 1.0 / (1.0 - math.exp(-1.0 / self.scale))
+        # lots per tick to volume per price
+        scale = book.price_scale / book.qty_scale / weight
+        return depths[0] * scale, depths[1] * scale
+
+
+@register
+class PullingStackingIntensity(Signal):
+    """
+    Volume pulled from and stacked onto the book per second, decayed with a
+    half-life of ``HALF_LIFE`` seconds. Taken from the running totals of the
+    book sides, so updates between two runs are not lost.
+    """
+
+    name = "pulling_stacking"
+    fields = ("pulling", "stacking")
+    HALF_LIFE = 10.0
+
+    def __init__(self: PullingStackingIntensity, pair: str) -> None:
+        super().__init__(pair)
+        self.tau: float = self.HALF_LIFE / math.log(2)
+        # decayed sums and the totals they include
+        self.sums = np.zeros(2, dtype=np.float64)
+        self.totals = np.zeros(2, dtype=np.int64)
+        self.t: Optional[float] = None
+
+    def on_book(self: PullingStackingIntensity, book: Book, t: float) -> tuple:
+        totals = np.array(
+            [
+                book.bid.removed + book.ask.removed,
+                book.bid.added + book.ask.added,
+            ],
+            dtype=np.int64,
+        )
+        if self.t is not None:
+            self.sums *= math.exp(-(t - self.t) / self.tau)
+            self.sums += (totals - self.totals) / book.qty_scale
+        self.totals = totals
+        self.t = t
+        return tuple((self.sums / self.tau).tolist())
+
+
+@register
+class SpreadEwma(Signal):
+    """Spread of the spread channel and its EWMA with a half-life in seconds"""
+
+    name = "spread_ewma"
+    streams = ("spread",)
+    fields = ("spread", "ewma")
+    HALF_LIFE = 30.0
+
+    def __init__(self: SpreadEwma, pair: str) -> None:
+        super().__init__(pair)
+        self.ewma: Optional[float] = None
+        self.t: float = 0.0
+
+    def on_spread(
+        self: SpreadEwma,
+        t: float,
+        bid: float,
+        ask: float,
+        bid_volume: float,
+        ask_volume: float,
+    ) -> tuple:
+        spread = ask - bid
+        if self.ewma is None:
+            self.ewma = spread
+        else:
+            alpha = 1 - 0.5 ** (max(t - self.t, 0) / self.HALF_LIFE)
+            self.ewma += alpha * (spread - self.ewma)
+        self.t = t
+        return spread, self.ewma
+
+
+class SignalSeries:
+    """Latest values, history and clients of one signal of a pair"""
+
+    def __init__(self: SignalSeries, signal: Signal, retention: float) -> None:
+        self.signal: Signal = signal
+        self.history: dict[str, RingBuffer] = {
+            field: RingBuffer(SIGNAL_CAPACITY, retention) for field in signal.fields
+        }
+        self.time: float = 0.0
+        self.values: Sequence[float] = ()
+        self.clients: set[Subscriber] = set()
+        self._frame: Optional[Frame] = None
+
+    def record(self: SignalSeries, t: float, values: Sequence[float]) -> None:
+        self.time = t
+        self.values = values
+        for history, value in zip(self.history.values(), values):
+            history.push(t, value)
+        self._frame = None
+        for subscriber in self.clients:
+            subscriber.publish(self.render, key=("signal", self.signal.name))
+
+    def render(self: SignalSeries) -> Frame:
+        """The latest values, encoded once for all clients"""
+        if self._frame is None:
+            self._frame = Frame(
+                {
+                    "signal": self.signal.name,
+                    "pair": self.signal.pair,
+                    "time": self.time,
+                    **dict(zip(self.signal.fields, self.values)),
+                }
+            )
+        return self._frame
+
+    def to_columnar(self: SignalSeries) -> dict:
+        payload = {"signal": self.signal.name, "pair": self.signal.pair}
+        for field, history in self.history.items():
+            t, value = history.arrays()
+            payload["time"] = t.tolist()
+            payload[field] = value.tolist()
+        return payload
+
+
+class SignalEngine:
+    """
+    Computes the registered :data:`SIGNALS` of every pair that has been
+    requested, from the books of an :class:`OrderbookHub` and the spread and
+    trade channels of a :class:`ChannelRouter`. The signals of a pair are
+    dropped a while after the last client or request, see
+    :class:`PairUsers`.
+    """
+
+    def __init__(
+        self: SignalEngine,
+        names: Optional[Sequence[str]] = None,
+        retention: float = SIGNAL_RETENTION,
+        release_delay: float = RELEASE_DELAY,
+    ) -> None:
+        self.names: list[str] = list(names if names is not None else SIGNALS)
+        self.retention: float = retention
+        self.hub: Any = None
+        self.router: Any = None
+        self.pairs: dict[str, dict[str, SignalSeries]] = {}
+        # pairs with book updates the book signals have not seen yet, their
+        # book and the messages since the last run
+        self._dirty: dict[str, tuple[Book, list[dict]]] = {}
+        # pair -> the book of the hub and the copy of it the watching
+        # signals read
+        self._mirrors: dict[str, tuple[Book, Book]] = {}
+        self._scheduled: bool = False
+        self.users: PairUsers = PairUsers(self._remove_pair, release_delay)
+        self._adding: dict[str, asyncio.Task] = {}
+
+    def start(self: SignalEngine, hub: Any, router: Any) -> None:
+        self.hub = hub
+        self.router = router
+        if hub.keeps_books:
+            hub.listeners.append(self.on_book_update)
+        else:
+            unavailable = [name for name in self.names if not self.available(name)]
+            logging.warning(
+                "The book signals %s are not computed with sharded order books",
+                ", ".join(unavailable),
+            )
+
+    def serves(self: SignalEngine, name: str) -> bool:
+        return name in self.names
+
+    def available(self: SignalEngine, name: str) -> bool:
+        """Whether a served signal is computed, book signals need local books"""
+        return self.hub.keeps_books or "book" not in SIGNALS[name].streams
+
+    async def series(self: SignalEngine, pair: str) -> dict[str, SignalSeries]:
+        """The signals of ``pair``, subscribed on first use"""
+        series = self.pairs.get(pair)
+        if series is not None:
+            return series
+        if pair not in self._adding:
+            self._adding[pair] = asyncio.ensure_future(self._add_pair(pair))
+        return await asyncio.shield(self._adding[pair])
+
+    async def _add_pair(self: SignalEngine, pair: str) -> dict[str, SignalSeries]:
+        try:
+            await self.users.settled(pair)
+            series = {
+                name: SignalSeries(SIGNALS[name](pair), self.retention)
+                for name in self.names
+                if self.available(name)
+            }
+            streams = {stream for s in series.values() for stream in s.signal.streams}
+            logging.info("Computing the signals of %s", pair)
+            if "book" in streams:
+                self.hub.users.acquire(pair)
+                await self.hub.add_pairs([pair])
+            if "spread" in streams:
+                await self.router.subscribe(self.on_spread, {"name": "spread"}, pair)
+            if "trade" in streams:
+                await self.router.subscribe(self.on_trades, {"name": "trade"}, pair)
+            self.pairs[pair] = series
+            return series
+        finally:
+            del self._adding[pair]
+
+    async def _remove_pair(self: SignalEngine, pair: str) -> None:
+        series = self.pairs.pop(pair, None)
+        if series is None:
+            return
+        self._dirty.pop(pair, None)
+        self._mirrors.pop(pair, None)
+        streams = {stream for s in series.values() for stream in s.signal.streams}
+        logging.info("Dropping the signals of %s", pair)
+        if "book" in streams:
+            self.hub.users.release(pair)
+        if "spread" in streams:
+            await self.router.unsubscribe(self.on_spread, {"name": "spread"}, pair)
+        if "trade" in streams:
+            await self.router.unsubscribe(self.on_trades, {"name": "trade"}, pair)
+
+    def _signals(self: SignalEngine, pair: str, stream: str) -> list[SignalSeries]:
+        return [
+            s for s in self.pairs.get(pair, {}).values() if stream in s.signal.streams
+        ]
+
+    def on_book_update(
+        self: SignalEngine, pair: str, state: Any, book: Book, message: dict
+    ) -> None:
+        if pair not in self.pairs:
+            return
+        dirty = self._dirty.get(pair)
+        if dirty is None or dirty[0] is not book:
+            dirty = self._dirty[pair] = (book, [])
+        if message["type"] == "snapshot":
+            # replaces the levels of the messages before it
+            dirty[1].clear()
+        dirty[1].append(message)
+        if not self._scheduled:
+            self._scheduled = True
+            asyncio.get_running_loop().call_soon(self._run_book_signals)
+
+    def _run_book_signals(self: SignalEngine) -> None:
+        self._scheduled = False
+        dirty, self._dirty = self._dirty, {}
+        t = time.time()
+        for pair, (book, messages) in dirty.items():
+            signals = self._signals(pair, "book")
+            mirror = None
+            if any(series.signal.watches_book for series in signals):
+                mirror = self._mirror(pair, book, messages)
+            for series in signals:
+                values = series.signal.on_book(
+                    mirror if series.signal.watches_book else book, t
+                )
+                if values is not None:
+                    series.record(t, values)
+
+    def _mirror(
+        self: SignalEngine, pair: str, book: Book, messages: list[dict]
+    ) -> Book:
+        """The copy of the book of ``pair`` brought up to date with ``messages``"""
+        source, mirror = self._mirrors.get(pair, (None, None))
+        if source is book:
+            for message in messages:
+                mirror.apply(message)
+        else:
+            # the first run or a new subscription, the copy includes the
+            # messages
+            mirror = book.copy()
+            self._mirrors[pair] = (book, mirror)
+        return mirror
+
+    def on_spread(self: SignalEngine, pair: str, payload: list) -> None:
+        # [bid, ask, time, bid volume, ask volume]
+        t = float(payload[2])
+        bid, ask = float(payload[0]), float(payload[1])
+        bid_volume, ask_volume = float(payload[3]), float(payload[4])
+        for series in self._signals(pair, "spread"):
+            values = series.signal.on_spread(t, bid, ask, bid_volume, ask_volume)
+            if values is not None:
+                series.record(t, values)
+
+    def on_trades(self: SignalEngine, pair: str, trades: list) -> None:
+        # [price, volume, time, side, order type, misc]
+        price = np.array([trade[0] for trade in trades], dtype=np.float64)
+        volume = np.array([trade[1] for trade in trades], dtype=np.float64)
+        t = np.array([trade[2] for trade in trades], dtype=np.float64)
+        volume[[trade[3] != "b" for trade in trades]] *= -1
+        for series in self._signals(pair, "trade"):
+            values = series.signal.on_trades(t, price, volume)
+            if values is not None:
+                series.record(float(t[-1]), values)
+
+    async def get_history(self: SignalEngine, name: str, pair: str) -> dict:
+        series = await self.series(pair)
+        self.users.touch(pair)
+        return series[name].to_columnar()
+
+    async def serve(self: SignalEngine, ws: Any, name: str, pair: str) -> None:
+        """Streams one signal of ``pair`` at the rate of the signal"""
+        await ws.accept()
+        subscriber = Subscriber(ws, max_rate=SIGNALS[name].max_rate, stream="signals")
+        subscriber.start()
+        series = None
+        self.users.acquire(pair)
+        try:
+            series = (await self.series(pair))[name]
+            series.clients.add(subscriber)
+            if series.values:
+                subscriber.publish(series.render, key=("signal", name))
+            while True:
+                await ws.receive_text()
+        except WebSocketDisconnect:
+            pass
+        finally:
+            if series is not None:
+                series.clients.discard(subscriber)
+            self.users.release(pair)
+            subscriber.close()
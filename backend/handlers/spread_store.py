@@ -0,0 +1,350 @@
+"""
+Spread history of a pair, kept from the Kraken ``spread`` channel.
+
+Quotes (time, bid, ask, bid volume, ask volume) are kept in a ring of
+preallocated columns. For each of the :data:`WINDOWS` the store updates on
+every quote, in amortized O(1):
+
+- mean and max spread of the quotes in the window (the max from a monotonic
+  queue of quote numbers)
+- time-weighted spread, every quote weighted by how long it stood
+- quote updates per second
+
+Windows are relative to the time of the latest quote.
+:meth:`SpreadStore.history` downsamples a time range to min/max/last of the
+spread per time bucket, so an hour of quotes fits a few hundred points.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, Callable, Optional
+
+import numpy as np
+
+from handlers.channels import pair_key
+from handlers.pairs import RELEASE_DELAY, PairUsers
+
+# seconds of the rolling statistics
+WINDOWS = (1, 60, 300)
+SPREAD_CAPACITY = 262_144
+# default and maximum buckets of a history
+HISTORY_POINTS = 500
+# bid, ask, bid volume, ask volume
+COLUMNS = ("bid", "ask", "bid_volume", "ask_volume")
+# seconds a quote is taken for the current best bid and ask
+QUOTE_MAX_AGE = 5.0
+
+
+class SpreadWindow:
+    """Running sums of the quotes of the last ``seconds``, the oldest is ``tail``"""
+
+    def __init__(self: SpreadWindow, seconds: int) -> None:
+        self.seconds: int = seconds
+        self.tail: int = 0
+        self.sum: float = 0.0
+        # spread * seconds of the quotes that were followed by another one
+        self.weighted: float = 0.0
+        # quote numbers of decreasing spread, the max first
+        self.max_queue: deque[int] = deque()
+
+
+class SpreadStore:
+    """Quotes and rolling statistics of a single pair"""
+
+    def __init__(self: SpreadStore, pair: str, capacity: int = SPREAD_CAPACITY) -> None:
+        self.pair: str = pair
+        self.capacity: int = capacity
+        self.time = np.zeros(capacity, dtype=np.float64)
+        self.spread = np.zeros(capacity, dtype=np.float64)
+        self.columns: dict[str, np.ndarray] = {
+            name: np.zeros(capacity, dtype=np.float64) for name in COLUMNS
+        }
+        # quotes pushed so far, quote n is at n % capacity
+        self.pushed: int = 0
+        self.windows: list[SpreadWindow] = [SpreadWindow(s) for s in WINDOWS]
+
+    def __len__(self: SpreadStore) -> int:
+        return min(self.pushed, self.capacity)
+
+    def on_message(self: SpreadStore, payload: list) -> None:
+        """Applies a Kraken ``spread`` message payload"""
+        # [bid, ask, time, bid volume, ask volume]
+        self.push(
+            float(payload[2]),
+            float(payload[0]),
+            float(payload[1]),
+            float(payload[3]),
+            float(payload[4]),
+        )
+
+    def push(
+        self: SpreadStore,
+        t: float,
+        bid: float,
+        ask: float,
+        bid_volume: float,
+        ask_volume: float,
+    ) -> None:
+        n = self.pushed
+        if n and t < self.time[(n - 1) % self.capacity]:
+            # keeps the times sorted
+            t = float(self.time[(n - 1) % self.capacity])
+        # the quote about to be overwritten leaves the windows first
+        for window in self.windows:
+            if window.tail <= n - self.capacity:
+                self._evict(window, n - self.capacity + 1)
+
+        spread = ask - bid
+        if n:
+            previous = (n - 1) % self.capacity
+            held = float((t - self.time[previous]) * self.spread[previous])
+        i = n % self.capacity
+        self.time[i] = t
+        self.spread[i] = spread
+        for name, value in zip(COLUMNS, (bid, ask, bid_volume, ask_volume)):
+            self.columns[name][i] = value
+        self.pushed = n + 1
+
+        for window in self.windows:
+            window.sum += spread
+            if n and window.tail < n:
+                window.weighted += held
+            queue = window.max_queue
+            while queue and self.spread[queue[-1] % self.capacity] <= spread:
+                queue.pop()
+            queue.append(n)
+            self._evict(window, self._find(window.tail, t - window.seconds))
+
+    def _find(self: SpreadStore, start: int, cutoff: float) -> int:
+        """The first quote from ``start`` on that is newer than ``cutoff``"""
+        stop = self.pushed
+        if start < stop and self.time[start % self.capacity] > cutoff:
+            # nothing to evict, the common case
+            return start
+        while start < stop:
+            i = start % self.capacity
+            chunk = self.time[i : i + min(stop - start, self.capacity - i)]
+            found = int(np.searchsorted(chunk, cutoff, side="right"))
+            if found < len(chunk):
+                return start + found
+            start += len(chunk)
+        return stop
+
+    def _evict(self: SpreadStore, window: SpreadWindow, stop: int) -> None:
+        """Takes the quotes before ``stop`` out of ``window``"""
+        if stop <= window.tail:
+            return
+        capacity = self.capacity
+        if stop - window.tail < 8:
+            time, spread = self.time, self.spread
+            for n in range(window.tail, stop):
+                value = float(spread[n % capacity])
+                window.sum -= value
+                if n + 1 < self.pushed:
+                    # how long the quote stood, up to the next one
+                    held = time[(n + 1) % capacity] - time[n % capacity]
+                    window.weighted -= float(held) * value
+        else:
+            index = np.arange(window.tail, stop) % capacity
+            window.sum -= float(self.spread[index].sum())
+            after = np.arange(window.tail + 1, stop + 1) % capacity
+            held = self.time[after] - self.time[index]
+            if stop == self.pushed:
+                held[-1] = 0
+            window.weighted -= float(held @ self.spread[index])
+        window.tail = stop
+        queue = window.max_queue
+        while queue and queue[0] < stop:
+            queue.popleft()
+        if window.tail == self.pushed:
+            # no residue of the float sums in an empty window
+            window.sum = window.weighted = 0.0
+
+    def quote(
+        self: SpreadStore,
+        max_age: Optional[float] = None,
+        now: Optional[float] = None,
+    ) -> Optional[tuple[float, float]]:
+        """
+        Best bid and ask of the latest quote, ``None`` if its (exchange) time
+        is more than ``max_age`` seconds before ``now``
+        """
+        if not self.pushed:
+            return None
+        i = (self.pushed - 1) % self.capacity
+        if max_age is not None:
+            now = time.time() if now is None else now
+            if now - float(self.time[i]) > max_age:
+                return None
+        return float(self.columns["bid"][i]), float(self.columns["ask"][i])
+
+    def stats(self: SpreadStore) -> dict:
+        """Statistics of every window as of the latest quote"""
+        if not self.pushed:
+            return {}
+        last = (self.pushed - 1) % self.capacity
+        now = float(self.time[last])
+        stats = {}
+        for window in self.windows:
+            count = self.pushed - window.tail
+            if not count:
+                continue
+            first = float(self.time[window.tail % self.capacity])
+            # from the oldest quote of the window to the latest
+            duration = now - first
+            stats[str(window.seconds)] = {
+                "mean": window.sum / count,
+                "max": float(self.spread[window.max_queue[0] % self.capacity]),
+                "time_weighted": (
+                    window.weighted / duration
+                    if duration > 0
+                    else float(self.spread[last])
+                ),
+                "rate": count / window.seconds,
+            }
+        return stats
+
+    def arrays(self: SpreadStore, start: float, end: float) -> tuple[np.ndarray, ...]:
+        """Time, spread and the columns of the quotes in ``[start, end)``"""
+        count = len(self)
+        first = self.pushed - count
+        lo = self._find(first, np.nextafter(start, -np.inf))
+        hi = self._find(lo, np.nextafter(end, -np.inf))
+        index = np.arange(lo, hi) % self.capacity
+        return (
+            self.time[index],
+            self.spread[index],
+            *(self.columns[name][index] for name in COLUMNS),
+        )
+
+    def history(
+        self: SpreadStore,
+        points: int = HISTORY_POINTS,
+        seconds: Optional[float] = None,
+        end: Optional[float] = None,
+    ) -> dict:
+        """
+        The quotes of the last ``seconds`` up to ``end`` (the latest quote by
+        default) in at most ``points`` time buckets: min, max and last spread
+        and the last bid and ask of every bucket with quotes. ``points`` is
+        clamped to ``[1, HISTORY_POINTS]``.
+        """
+        points = min(max(points, 1), HISTORY_POINTS)
+        payload: dict[str, Any] = {
+            "pair": self.pair,
+            "stats": self.stats(),
+        }
+        if end is None and self.pushed:
+            end = float(self.time[(self.pushed - 1) % self.capacity])
+        if seconds is None and self.pushed:
+            seconds = end - float(self.time[(self.pushed - len(self)) % self.capacity])
+        if not self.pushed or not seconds:
+            return {**payload, "time": [], "min": [], "max": [], "last": []}
+        start = end - seconds
+        t, spread, bid, ask, _, _ = self.arrays(start, np.nextafter(end, np.inf))
+        if not len(t):
+            return {**payload, "time": [], "min": [], "max": [], "last": []}
+        width = max(seconds, 1e-9) / points
+        bucket = np.minimum(((t - start) / width).astype(np.int64), points - 1)
+        # first quote of each bucket that has quotes
+        first = np.flatnonzero(np.diff(bucket, prepend=-1))
+        last = np.append(first[1:], len(t)) - 1
+        return {
+            **payload,
+            "bucket": width,
+            "time": (start + bucket[first] * width).tolist(),
+            "min": np.minimum.reduceat(spread, first).tolist(),
+            "max": np.maximum.reduceat(spread, first).tolist(),
+            "last": spread[last].tolist(),
+            "bid": bid[last].tolist(),
+            "ask": ask[last].tolist(),
+        }
+
+
+class SpreadHub:
+    """
+    Spread stores of every pair from one ``spread`` subscription per pair.
+    Pairs other than the ones the hub was started with are dropped a while
+    after the last request, see :class:`PairUsers`.
+    """
+
+    def __init__(
+        self: SpreadHub,
+        capacity: int = SPREAD_CAPACITY,
+        release_delay: float = RELEASE_DELAY,
+    ) -> None:
+        self.capacity: int = capacity
+        self.router: Any = None
+        self.stores: dict[str, SpreadStore] = {}
+        # pair_key() of every recorded pair -> its store
+        self._keys: dict[str, SpreadStore] = {}
+        self.users: PairUsers = PairUsers(self._remove_pair, release_delay)
+        self._listeners: dict[str, Callable] = {}
+        self._adding: dict[str, asyncio.Task] = {}
+
+    async def start(self: SpreadHub, router: Any, pairs: list[str]) -> None:
+        """Starts recording the spread of ``pairs``, others start on first use"""
+        self.router = router
+        self.users.pin(pairs)
+        for pair in pairs:
+            await self.store(pair)
+
+    async def store(self: SpreadHub, pair: str) -> SpreadStore:
+        store = self.stores.get(pair)
+        if store is not None:
+            return store
+        if pair not in self._adding:
+            self._adding[pair] = asyncio.ensure_future(self._add_pair(pair))
+        return await asyncio.shield(self._adding[pair])
+
+    async def _add_pair(self: SpreadHub, pair: str) -> SpreadStore:
+        try:
+            await self.users.settled(pair)
+            store = SpreadStore(pair, self.capacity)
+            logging.info("Recording the spread of %s", pair)
+            listener = self._listeners[pair] = self._listener(store)
+            await self.router.subscribe(listener, {"name": "spread"}, pair)
+            self.stores[pair] = self._keys[pair_key(pair)] = store
+            return store
+        finally:
+            del self._adding[pair]
+
+    async def _remove_pair(self: SpreadHub, pair: str) -> None:
+        store = self.stores.pop(pair, None)
+        if store is not None and self._keys.get(pair_key(pair)) is store:
+            del self._keys[pair_key(pair)]
+        listener = self._listeners.pop(pair, None)
+        if listener is not None:
+            logging.info("Dropping the spread of %s", pair)
+            await self.router.unsubscribe(listener, {"name": "spread"}, pair)
+
+    def _listener(self: SpreadHub, store: SpreadStore) -> Callable:
+        def on_message(pair: str, payload: list) -> None:
+            store.on_message(payload)
+
+        return on_message
+
+    def quote(
+        self: SpreadHub, pair: str, max_age: Optional[float] = QUOTE_MAX_AGE
+    ) -> Optional[tuple[float, float]]:
+        """
+        Best bid and ask of ``pair`` in any notation, ``None`` if its spread
+        is not recorded (yet) or the latest quote is older than ``max_age``
+        seconds
+        """
+        store = self._keys.get(pair_key(pair))
+        return store.quote(max_age) if store is not None else None
+
+    async def get_history(
+        self: SpreadHub,
+        pair: str,
+        points: int = HISTORY_POINTS,
+        seconds: Optional[float] = None,
+    ) -> dict:
+        store = await self.store(pair)
+        self.users.touch(pair)
+        return store.history(points, seconds)
@@ -21,12 +21,12 @@ api_url = "https://api.kraken.com"
 
 
 # Attaches auth headers and returns results of a POST request
-def kraken_request(uri_path, data, api_key, api_sec):
+def kraken_request(uri_path, data, api_key, api_sec, url=api_url):
     headers = {}
     headers["API-Key"] = api_key
     # get_kraken_signature() as defined in the 'Authentication' section
     headers["API-Sign"] = get_kraken_signature(uri_path, data, api_sec)
-    req = requests.post((api_url + uri_path), headers=headers, data=data)
+    req = requests.post((url + uri_path), headers=headers, data=data)
     return req
 
 
@@ -36,5 +36,6 @@ def get_token(config):
         {"nonce": str(int(1000 * time.time()))},
         config("WS_API_KEY", cast=str),
         config("WS_SECRET_KEY", cast=str),
+        url=config("KRAKEN_REST_URL", cast=str, default="") or api_url,
     )
     return resp.json()
@@ -0,0 +1,482 @@
+"""
+Aggregates of the public trades of a pair.
+
+One ``trade`` subscription per pair feeds a :class:`TradeFlow`:
+
+- cumulative volume delta (buy minus sell volume) of the session, which
+  starts at 00:00 UTC, and of the rolling :data:`CVD_WINDOWS`
+- volume profile, buy and sell volume per price bucket, of the session and
+  of the last :data:`PROFILE_WINDOW` seconds
+- footprint, buy and sell volume per price bucket of every
+  :data:`FOOTPRINT_INTERVAL` candle
+
+The trades of the rolling windows are kept in a ring of preallocated
+columns; a window only remembers the oldest trade it still contains, trades
+leaving it are taken out of its sums. Profiles are arrays over the traded
+price range that grow when the price leaves it.
+
+Clients never get the trades themselves. Every profile bucket carries the
+update it last changed at, so a frame only holds the buckets that changed
+since the previous frame sent to that client (:class:`TradeFlowStream`).
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+from collections import deque
+from typing import Any, Callable, Optional
+
+import numpy as np
+from starlette.websockets import WebSocketDisconnect
+
+from handlers.broadcast import Frame, Subscriber
+from handlers.heatmap import nice_step
+from handlers.pairs import RELEASE_DELAY, PairUsers
+
+# seconds of the rolling cumulative volume deltas and of the rolling profile
+CVD_WINDOWS = (60, 300, 900)
+PROFILE_WINDOW = 3600
+# trades kept for the rolling windows; when they don't fit the oldest leave
+# the windows early
+TRADE_CAPACITY = 262_144
+# seconds per footprint candle and closed candles kept
+FOOTPRINT_INTERVAL = 60
+FOOTPRINT_CAPACITY = 240
+SESSION = 24 * 60 * 60
+
+
+class PriceProfile:
+    """Buy and sell volume per price bucket"""
+
+    def __init__(self: PriceProfile, size: int = 256) -> None:
+        self.buy = np.zeros(size, dtype=np.float64)
+        self.sell = np.zeros(size, dtype=np.float64)
+        # update of the last change of every bucket
+        self.changed = np.zeros(size, dtype=np.int64)
+        # bucket of index 0, and the indices that ever held volume
+        self.base: Optional[int] = None
+        self.lo: int = 0
+        self.hi: int = 0
+
+    def _reserve(self: PriceProfile, first: int, last: int) -> None:
+        """Grows the arrays to hold the buckets ``first`` to ``last``"""
+        if self.base is None:
+            self.base = first - (len(self.buy) - (last - first + 1)) // 2
+            self.lo = self.hi = first - self.base
+        lo = min(first - self.base, self.lo)
+        hi = max(last - self.base + 1, self.hi)
+        if lo >= 0 and hi <= len(self.buy):
+            return
+        size = len(self.buy)
+        while size < 2 * (hi - lo):
+            size *= 2
+        # the used range centered in the new arrays
+        shift = (size - (hi - lo)) // 2 - lo
+        for name in ("buy", "sell", "changed"):
+            old = getattr(self, name)
+            new = np.zeros(size, dtype=old.dtype)
+            new[self.lo + shift : self.hi + shift] = old[self.lo : self.hi]
+            setattr(self, name, new)
+        self.base -= shift
+        self.lo += shift
+        self.hi += shift
+
+    def add(
+        self: PriceProfile,
+        buckets: np.ndarray,
+        volumes: np.ndarray,
+        seq: int,
+        sign: int = 1,
+    ) -> None:
+        """
+        Adds trades, positive volumes are buys and negative ones sells. With
+        a ``sign`` of -1 trades added before are taken out.
+        """
+        if not len(buckets):
+            return
+        first, last = int(buckets.min()), int(buckets.max())
+        self._reserve(first, last)
+        index = buckets - self.base
+        buy = volumes > 0
+        np.add.at(self.buy, index[buy], sign * volumes[buy])
+        np.add.at(self.sell, index[~buy], -sign * volumes[~buy])
+        self.changed[index] = seq
+        if sign < 0:
+            # rounding residue of emptied buckets
+            for side in (self.buy, self.sell):
+                side[index[side[index] < 1e-12]] = 0
+        self.lo = min(self.lo, first - self.base)
+        self.hi = max(self.hi, last - self.base + 1)
+
+    def to_payload(
+        self: PriceProfile, bucket: float, since: Optional[int] = None
+    ) -> dict:
+        """
+        The buckets with volume, or with ``since`` the buckets changed after
+        that update, by ascending price.
+        """
+        rows = slice(self.lo, self.hi)
+        if since is None:
+            index = np.flatnonzero((self.buy[rows] > 0) | (self.sell[rows] > 0))
+        else:
+            index = np.flatnonzero(self.changed[rows] > since)
+        index += self.lo
+        return {
+            "price": np.round((index + (self.base or 0)) * bucket, 10).tolist(),
+            "buy": self.buy[index].tolist(),
+            "sell": self.sell[index].tolist(),
+        }
+
+
+class RollingWindow:
+    """Sums of the trades of the last ``seconds``, the oldest is ``tail``"""
+
+    def __init__(self: RollingWindow, seconds: int, profile: bool = False) -> None:
+        self.seconds: int = seconds
+        self.tail: int = 0
+        self.cvd: float = 0.0
+        self.profile: Optional[PriceProfile] = PriceProfile() if profile else None
+
+
+class TradeFlow:
+    """Trade aggregates of a single pair, see the module documentation"""
+
+    def __init__(
+        self: TradeFlow,
+        pair: str,
+        bucket: Optional[float] = None,
+        capacity: int = TRADE_CAPACITY,
+    ) -> None:
+        self.pair: str = pair
+        # price per profile bucket, about a basis point of the first price if None
+        self.bucket: Optional[float] = bucket
+        self.capacity: int = capacity
+        self.time = np.zeros(capacity, dtype=np.float64)
+        self.buckets = np.zeros(capacity, dtype=np.int64)
+        self.volume = np.zeros(capacity, dtype=np.float64)
+        # trades pushed so far, trade n is at n % capacity
+        self.pushed: int = 0
+        self.windows: list[RollingWindow] = [
+            RollingWindow(seconds) for seconds in CVD_WINDOWS
+        ]
+        self.profile_window = RollingWindow(PROFILE_WINDOW, profile=True)
+        self.windows.append(self.profile_window)
+
+        # updates applied, and how many of them reset the session
+        self.seq: int = 0
+        self.session_id: int = 0
+        self.session: Optional[float] = None
+        self.session_cvd: float = 0.0
+        self.session_trades: int = 0
+        self.session_profile = PriceProfile()
+
+        self.candle: Optional[float] = None
+        self.footprint = PriceProfile()
+        # closed candles: (time, first bucket, buy, sell)
+        self.closed: deque[tuple] = deque(maxlen=FOOTPRINT_CAPACITY)
+
+        self.last_price: float = 0.0
+        self.last_time: float = 0.0
+        self.clients: dict[Subscriber, TradeFlowStream] = {}
+
+    def on_message(self: TradeFlow, trades: list) -> None:
+        """Applies a Kraken ``trade`` message payload"""
+        # [price, volume, time, side, order type, misc]
+        price = np.array([trade[0] for trade in trades], dtype=np.float64)
+        volume = np.array([trade[1] for trade in trades], dtype=np.float64)
+        t = np.array([trade[2] for trade in trades], dtype=np.float64)
+        volume[[trade[3] != "b" for trade in trades]] *= -1
+        if self.bucket is None:
+            self.bucket = float(nice_step(price[0] * 1e-4))
+        buckets = np.floor(price / self.bucket + 1e-9).astype(np.int64)
+
+        self.seq += 1
+        # a message may cross midnight or the end of a candle
+        start = 0
+        while start < len(t):
+            first = float(t[start])
+            session = first - first % SESSION
+            candle = first - first % FOOTPRINT_INTERVAL
+            if session != self.session:
+                self._start_session(session)
+            if candle != self.candle:
+                self._close_candle(candle)
+            stop = start + int(
+                np.searchsorted(t[start:], candle + FOOTPRINT_INTERVAL, side="left")
+            )
+            self._apply(buckets[start:stop], volume[start:stop], t[start:stop])
+            start = stop
+
+        self.last_price = float(price[-1])
+        self.last_time = float(t[-1])
+        self._expire(self.last_time)
+        for subscriber, stream in self.clients.items():
+            subscriber.publish(stream.render, key=("trade_flow", self.pair))
+
+    def _start_session(self: TradeFlow, session: float) -> None:
+        self.session = session
+        self.session_id += 1
+        self.session_cvd = 0.0
+        self.session_trades = 0
+        self.session_profile = PriceProfile()
+
+    def _close_candle(self: TradeFlow, candle: float) -> None:
+        footprint = self.footprint
+        if self.candle is not None and footprint.hi > footprint.lo:
+            rows = slice(footprint.lo, footprint.hi)
+            self.closed.append(
+                (
+                    self.candle,
+                    footprint.base + footprint.lo,
+                    footprint.buy[rows].copy(),
+                    footprint.sell[rows].copy(),
+                )
+            )
+        self.candle = candle
+        self.footprint = PriceProfile()
+
+    def _apply(
+        self: TradeFlow, buckets: np.ndarray, volume: np.ndarray, t: np.ndarray
+    ) -> None:
+        seq = self.seq
+        total = float(volume.sum())
+        self.session_cvd += total
+        self.session_trades += len(volume)
+        self.session_profile.add(buckets, volume, seq)
+        self.footprint.add(buckets, volume, seq)
+
+        # trades about to be overwritten leave the windows first
+        overwritten = self.pushed + len(volume) - self.capacity
+        for window in self.windows:
+            if window.tail < overwritten:
+                self._evict(window, overwritten)
+        self._push(buckets, volume, t)
+        for window in self.windows:
+            window.cvd += total
+            if window.profile is not None:
+                window.profile.add(buckets, volume, seq)
+
+    def _push(
+        self: TradeFlow, buckets: np.ndarray, volume: np.ndarray, t: np.ndarray
+    ) -> None:
+        # at most ``capacity`` trades
+        n = len(volume)
+        i = self.pushed % self.capacity
+        first = min(n, self.capacity - i)
+        for column, values in (
+            (self.time, t),
+            (self.buckets, buckets),
+            (self.volume, volume),
+        ):
+            column[i : i + first] = values[:first]
+            column[: n - first] = values[first:]
+        self.pushed += n
+
+    def _find(self: TradeFlow, start: int, cutoff: float) -> int:
+        """The first trade from ``start`` on that is newer than ``cutoff``"""
+        stop = self.pushed
+        while start < stop:
+            i = start % self.capacity
+            chunk = self.time[i : i + min(stop - start, self.capacity - i)]
+            found = int(np.searchsorted(chunk, cutoff, side="right"))
+            if found < len(chunk):
+                return start + found
+            start += len(chunk)
+        return stop
+
+    def _trades(
+        self: TradeFlow, start: int, stop: int
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Buckets and volumes of the trades ``start`` to ``stop``"""
+        index = np.arange(start, stop) % self.capacity
+        return self.buckets[index], self.volume[index]
+
+    def _evict(self: TradeFlow, window: RollingWindow, stop: int) -> None:
+        buckets, volume = self._trades(window.tail, stop)
+        window.cvd -= float(volume.sum())
+        if window.profile is not None:
+            window.profile.add(buckets, volume, self.seq, sign=-1)
+        window.tail = stop
+        if window.tail == self.pushed:
+            # no residue of the float sums in an empty window
+            window.cvd = 0.0
+
+    def _expire(self: TradeFlow, now: float) -> None:
+        for window in self.windows:
+            stop = self._find(window.tail, now - window.seconds)
+            if stop > window.tail:
+                self._evict(window, stop)
+
+    def cvd(self: TradeFlow) -> dict:
+        return {
+            "session": self.session_cvd,
+            **{str(window.seconds): window.cvd for window in self.windows[:-1]},
+        }
+
+    def closed_footprints(self: TradeFlow, since: Optional[float] = None) -> list[dict]:
+        """The closed candles starting at or after ``since``"""
+        return [
+            {
+                "time": candle,
+                "price": np.round(
+                    (np.arange(len(buy)) + first) * self.bucket, 10
+                ).tolist(),
+                "buy": buy.tolist(),
+                "sell": sell.tolist(),
+            }
+            for candle, first, buy, sell in self.closed
+            if since is None or candle >= since
+        ]
+
+    def to_payload(
+        self: TradeFlow,
+        since: Optional[int] = None,
+        candle: Optional[float] = None,
+    ) -> dict:
+        """
+        All aggregates, or with ``since`` the buckets changed after that
+        update. ``candle`` is the footprint candle the client has, the
+        candles closed since then are included in full.
+        """
+        footprint_since = since if candle == self.candle else None
+        closed = (
+            self.closed_footprints(candle)
+            if since is None or candle != self.candle
+            else []
+        )
+        return {
+            "event": "snapshot" if since is None else "delta",
+            "pair": self.pair,
+            "seq": self.seq,
+            "base": since or 0,
+            "bucket": self.bucket,
+            "session": self.session,
+            "time": self.last_time,
+            "price": self.last_price,
+            "trades": self.session_trades,
+            "cvd": self.cvd(),
+            "profile": {
+                "session": self.session_profile.to_payload(self.bucket, since),
+                str(PROFILE_WINDOW): self.profile_window.profile.to_payload(
+                    self.bucket, since
+                ),
+            },
+            "footprint": {
+                "time": self.candle,
+                **self.footprint.to_payload(self.bucket, footprint_since),
+            },
+            "closed": closed,
+        }
+
+
+class TradeFlowStream:
+    """
+    Per client encoder of a :class:`TradeFlow`, remembers the update and
+    candle last sent. The first frame, and the first of a new session, is a
+    snapshot with all buckets.
+    """
+
+    def __init__(self: TradeFlowStream, flow: TradeFlow) -> None:
+        self.flow: TradeFlow = flow
+        self.seq: Optional[int] = None
+        self.session_id: int = 0
+        self.candle: Optional[float] = None
+
+    def render(self: TradeFlowStream) -> Optional[Frame]:
+        flow = self.flow
+        if flow.seq == 0 or flow.seq == self.seq:
+            return None
+        since = self.seq if self.session_id == flow.session_id else None
+        payload = flow.to_payload(since, self.candle if since is not None else None)
+        self.seq = flow.seq
+        self.session_id = flow.session_id
+        self.candle = flow.candle
+        return Frame(payload)
+
+
+class TradeFlowHub:
+    """
+    Trade aggregates of every pair from one ``trade`` subscription per pair,
+    created on first use and dropped a while after the last client or
+    request, see :class:`PairUsers`.
+    """
+
+    def __init__(
+        self: TradeFlowHub,
+        bucket: Optional[float] = None,
+        capacity: int = TRADE_CAPACITY,
+        max_rate: Optional[float] = None,
+        release_delay: float = RELEASE_DELAY,
+    ) -> None:
+        self.bucket: Optional[float] = bucket
+        self.capacity: int = capacity
+        self.max_rate: Optional[float] = max_rate
+        self.router: Any = None
+        self.flows: dict[str, TradeFlow] = {}
+        self.users: PairUsers = PairUsers(self._remove_pair, release_delay)
+        self._listeners: dict[str, Callable] = {}
+        self._adding: dict[str, asyncio.Task] = {}
+
+    def start(self: TradeFlowHub, router: Any) -> None:
+        self.router = router
+
+    async def flow(self: TradeFlowHub, pair: str) -> TradeFlow:
+        """The aggregates of ``pair``, subscribed on first use"""
+        flow = self.flows.get(pair)
+        if flow is not None:
+            return flow
+        if pair not in self._adding:
+            self._adding[pair] = asyncio.ensure_future(self._add_pair(pair))
+        return await asyncio.shield(self._adding[pair])
+
+    async def _add_pair(self: TradeFlowHub, pair: str) -> TradeFlow:
+        try:
+            await self.users.settled(pair)
+            flow = TradeFlow(pair, self.bucket, self.capacity)
+            logging.info("Aggregating the trades of %s", pair)
+            listener = self._listeners[pair] = self._listener(flow)
+            await self.router.subscribe(listener, {"name": "trade"}, pair)
+            self.flows[pair] = flow
+            return flow
+        finally:
+            del self._adding[pair]
+
+    async def _remove_pair(self: TradeFlowHub, pair: str) -> None:
+        self.flows.pop(pair, None)
+        listener = self._listeners.pop(pair, None)
+        if listener is not None:
+            logging.info("Dropping the trade aggregates of %s", pair)
+            await self.router.unsubscribe(listener, {"name": "trade"}, pair)
+
+    def _listener(self: TradeFlowHub, flow: TradeFlow) -> Callable:
+        def on_message(pair: str, payload: list) -> None:
+            flow.on_message(payload)
+
+        return on_message
+
+    async def get_payload(self: TradeFlowHub, pair: str) -> dict:
+        flow = await self.flow(pair)
+        self.users.touch(pair)
+        return flow.to_payload()
+
+    async def serve(self: TradeFlowHub, ws: Any, pair: str) -> None:
+        """Streams the aggregate changes of ``pair`` to a client"""
+        await ws.accept()
+        subscriber = Subscriber(ws, max_rate=self.max_rate, stream="trade_flow")
+        subscriber.start()
+        flow = None
+        self.users.acquire(pair)
+        try:
+            flow = await self.flow(pair)
+            stream = flow.clients[subscriber] = TradeFlowStream(flow)
+            subscriber.publish(stream.render, key=("trade_flow", pair))
+            while True:
+                await ws.receive_text()
+        except WebSocketDisconnect:
+            pass
+        finally:
+            if flow is not None:
+                flow.clients.pop(subscriber, None)
+            self.users.release(pair)
+            subscriber.close()
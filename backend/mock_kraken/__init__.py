@@ -0,0 +1,33 @@
+"""
+Local stand-in for the Kraken exchange, for deterministic load tests.
+
+Serves the REST endpoints the backend uses (AssetPairs, Ticker, OHLC,
+Balance, OpenOrders, OpenPositions, GetWebSocketsToken, AddOrder,
+CancelOrder, CancelAll) and the websocket APIs:
+
+- ``/public/v2``: v2 ``book`` channel with valid checksums,
+- ``/public``: v1 ``book-N``, ``spread``, ``trade`` and ``ohlc-N`` channels,
+- ``/private``: v1 ``ownTrades`` and ``openOrders`` channels and the
+  ``addOrder``, ``cancelOrder`` and ``cancelAll`` events.
+
+Market data is synthetic (``--rate`` book updates per second and pair) or
+replayed from a recording of the backend (``--replay``, see ``RECORD_DIR``).
+Orders of the single mock account trade against the synthetic books.
+
+The Kraken client always connects with ``wss://``, so the mock is served
+over TLS with a self-signed certificate. Run from the backend directory::
+
+    openssl req -x509 -newkey rsa:2048 -nodes -days 365 -subj /CN=localhost \\
+        -addext subjectAltName=DNS:localhost,IP:127.0.0.1 \\
+        -keyout mock-key.pem -out mock-cert.pem
+    python -m mock_kraken --port 8100 --pairs BTC/USD --rate 200 \\
+        --ssl-certfile mock-cert.pem --ssl-keyfile mock-key.pem
+
+and point the backend at it in ``.env``::
+
+    KRAKEN_REST_URL=https://localhost:8100
+    KRAKEN_WS_URL=localhost:8100
+    KRAKEN_CA_FILE=mock-cert.pem
+
+The mock accepts any API key, the secret only has to be valid base64.
+"""
@@ -0,0 +1,50 @@
+import argparse
+import logging
+
+import uvicorn
+
+import mock_kraken
+from mock_kraken.server import MockKraken, create_app
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=mock_kraken.__doc__.strip().splitlines()[0],
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--pairs", nargs="*", default=["BTC/USD"])
+    parser.add_argument(
+        "--rate", type=float, default=100.0, help="book updates per second and pair"
+    )
+    parser.add_argument("--depth", type=int, default=1000, help="levels per side")
+    parser.add_argument("--trade-probability", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--replay", default=None, help="recording directory")
+    parser.add_argument("--speed", default="1", help="max or a replay speed factor")
+    parser.add_argument("--ssl-certfile", default=None)
+    parser.add_argument("--ssl-keyfile", default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    mock = MockKraken(
+        args.pairs,
+        rate=args.rate,
+        depth=args.depth,
+        trade_probability=args.trade_probability,
+        seed=args.seed,
+        replay=args.replay,
+        speed=None if args.speed == "max" else float(args.speed),
+    )
+    uvicorn.run(
+        create_app(mock),
+        host=args.host,
+        port=args.port,
+        ssl_certfile=args.ssl_certfile,
+        ssl_keyfile=args.ssl_keyfile,
+        log_level="warning",
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+from __future__ import annotations
+
+import itertools
+from typing import Any, Callable, Optional
+
+from mock_kraken.market import SyntheticMarket, pair_key
+
+FEE = 0.0026
+
+
+class MockError(Exception):
+    """An error answered in the ``error`` list of Kraken responses"""
+
+
+def truthy(value: Any) -> bool:
+    return str(value).lower() in {"true", "1"}
+
+
+class Account:
+    """
+    Orders, trades, positions and balances of the single mock account.
+
+    Market orders trade against the best level of the synthetic book.
+    Limit orders that cross the book fill immediately at the best price,
+    others rest (outside of the public book) until the book crosses their
+    price. Orders with a leverage open margin positions, ``reduce_only``
+    orders close them. ``on_private(channel, payload)`` gets the
+    ``openOrders`` and ``ownTrades`` payloads of every change.
+    """
+
+    def __init__(
+        self: Account,
+        on_private: Callable[[str, list], None],
+        balance: Optional[dict[str, float]] = None,
+    ) -> None:
+        self.on_private: Callable[[str, list], None] = on_private
+        self.balance: dict[str, float] = balance or {"ZUSD": 100000.0, "XXBT": 10.0}
+        self.orders: dict[str, dict] = {}
+        self.trades: dict[str, dict] = {}
+        self.positions: dict[str, dict] = {}
+        self._reduce_only: set[str] = set()
+        self._ids = itertools.count(1)
+
+    def _id(self: Account, prefix: str) -> str:
+        number = "{:015d}".format(next(self._ids))
+        return "{}{}-{}-{}".format(prefix, number[:5], number[5:10], number[10:])
+
+    def add_order(
+        self: Account, params: dict, market: SyntheticMarket, now: float
+    ) -> dict:
+        """Places an order from AddOrder parameters, returns the AddOrder result"""
+        try:
+            side = params["type"]
+            ordertype = params["ordertype"]
+            volume = float(params["volume"])
+        except (KeyError, ValueError):
+            raise MockError("EGeneral:Invalid arguments")
+        if side not in {"buy", "sell"} or volume <= 0:
+            raise MockError("EGeneral:Invalid arguments")
+        if ordertype not in {"market", "limit"}:
+            raise MockError("EGeneral:Invalid arguments:ordertype")
+        price = float(params.get("price") or 0)
+        if ordertype == "limit" and price <= 0:
+            raise MockError("EGeneral:Invalid arguments:price")
+
+        book = market.book
+        pair = params["pair"]
+        description = "{} {:.8f} {} @ {}".format(
+            side,
+            volume,
+            pair_key(pair),
+            "market" if ordertype == "market" else "limit {}".format(price),
+        )
+        if truthy(params.get("validate")):
+            return {"descr": {"order": description}}
+
+        txid = self._id("O")
+        leverage = params.get("leverage")
+        self.orders[txid] = {
+            "refid": None,
+            "userref": int(params.get("userref") or 0),
+            "status": "open",
+            "opentm": now,
+            "starttm": 0,
+            "expiretm": 0,
+            "descr": {
+                "pair": pair,
+                "type": side,
+                "ordertype": ordertype,
+                "price": "{:.{}f}".format(price, book.price_decimals),
+                "price2": "0",
+                "leverage": "{}:1".format(leverage) if leverage else "none",
+                "order": description,
+                "close": "",
+            },
+            "vol": "{:.8f}".format(volume),
+            "vol_exec": "0.00000000",
+            "cost": "0.00000",
+            "fee": "0.00000",
+            "price": "0.00000",
+            "stopprice": "0.00000",
+            "limitprice": "0.00000",
+            "misc": "",
+            "oflags": "fciq",
+        }
+        if truthy(params.get("reduce_only")):
+            self._reduce_only.add(txid)
+        self.on_private("openOrders", [{txid: self.orders[txid]}])
+
+        taker = "ask" if side == "buy" else "bid"
+        best = book.best(taker)
+        if ordertype == "market" or (
+            best is not None
+            and (
+                price >= book.price(best)
+                if side == "buy"
+                else price <= book.price(best)
+            )
+        ):
+            fill, _ = market.take(taker, volume, now)
+            self._fill(txid, fill, now)
+        return {"descr": {"order": description}, "txid": [txid]}
+
+    def cancel_order(self: Account, txid: str) -> int:
+        order = self.orders.pop(txid, None)
+        if order is None:
+            raise MockError("EOrder:Unknown order")
+        self._reduce_only.discard(txid)
+        self.on_private(
+            "openOrders", [{txid: {"status": "canceled", "reason": "User requested"}}]
+        )
+        return 1
+
+    def cancel_all(self: Account) -> int:
+        txids = list(self.orders)
+        for txid in txids:
+            self.cancel_order(txid)
+        return len(txids)
+
+    def match(self: Account, market: SyntheticMarket, now: float) -> None:
+        """Fills the resting limit orders of ``market`` the book crossed"""
+        book = market.book
+        bid, ask = book.best("bid"), book.best("ask")
+        for txid, order in list(self.orders.items()):
+            descr = order["descr"]
+            if pair_key(descr["pair"]) != pair_key(market.pair):
+                continue
+            price = float(descr["price"])
+            if (descr["type"] == "buy" and price >= book.price(ask)) or (
+                descr["type"] == "sell" and price <= book.price(bid)
+            ):
+                self._fill(txid, price, now)
+
+    def _fill(self: Account, txid: str, price: float, now: float) -> None:
+        order = self.orders.pop(txid)
+        descr = order["descr"]
+        volume = float(order["vol"])
+        cost = price * volume
+        fee = cost * FEE
+        trade_id = self._id("T")
+        position_id = ""
+
+        if txid in self._reduce_only:
+            self._reduce_only.discard(txid)
+            self._reduce(descr["pair"], descr["type"], volume)
+        elif descr["leverage"] != "none":
+            position_id = self._id("P")
+            leverage = int(descr["leverage"].split(":")[0])
+            self.positions[position_id] = {
+                "ordertxid": txid,
+                "posstatus": "open",
+                "pair": descr["pair"],
+                "time": now,
+                "type": descr["type"],
+                "ordertype": descr["ordertype"],
+                "cost": "{:.5f}".format(cost),
+                "fee": "{:.5f}".format(fee),
+                "vol": "{:.8f}".format(volume),
+                "vol_closed": "0.00000000",
+                "margin": "{:.5f}".format(cost / leverage),
+                "leverage": str(leverage),
+                "terms": "0.0100% per 4 hours",
+                "rollovertm": str(int(now) + 4 * 60 * 60),
+                "misc": "",
+                "oflags": "",
+            }
+        else:
+            sign = 1 if descr["type"] == "buy" else -1
+            base = pair_key(descr["pair"])[:-3]
+            self.balance["ZUSD"] = self.balance.get("ZUSD", 0.0) - sign * cost - fee
+            self.balance[base] = self.balance.get(base, 0.0) + sign * volume
+
+        self.trades[trade_id] = {
+            "ordertxid": txid,
+            "postxid": position_id,
+            "pair": descr["pair"],
+            "time": now,
+            "type": descr["type"],
+            "ordertype": descr["ordertype"],
+            "price": "{:.5f}".format(price),
+            "cost": "{:.5f}".format(cost),
+            "fee": "{:.5f}".format(fee),
+            "vol": "{:.8f}".format(volume),
+            "margin": "0.00000",
+        }
+        self.on_private("ownTrades", [{trade_id: self.trades[trade_id]}])
+        self.on_private(
+            "openOrders",
+            [
+                {
+                    txid: {
+                        "status": "closed",
+                        "vol_exec": order["vol"],
+                        "cost": "{:.5f}".format(cost),
+                        "fee": "{:.5f}".format(fee),
+                        "avg_price": "{:.5f}".format(price),
+                        "lastupdated": now,
+                    }
+                }
+            ],
+        )
+
+    def _reduce(self: Account, pair: str, side: str, volume: float) -> None:
+        """Closes ``volume`` of the positions a ``side`` order reduces"""
+        for position_id, position in list(self.positions.items()):
+            if volume <= 0:
+                return
+            if pair_key(position["pair"]) != pair_key(pair) or position["type"] == side:
+                continue
+            open_volume = float(position["vol"]) - float(position["vol_closed"])
+            closed = min(open_volume, volume)
+            volume -= closed
+            if closed >= open_volume:
+                del self.positions[position_id]
+            else:
+                position["vol_closed"] = "{:.8f}".format(
+                    float(position["vol_closed"]) + closed
+                )
+
+    def open_orders(self: Account) -> dict:
+        return {"open": self.orders}
+
+    def open_positions(self: Account) -> dict:
+        return self.positions
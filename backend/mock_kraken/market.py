@@ -0,0 +1,302 @@
+from __future__ import annotations
+
+import bisect
+import random
+from binascii import crc32
+from typing import Optional
+
+# intervals of the ohlc channel and the OHLC endpoint, in minutes
+INTERVALS = (1, 5, 15, 30, 60, 240, 1440, 10080, 21600)
+HISTORY_MINUTES = 3 * 24 * 60
+
+
+def pair_key(pair: str) -> str:
+    """Market of a pair name, ``XBT/USD``, ``BTC/USD`` and ``XBTUSD`` are one"""
+    return pair.upper().replace("/", "").replace("XBT", "BTC")
+
+
+def decimals(price: float) -> int:
+    """Price decimals of a synthetic pair trading around ``price``"""
+    return 1 if price >= 1000 else 2 if price >= 10 else 5
+
+
+def checksum_part(value: float, decimals: int) -> str:
+    return "{:.{}f}".format(value, decimals).replace(".", "").lstrip("0")
+
+
+class Book:
+    """
+    Price levels of both sides of a pair, keyed by integer ticks and kept
+    sorted. Computes the views and checksums Kraken sends for a depth.
+    """
+
+    def __init__(
+        self: Book, price_decimals: int, qty_decimals: int, max_depth: int = 1000
+    ) -> None:
+        self.price_decimals: int = price_decimals
+        self.qty_decimals: int = qty_decimals
+        self.tick: float = 10**-price_decimals
+        self.max_depth: int = max_depth
+        self.levels: dict[str, dict[int, float]] = {"bid": {}, "ask": {}}
+        # ascending ticks of both sides
+        self._ticks: dict[str, list[int]] = {"bid": [], "ask": []}
+        # levels changed since the server last published the book
+        self.changed: dict[str, set[int]] = {"bid": set(), "ask": set()}
+
+    def ticks(self: Book, price: float) -> int:
+        return round(price / self.tick)
+
+    def price(self: Book, ticks: int) -> float:
+        return round(ticks * self.tick, self.price_decimals)
+
+    def set(self: Book, side: str, ticks: int, qty: float) -> None:
+        levels, order = self.levels[side], self._ticks[side]
+        qty = round(qty, self.qty_decimals)
+        self.changed[side].add(ticks)
+        if qty <= 0:
+            if levels.pop(ticks, None) is not None:
+                del order[bisect.bisect_left(order, ticks)]
+            return
+        if ticks not in levels:
+            bisect.insort(order, ticks)
+        levels[ticks] = qty
+        if len(order) > self.max_depth:
+            # drop the worst level
+            worst = order.pop(0 if side == "bid" else -1)
+            del levels[worst]
+
+    def clear(self: Book) -> None:
+        for side in ("bid", "ask"):
+            self.levels[side].clear()
+            self._ticks[side].clear()
+
+    def best(self: Book, side: str) -> Optional[int]:
+        order = self._ticks[side]
+        if not order:
+            return None
+        return order[-1] if side == "bid" else order[0]
+
+    def worst(self: Book, side: str) -> Optional[int]:
+        order = self._ticks[side]
+        if not order:
+            return None
+        return order[0] if side == "bid" else order[-1]
+
+    def depth(self: Book, side: str) -> int:
+        return len(self._ticks[side])
+
+    def top(self: Book, side: str, depth: int) -> list[int]:
+        """Ticks of the best ``depth`` levels of a side, best first"""
+        order = self._ticks[side]
+        return order[: -depth - 1 : -1] if side == "bid" else order[:depth]
+
+    def view(self: Book, side: str, depth: int) -> list[tuple[int, float]]:
+        """The best ``depth`` levels of a side, best first"""
+        levels = self.levels[side]
+        return [(ticks, levels[ticks]) for ticks in self.top(side, depth)]
+
+    def checksum(self: Book) -> int:
+        """CRC32 of the 10 best asks and bids as Kraken computes it"""
+        data = "".join(
+            checksum_part(self.price(ticks), self.price_decimals)
+            + checksum_part(qty, self.qty_decimals)
+            for side in ("ask", "bid")
+            for ticks, qty in self.view(side, 10)
+        )
+        return crc32(data.encode())
+
+
+class Candle:
+    """A candle that is built from trades"""
+
+    __slots__ = ("start", "open", "high", "low", "close", "notional", "volume", "count")
+
+    def __init__(self: Candle, start: float, price: float) -> None:
+        self.start: float = start
+        self.open = self.high = self.low = self.close = price
+        self.notional: float = 0.0
+        self.volume: float = 0.0
+        self.count: int = 0
+
+    def add(self: Candle, price: float, volume: float) -> None:
+        self.high = max(self.high, price)
+        self.low = min(self.low, price)
+        self.close = price
+        self.notional += price * volume
+        self.volume += volume
+        self.count += 1
+
+    @property
+    def vwap(self: Candle) -> float:
+        return self.notional / self.volume if self.volume else self.close
+
+    def row(self: Candle) -> list:
+        return [
+            self.start,
+            self.open,
+            self.high,
+            self.low,
+            self.close,
+            self.vwap,
+            self.volume,
+            self.count,
+        ]
+
+
+class SyntheticMarket:
+    """
+    Random order flow of a single pair: limit orders are added, changed
+    and cancelled near the top of the book, market orders trade against
+    the best level. Trades build the candles of all :data:`INTERVALS`.
+    """
+
+    def __init__(
+        self: SyntheticMarket,
+        pair: str,
+        price: float = 30000.0,
+        price_decimals: int = 1,
+        qty_decimals: int = 8,
+        max_depth: int = 1000,
+        trade_probability: float = 0.1,
+        seed: Optional[int] = None,
+        now: float = 0.0,
+    ) -> None:
+        self.pair: str = pair
+        self.book: Book = Book(price_decimals, qty_decimals, max_depth)
+        self.trade_probability: float = trade_probability
+        self.random: random.Random = random.Random(seed)
+        self.last_price: float = price
+
+        mid = self.book.ticks(price)
+        for i in range(max_depth):
+            self.book.set("bid", mid - 1 - i, self._qty())
+            self.book.set("ask", mid + i, self._qty())
+
+        # closed 1 minute candles and the open candle of every interval
+        self.history: list[list] = self._history(now)
+        self.candles: dict[int, Candle] = {}
+        # trades since the server last published them
+        self.trades: list[tuple[float, float, float, str]] = []
+
+    def _qty(self: SyntheticMarket) -> float:
+        return self.random.expovariate(1 / 2.0) + 10**-self.book.qty_decimals
+
+    def _history(self: SyntheticMarket, now: float) -> list[list]:
+        """Random walk 1 minute candles ending at the current price"""
+        rows = []
+        close = self.last_price
+        start = now - now % 60
+        # walks backwards from the latest minute, the open of a candle is the
+        # close of the one before
+        for i in range(1, HISTORY_MINUTES + 1):
+            open = close * (1 + self.random.gauss(0, 0.0005))
+            high = max(open, close) * (1 + abs(self.random.gauss(0, 0.0003)))
+            low = min(open, close) * (1 - abs(self.random.gauss(0, 0.0003)))
+            rows.append(
+                [
+                    start - i * 60,
+                    open,
+                    high,
+                    low,
+                    close,
+                    (open + close) / 2,
+                    self.random.expovariate(1 / 5.0),
+                    self.random.randint(1, 50),
+                ]
+            )
+            close = open
+        rows.reverse()
+        return rows
+
+    def best_bid(self: SyntheticMarket) -> tuple[float, float]:
+        ticks = self.book.best("bid")
+        return self.book.price(ticks), self.book.levels["bid"][ticks]
+
+    def best_ask(self: SyntheticMarket) -> tuple[float, float]:
+        ticks = self.book.best("ask")
+        return self.book.price(ticks), self.book.levels["ask"][ticks]
+
+    def step(self: SyntheticMarket, now: float) -> None:
+        """Applies one random order book event"""
+        book = self.book
+        side = "bid" if self.random.random() < 0.5 else "ask"
+        if self.random.random() < self.trade_probability:
+            # a market order taking (part of) the best level of ``side``
+            self.take(side, self.random.expovariate(1 / 1.0), now)
+        else:
+            best = book.best(side)
+            other = book.best("ask" if side == "bid" else "bid")
+            distance = int(self.random.expovariate(1 / 5.0)) - 1
+            ticks = best - distance if side == "bid" else best + distance
+            if (side == "bid" and ticks >= other) or (side == "ask" and ticks <= other):
+                ticks = best
+            if ticks in book.levels[side] and self.random.random() < 0.4:
+                book.set(side, ticks, 0)
+            else:
+                book.set(side, ticks, self._qty())
+
+        for side in ("bid", "ask"):
+            # new levels at the far end keep the book deep
+            while book.depth(side) < book.max_depth:
+                worst = book.worst(side)
+                step = self.random.randint(1, 3)
+                book.set(
+                    side, worst - step if side == "bid" else worst + step, self._qty()
+                )
+
+    def take(
+        self: SyntheticMarket, side: str, volume: float, now: float
+    ) -> tuple[float, float]:
+        """
+        Trades up to ``volume`` against the best level of ``side`` and
+        returns the price and the traded volume.
+        """
+        ticks = self.book.best(side)
+        qty = self.book.levels[side][ticks]
+        volume = min(qty, volume)
+        self.book.set(side, ticks, qty - volume)
+        price = self.book.price(ticks)
+        self.trade(price, volume, now, "s" if side == "bid" else "b")
+        return price, volume
+
+    def trade(
+        self: SyntheticMarket, price: float, volume: float, now: float, side: str
+    ) -> None:
+        """Records a trade, ``side`` is the side of the taker (``b`` or ``s``)"""
+        self.last_price = price
+        self.trades.append((price, volume, now, side))
+        for interval in INTERVALS:
+            seconds = interval * 60
+            start = now - now % seconds
+            candle = self.candles.get(interval)
+            if candle is None or candle.start != start:
+                if interval == 1 and candle is not None:
+                    self.history.append(candle.row())
+                    del self.history[:-HISTORY_MINUTES]
+                candle = self.candles[interval] = Candle(start, price)
+            candle.add(price, volume)
+
+    def ohlc(self: SyntheticMarket, interval: int) -> list[list]:
+        """Up to 720 candles of ``interval``, rolled up from 1 minute candles"""
+        seconds = interval * 60
+        minutes = list(self.history)
+        if 1 in self.candles:
+            minutes.append(self.candles[1].row())
+        rows: list[list] = []
+        for start, open, high, low, close, vwap, volume, count in minutes:
+            bucket = start - start % seconds
+            if rows and rows[-1][0] == bucket:
+                row = rows[-1]
+                row[2] = max(row[2], high)
+                row[3] = min(row[3], low)
+                row[4] = close
+                row[5] += vwap * volume
+                row[6] += volume
+                row[7] += count
+            else:
+                rows.append(
+                    [bucket, open, high, low, close, vwap * volume, volume, count]
+                )
+        for row in rows:
+            row[5] = row[5] / row[6] if row[6] else row[4]
+        return rows[-720:]
@@ -0,0 +1,904 @@
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import itertools
+import logging
+import secrets
+import time
+from datetime import datetime, timezone
+from typing import Any, Optional
+from urllib.parse import parse_qsl
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route, WebSocketRoute
+from starlette.websockets import WebSocket, WebSocketDisconnect
+
+from handlers.broadcast import decode, encode
+from handlers.recorder import read
+from mock_kraken.account import Account, MockError
+from mock_kraken.market import (
+    INTERVALS,
+    Book,
+    SyntheticMarket,
+    decimals,
+    pair_key,
+)
+
+PRIVATE_CHANNELS = ("ownTrades", "openOrders")
+# starting prices of the synthetic markets, other pairs start at 100
+PRICES = {"BTC": 30000.0, "ETH": 2000.0, "SOL": 20.0, "XRP": 0.5}
+QTY_DECIMALS = 8
+TOKEN_EXPIRES = 900
+MAX_QUEUE = 10000
+
+
+def iso_time(t: float) -> str:
+    return datetime.fromtimestamp(t, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+class Connection:
+    """
+    A websocket client of the mock. Messages are queued and sent by a task
+    of the connection; a client that falls ``max_queue`` messages behind
+    is disconnected like Kraken drops slow consumers.
+    """
+
+    def __init__(
+        self: Connection, ws: WebSocket, heartbeat: str, max_queue: int = MAX_QUEUE
+    ):
+        self.ws: WebSocket = ws
+        self.heartbeat: str = heartbeat
+        self.queue: asyncio.Queue = asyncio.Queue(max_queue)
+        self.closed: bool = False
+        # private channel -> sequence number of the last message
+        self.sequence: dict[str, int] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self: Connection) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    def send(self: Connection, data: str) -> None:
+        if self.closed:
+            return
+        try:
+            self.queue.put_nowait(data)
+        except asyncio.QueueFull:
+            logging.warning("Disconnecting a slow websocket client")
+            self.close()
+            asyncio.ensure_future(self.ws.close(code=1008))
+
+    def send_json(self: Connection, payload: Any) -> None:
+        self.send(encode(payload).decode())
+
+    async def _run(self: Connection) -> None:
+        try:
+            while True:
+                await self.ws.send_text(await self.queue.get())
+        except Exception:
+            self.closed = True
+
+    def close(self: Connection) -> None:
+        self.closed = True
+        if self._task is not None:
+            self._task.cancel()
+
+
+class BookView:
+    """
+    The best ``depth`` levels of a book as a group of subscribers sees it.
+    Updates send the levels that left the view first, so the truncation of
+    the client book to ``depth`` never drops a level that is sent later.
+    """
+
+    def __init__(self: BookView, pair: str, depth: int, channel_id: int) -> None:
+        self.pair: str = pair
+        self.depth: int = depth
+        self.channel_id: int = channel_id
+        self.v1: set[Connection] = set()
+        self.v2: set[Connection] = set()
+        self.ticks: dict[str, set[int]] = {"bid": set(), "ask": set()}
+
+    def __bool__(self: BookView) -> bool:
+        return bool(self.v1 or self.v2)
+
+    def reset(self: BookView, book: Book) -> None:
+        for side in ("bid", "ask"):
+            self.ticks[side] = set(book.top(side, self.depth))
+
+    def update(self: BookView, book: Book) -> Optional[dict[str, list]]:
+        """Levels of the view changed since the last update, best first"""
+        changes = {}
+        for side in ("bid", "ask"):
+            top = book.top(side, self.depth)
+            ticks = set(top)
+            previous = self.ticks[side]
+            changed = book.changed[side]
+            levels = book.levels[side]
+            changes[side] = [(t, 0.0) for t in previous - ticks] + [
+                (t, levels[t]) for t in top if t in changed or t not in previous
+            ]
+            self.ticks[side] = ticks
+        if not changes["bid"] and not changes["ask"]:
+            return None
+        return changes
+
+
+class Channel:
+    """A public v1 channel (spread, trade, ohlc-N) of a pair"""
+
+    def __init__(self: Channel, name: str, pair: str, channel_id: int) -> None:
+        self.name: str = name
+        self.pair: str = pair
+        self.channel_id: int = channel_id
+        self.connections: set[Connection] = set()
+
+
+class MockKraken:
+    """
+    Stand-in for the Kraken REST API and the v1/v2 websocket APIs.
+
+    Synthetic markets are created for every pair that is asked for and
+    stepped ``rate`` times per second and pair. With ``replay`` the public
+    websocket channels replay a recording of the backend (``RECORD_DIR``)
+    instead, REST and the private channels stay synthetic.
+    """
+
+    def __init__(
+        self: MockKraken,
+        pairs: list[str],
+        rate: float = 100.0,
+        depth: int = 1000,
+        trade_probability: float = 0.1,
+        seed: Optional[int] = None,
+        replay: Optional[str] = None,
+        speed: Optional[float] = 1.0,
+    ) -> None:
+        self.rate: float = rate
+        self.depth: int = depth
+        self.trade_probability: float = trade_probability
+        self.seed: Optional[int] = seed
+        self.replay: Optional[str] = replay
+        self.speed: Optional[float] = speed
+
+        self.markets: dict[str, SyntheticMarket] = {}
+        self.account: Account = Account(self.on_private)
+        self.tokens: set[str] = set()
+        self.connections: set[Connection] = set()
+        # pair key -> book views and v1 channels of the pair
+        self.views: dict[str, dict[tuple[str, int], BookView]] = {}
+        self.channels: dict[str, dict[tuple[str, str], Channel]] = {}
+        self.private: dict[str, set[Connection]] = {
+            channel: set() for channel in PRIVATE_CHANNELS
+        }
+        self.spreads: dict[str, tuple] = {}
+        # replayed books, the asset pairs of the recording
+        self.books: dict[str, Book] = {}
+        self.asset_pairs: dict[str, dict] = {}
+        self.published: int = 0
+        self._channel_ids = itertools.count(1)
+        self._tasks: list[asyncio.Task] = []
+        for pair in pairs:
+            self.market(pair)
+
+    def market(self: MockKraken, pair: str) -> SyntheticMarket:
+        key = pair_key(pair)
+        market = self.markets.get(key)
+        if market is None:
+            price = next(
+                (price for base, price in PRICES.items() if key.startswith(base)),
+                100.0,
+            )
+            market = self.markets[key] = SyntheticMarket(
+                pair,
+                price=price,
+                price_decimals=decimals(price),
+                qty_decimals=QTY_DECIMALS,
+                max_depth=self.depth,
+                trade_probability=self.trade_probability,
+                seed=self.seed,
+                now=time.time(),
+            )
+            logging.info("Created the synthetic market %s", key)
+        return market
+
+    def book(self: MockKraken, pair: str) -> Book:
+        if self.replay is not None:
+            return self.books.setdefault(
+                pair_key(pair), Book(*self.decimals(pair), self.depth)
+            )
+        return self.market(pair).book
+
+    def decimals(self: MockKraken, pair: str) -> tuple[int, int]:
+        info = self.asset_pairs.get(pair)
+        if info is not None:
+            return int(info["pair_decimals"]), int(info["lot_decimals"])
+        book = self.market(pair).book
+        return book.price_decimals, book.qty_decimals
+
+    # -- streaming ---------------------------------------------------------
+
+    async def start(self: MockKraken) -> None:
+        self._tasks.append(asyncio.create_task(self._heartbeat()))
+        if self.replay is not None:
+            self._tasks.append(asyncio.create_task(self._replay()))
+        else:
+            self._tasks.append(asyncio.create_task(self._run()))
+
+    async def stop(self: MockKraken) -> None:
+        for task in self._tasks:
+            task.cancel()
+        for connection in self.connections:
+            connection.close()
+
+    async def _run(self: MockKraken) -> None:
+        loop = asyncio.get_running_loop()
+        last = loop.time()
+        due = 0.0
+        while True:
+            await asyncio.sleep(min(0.01, 1 / self.rate))
+            now = loop.time()
+            # at most a second of backlog when stepping can't keep up
+            due = min(due + (now - last) * self.rate, self.rate)
+            last = now
+            for _ in range(int(due)):
+                t = time.time()
+                for market in list(self.markets.values()):
+                    market.step(t)
+                    self.account.match(market, t)
+                    self.publish(market.pair, market.book)
+                    self.publish_trades(market, t)
+            due -= int(due)
+
+    async def _heartbeat(self: MockKraken) -> None:
+        while True:
+            await asyncio.sleep(1)
+            for connection in list(self.connections):
+                connection.send(connection.heartbeat)
+
+    async def _replay(self: MockKraken) -> None:
+        loop = asyncio.get_running_loop()
+        first = started = None
+        count = 0
+        for received, source, message in read(self.replay):
+            if self.speed:
+                if first is None:
+                    first, started = received, loop.time()
+                delay = (received - first) / self.speed - (loop.time() - started)
+                await asyncio.sleep(max(0, delay))
+            elif count % 100 == 0:
+                await asyncio.sleep(0)
+            count += 1
+            if source == "meta":
+                self.asset_pairs.update(message)
+            elif source == "book":
+                self.replay_book(message)
+            elif source == "kraken" and isinstance(message, list):
+                self.replay_channel(message)
+        logging.info("Replayed %d messages of %s", count, self.replay)
+
+    def replay_book(self: MockKraken, message: dict) -> None:
+        if message.get("channel") != "book" or not message.get("data"):
+            return
+        data = message["data"][0]
+        pair = data["symbol"]
+        book = self.book(pair)
+        if message.get("type") == "snapshot":
+            book.clear()
+        for side, levels in (("bid", data["bids"]), ("ask", data["asks"])):
+            for level in levels:
+                book.set(side, book.ticks(level["price"]), level["qty"])
+        # the recorded message is forwarded as it is
+        text = encode(message).decode()
+        for view in self.views.get(pair_key(pair), {}).values():
+            view.reset(book)
+            for connection in view.v2:
+                connection.send(text)
+        for side in ("bid", "ask"):
+            book.changed[side].clear()
+
+    def replay_channel(self: MockKraken, message: list) -> None:
+        if isinstance(message[-1], dict):
+            self.on_private(message[1], message[0])
+            return
+        name, pair = message[-2], message[-1]
+        channel = self.channels.get(pair_key(pair), {}).get((name, pair))
+        if channel is not None:
+            self.send_channel(channel, message[1:-2])
+
+    def publish(self: MockKraken, pair: str, book: Book) -> None:
+        """Sends the book updates and the spread of a pair"""
+        key = pair_key(pair)
+        now = time.time()
+        checksum = None
+        for view in self.views.get(key, {}).values():
+            if not view:
+                continue
+            changes = view.update(book)
+            if changes is None:
+                continue
+            if checksum is None:
+                checksum = book.checksum()
+            if view.v2:
+                self.broadcast(
+                    view.v2, self.book_v2(view.pair, book, changes, checksum, now)
+                )
+            if view.v1:
+                self.broadcast(
+                    view.v1, self.book_v1(view, book, changes, checksum, now)
+                )
+        for side in ("bid", "ask"):
+            book.changed[side].clear()
+
+        bid, ask = book.best("bid"), book.best("ask")
+        if bid is None or ask is None:
+            return
+        spread = (bid, book.levels["bid"][bid], ask, book.levels["ask"][ask])
+        if spread == self.spreads.get(key):
+            return
+        self.spreads[key] = spread
+        for (name, _), channel in self.channels.get(key, {}).items():
+            if name == "spread" and channel.connections:
+                self.send_channel(
+                    channel,
+                    [
+                        [
+                            self.format_price(book, bid),
+                            self.format_price(book, ask),
+                            "{:.6f}".format(now),
+                            self.format_qty(book, spread[1]),
+                            self.format_qty(book, spread[3]),
+                        ]
+                    ],
+                )
+
+    def publish_trades(self: MockKraken, market: SyntheticMarket, now: float) -> None:
+        if not market.trades:
+            return
+        trades, market.trades = market.trades, []
+        book = market.book
+        for (name, _), channel in self.channels.get(pair_key(market.pair), {}).items():
+            if not channel.connections:
+                continue
+            if name == "trade":
+                self.send_channel(
+                    channel,
+                    [
+                        [
+                            [
+                                "{:.{}f}".format(price, book.price_decimals),
+                                self.format_qty(book, volume),
+                                "{:.6f}".format(t),
+                                side,
+                                "m",
+                                "",
+                            ]
+                            for price, volume, t, side in trades
+                        ]
+                    ],
+                )
+            elif name.startswith("ohlc-"):
+                self.send_channel(channel, [self.ohlc_v1(market, int(name[5:]), now)])
+
+    def ohlc_v1(self: MockKraken, market: SyntheticMarket, interval: int, now: float):
+        candle = market.candles.get(interval)
+        if candle is None:
+            return None
+        price = "{{:.{}f}}".format(market.book.price_decimals).format
+        return [
+            "{:.6f}".format(now),
+            "{:.6f}".format(candle.start + interval * 60),
+            price(candle.open),
+            price(candle.high),
+            price(candle.low),
+            price(candle.close),
+            price(candle.vwap),
+            "{:.8f}".format(candle.volume),
+            candle.count,
+        ]
+
+    def on_private(self: MockKraken, channel: str, payload: list) -> None:
+        for connection in self.private.get(channel, ()):
+            sequence = connection.sequence.get(channel, 0) + 1
+            connection.sequence[channel] = sequence
+            connection.send_json([payload, channel, {"sequence": sequence}])
+
+    def broadcast(self: MockKraken, connections: set[Connection], payload: Any) -> None:
+        text = encode(payload).decode()
+        for connection in connections:
+            connection.send(text)
+        self.published += 1
+
+    def send_channel(self: MockKraken, channel: Channel, payload: list) -> None:
+        self.broadcast(
+            channel.connections,
+            [channel.channel_id, *payload, channel.name, channel.pair],
+        )
+
+    # -- formatting ----------------------------------------------------------
+
+    @staticmethod
+    def format_price(book: Book, ticks: int) -> str:
+        return "{:.{}f}".format(book.price(ticks), book.price_decimals)
+
+    @staticmethod
+    def format_qty(book: Book, qty: float) -> str:
+        return "{:.{}f}".format(qty, book.qty_decimals)
+
+    def book_v2(
+        self: MockKraken,
+        pair: str,
+        book: Book,
+        changes: dict[str, list],
+        checksum: int,
+        now: Optional[float] = None,
+    ) -> dict:
+        data = {
+            "symbol": pair,
+            "bids": [{"price": book.price(t), "qty": q} for t, q in changes["bid"]],
+            "asks": [{"price": book.price(t), "qty": q} for t, q in changes["ask"]],
+            "checksum": checksum,
+        }
+        if now is not None:
+            data["timestamp"] = iso_time(now)
+        return {
+            "channel": "book",
+            "type": "snapshot" if now is None else "update",
+            "data": [data],
+        }
+
+    def book_v1(
+        self: MockKraken,
+        view: BookView,
+        book: Book,
+        changes: dict[str, list],
+        checksum: int,
+        now: float,
+    ) -> list:
+        def levels(side):
+            return [
+                [
+                    self.format_price(book, t),
+                    self.format_qty(book, q),
+                    "{:.6f}".format(now),
+                ]
+                for t, q in changes[side]
+            ]
+
+        payload = []
+        if changes["ask"]:
+            payload.append({"a": levels("ask")})
+        if changes["bid"]:
+            payload.append({"b": levels("bid")})
+        payload[-1]["c"] = str(checksum)
+        return [view.channel_id, *payload, "book-{}".format(view.depth), view.pair]
+
+    def book_snapshot_v1(self: MockKraken, view: BookView, book: Book) -> list:
+        now = time.time()
+        changes = {side: book.view(side, view.depth) for side in ("bid", "ask")}
+        payload = self.book_v1(view, book, changes, 0, now)
+        # a snapshot is {"as": ..., "bs": ...} without checksum
+        snapshot = {"as": [], "bs": []}
+        for part in payload[1:-2]:
+            snapshot["as"] += part.get("a", [])
+            snapshot["bs"] += part.get("b", [])
+        return [view.channel_id, snapshot, "book-{}".format(view.depth), view.pair]
+
+    # -- subscriptions -------------------------------------------------------
+
+    def view(self: MockKraken, pair: str, depth: int) -> BookView:
+        views = self.views.setdefault(pair_key(pair), {})
+        view = views.get((pair, depth))
+        if view is None:
+            view = views[(pair, depth)] = BookView(pair, depth, next(self._channel_ids))
+            view.reset(self.book(pair))
+        return view
+
+    def channel(self: MockKraken, name: str, pair: str) -> Channel:
+        channels = self.channels.setdefault(pair_key(pair), {})
+        channel = channels.get((name, pair))
+        if channel is None:
+            channel = channels[(name, pair)] = Channel(
+                name, pair, next(self._channel_ids)
+            )
+        return channel
+
+    def disconnect(self: MockKraken, connection: Connection) -> None:
+        connection.close()
+        self.connections.discard(connection)
+        for views in self.views.values():
+            for view in views.values():
+                view.v1.discard(connection)
+                view.v2.discard(connection)
+        for channels in self.channels.values():
+            for channel in channels.values():
+                channel.connections.discard(connection)
+        for connections in self.private.values():
+            connections.discard(connection)
+
+    async def serve(
+        self: MockKraken, ws: WebSocket, handler: Any, heartbeat: dict
+    ) -> None:
+        await ws.accept()
+        connection = Connection(ws, encode(heartbeat).decode())
+        connection.start()
+        self.connections.add(connection)
+        try:
+            handler(connection, None)
+            while True:
+                handler(connection, decode((await ws.receive_text()).encode()))
+        except WebSocketDisconnect:
+            pass
+        finally:
+            self.disconnect(connection)
+
+    def on_v2(self: MockKraken, connection: Connection, message: Optional[dict]):
+        if message is None:
+            connection.send_json(
+                {
+                    "channel": "status",
+                    "type": "update",
+                    "data": [
+                        {
+                            "api_version": "v2",
+                            "connection_id": id(connection),
+                            "system": "online",
+                            "version": "2.0.0",
+                        }
+                    ],
+                }
+            )
+            return
+        method = message.get("method")
+        now = iso_time(time.time())
+        reply = {"method": method, "time_in": now, "time_out": now}
+        if "req_id" in message:
+            reply["req_id"] = message["req_id"]
+        if method == "ping":
+            connection.send_json({**reply, "method": "pong"})
+            return
+        params = message.get("params") or {}
+        if (
+            method not in {"subscribe", "unsubscribe"}
+            or params.get("channel") != "book"
+        ):
+            connection.send_json(
+                {**reply, "success": False, "error": "Unsupported request"}
+            )
+            return
+        depth = int(params.get("depth", 10))
+        for pair in params.get("symbol", []):
+            view = self.view(pair, depth)
+            result = {"channel": "book", "depth": depth, "symbol": pair}
+            if method == "subscribe":
+                view.v2.add(connection)
+                connection.send_json(
+                    {**reply, "result": {**result, "snapshot": True}, "success": True}
+                )
+                book = self.book(pair)
+                changes = {side: book.view(side, depth) for side in ("bid", "ask")}
+                connection.send_json(self.book_v2(pair, book, changes, book.checksum()))
+            else:
+                view.v2.discard(connection)
+                connection.send_json({**reply, "result": result, "success": True})
+
+    def on_v1(self: MockKraken, connection: Connection, message: Optional[dict]):
+        if message is None:
+            connection.send_json(
+                {
+                    "connectionID": id(connection),
+                    "event": "systemStatus",
+                    "status": "online",
+                    "version": "1.9.1",
+                }
+            )
+            return
+        event = message.get("event")
+        reply = {"reqid": message["reqid"]} if "reqid" in message else {}
+        if event == "ping":
+            connection.send_json({**reply, "event": "pong"})
+        elif event in {"subscribe", "unsubscribe"}:
+            self.on_subscription(connection, event, message, reply)
+        elif event in {"addOrder", "cancelOrder", "cancelAll"}:
+            self.on_order(connection, event, message, reply)
+        else:
+            connection.send_json(
+                {**reply, "event": "error", "errorMessage": "Unsupported event"}
+            )
+
+    def on_subscription(
+        self: MockKraken, connection: Connection, event: str, message: dict, reply: dict
+    ) -> None:
+        subscription = dict(message.get("subscription") or {})
+        name = subscription.get("name")
+        status = "subscribed" if event == "subscribe" else "unsubscribed"
+        if name in PRIVATE_CHANNELS:
+            token = subscription.pop("token", None)
+            status_message = {
+                **reply,
+                "channelName": name,
+                "event": "subscriptionStatus",
+                "subscription": subscription,
+            }
+            if event == "subscribe" and token not in self.tokens:
+                connection.send_json(
+                    {
+                        **status_message,
+                        "status": "error",
+                        "errorMessage": "ESession:Invalid session",
+                    }
+                )
+                return
+            connection.send_json({**status_message, "status": status})
+            if event == "unsubscribe":
+                self.private[name].discard(connection)
+                return
+            self.private[name].add(connection)
+            if name == "openOrders":
+                snapshot = [
+                    {txid: order} for txid, order in self.account.orders.items()
+                ]
+            else:
+                trades = list(self.account.trades.items())[-50:]
+                snapshot = [{trade_id: trade} for trade_id, trade in trades]
+            connection.sequence[name] = 1
+            connection.send_json([snapshot, name, {"sequence": 1}])
+            return
+
+        if name == "ohlc":
+            channel_name = "ohlc-{}".format(subscription.get("interval", 1))
+        elif name == "book":
+            channel_name = "book-{}".format(subscription.get("depth", 10))
+        else:
+            channel_name = name
+        if name not in {"ohlc", "book", "spread", "trade"} or (
+            name == "ohlc" and subscription.get("interval", 1) not in INTERVALS
+        ):
+            connection.send_json(
+                {
+                    **reply,
+                    "event": "subscriptionStatus",
+                    "status": "error",
+                    "errorMessage": "Subscription name invalid",
+                    "subscription": subscription,
+                }
+            )
+            return
+        for pair in message.get("pair") or []:
+            if name == "book":
+                channel = self.view(pair, int(subscription.get("depth", 10)))
+                connections = channel.v1
+            else:
+                channel = self.channel(channel_name, pair)
+                connections = channel.connections
+            connection.send_json(
+                {
+                    **reply,
+                    "channelID": channel.channel_id,
+                    "channelName": channel_name,
+                    "event": "subscriptionStatus",
+                    "pair": pair,
+                    "status": status,
+                    "subscription": subscription,
+                }
+            )
+            if event == "unsubscribe":
+                connections.discard(connection)
+                continue
+            connections.add(connection)
+            if name == "book":
+                connection.send_json(self.book_snapshot_v1(channel, self.book(pair)))
+            elif name == "ohlc" and self.replay is None:
+                candle = self.ohlc_v1(
+                    self.market(pair), subscription.get("interval", 1), time.time()
+                )
+                if candle is not None:
+                    connection.send_json(
+                        [channel.channel_id, candle, channel_name, pair]
+                    )
+
+    def on_order(
+        self: MockKraken, connection: Connection, event: str, message: dict, reply: dict
+    ) -> None:
+        status_event = "{}Status".format(event)
+        if message.get("token") not in self.tokens:
+            connection.send_json(
+                {
+                    **reply,
+                    "event": status_event,
+                    "status": "error",
+                    "errorMessage": "ESession:Invalid session",
+                }
+            )
+            return
+        try:
+            if event == "addOrder":
+                result = self.account.add_order(
+                    message, self.market(message.get("pair", "")), time.time()
+                )
+                connection.send_json(
+                    {
+                        **reply,
+                        "event": status_event,
+                        "status": "ok",
+                        "descr": result["descr"]["order"],
+                        **({"txid": result["txid"][0]} if "txid" in result else {}),
+                    }
+                )
+            elif event == "cancelOrder":
+                for txid in message.get("txid", []):
+                    self.account.cancel_order(txid)
+                connection.send_json({**reply, "event": status_event, "status": "ok"})
+            else:
+                count = self.account.cancel_all()
+                connection.send_json(
+                    {**reply, "event": status_event, "status": "ok", "count": count}
+                )
+        except MockError as error:
+            connection.send_json(
+                {
+                    **reply,
+                    "event": status_event,
+                    "status": "error",
+                    "errorMessage": str(error),
+                }
+            )
+
+    # -- REST ----------------------------------------------------------------
+
+    async def rest(self: MockKraken, request: Request) -> JSONResponse:
+        params = dict(request.query_params)
+        if request.method == "POST":
+            body = await request.body()
+            if body.startswith(b"{"):
+                params.update(decode(body))
+            else:
+                params.update(parse_qsl(body.decode()))
+        endpoint = request.path_params["endpoint"]
+        handler = getattr(self, "rest_" + endpoint.lower(), None)
+        if handler is None:
+            return JSONResponse({"error": ["EGeneral:Unknown method"]}, status_code=404)
+        private = request.url.path.startswith("/0/private/")
+        if private and "API-Key" not in request.headers:
+            return JSONResponse({"error": ["EAPI:Invalid key"]})
+        try:
+            return JSONResponse({"error": [], "result": handler(params)})
+        except MockError as error:
+            return JSONResponse({"error": [str(error)]})
+
+    def pairs(self: MockKraken, params: dict) -> list[str]:
+        if not params.get("pair"):
+            raise MockError("EGeneral:Invalid arguments:pair")
+        return params["pair"].split(",")
+
+    def rest_time(self: MockKraken, params: dict) -> dict:
+        now = time.time()
+        return {
+            "unixtime": int(now),
+            "rfc1123": time.strftime("%a, %d %b %y %H:%M:%S +0000", time.gmtime(now)),
+        }
+
+    def rest_assetpairs(self: MockKraken, params: dict) -> dict:
+        result = {}
+        # all pairs of the mock without a pair argument, like Kraken
+        pairs = (
+            self.pairs(params)
+            if params.get("pair")
+            else [market.pair for market in self.markets.values()]
+        )
+        for pair in pairs:
+            price_decimals, qty_decimals = self.decimals(pair)
+            key = pair_key(pair)
+            result[pair] = {
+                "altname": key,
+                "wsname": "{}/{}".format(key[:-3], key[-3:]),
+                "base": key[:-3],
+                "quote": key[-3:],
+                "pair_decimals": price_decimals,
+                "lot_decimals": qty_decimals,
+                "cost_decimals": 5,
+                "ordermin": "0.0001",
+                "status": "online",
+            }
+        return result
+
+    def rest_ticker(self: MockKraken, params: dict) -> dict:
+        result = {}
+        for pair in self.pairs(params):
+            market = self.market(pair)
+            book = market.book
+            (bid, bid_qty), (ask, ask_qty) = market.best_bid(), market.best_ask()
+            price = "{{:.{}f}}".format(book.price_decimals).format
+            result[pair] = {
+                "a": [price(ask), str(int(ask_qty)), self.format_qty(book, ask_qty)],
+                "b": [price(bid), str(int(bid_qty)), self.format_qty(book, bid_qty)],
+                "c": [price(market.last_price), "0.00000000"],
+            }
+        return result
+
+    def rest_ohlc(self: MockKraken, params: dict) -> dict:
+        interval = int(params.get("interval", 1))
+        if interval not in INTERVALS:
+            raise MockError("EGeneral:Invalid arguments:interval")
+        (pair,) = self.pairs(params)
+        market = self.market(pair)
+        price = "{{:.{}f}}".format(market.book.price_decimals).format
+        rows = [
+            [
+                int(t),
+                price(o),
+                price(h),
+                price(lo),
+                price(c),
+                price(vwap),
+                "{:.8f}".format(v),
+                n,
+            ]
+            for t, o, h, lo, c, vwap, v, n in market.ohlc(interval)
+        ]
+        return {pair: rows, "last": rows[-2][0] if len(rows) > 1 else 0}
+
+    def rest_getwebsocketstoken(self: MockKraken, params: dict) -> dict:
+        token = secrets.token_urlsafe(24)
+        self.tokens.add(token)
+        return {"token": token, "expires": TOKEN_EXPIRES}
+
+    def rest_balance(self: MockKraken, params: dict) -> dict:
+        return {
+            asset: "{:.8f}".format(value)
+            for asset, value in self.account.balance.items()
+        }
+
+    def rest_openorders(self: MockKraken, params: dict) -> dict:
+        return self.account.open_orders()
+
+    def rest_openpositions(self: MockKraken, params: dict) -> dict:
+        return self.account.open_positions()
+
+    def rest_addorder(self: MockKraken, params: dict) -> dict:
+        return self.account.add_order(
+            params, self.market(params.get("pair", "")), time.time()
+        )
+
+    def rest_cancelorder(self: MockKraken, params: dict) -> dict:
+        return {"count": self.account.cancel_order(params.get("txid", ""))}
+
+    def rest_cancelall(self: MockKraken, params: dict) -> dict:
+        return {"count": self.account.cancel_all()}
+
+    def stats(self: MockKraken, request: Request) -> JSONResponse:
+        return JSONResponse(
+            {
+                "connections": len(self.connections),
+                "published": self.published,
+                "markets": list(self.markets),
+            }
+        )
+
+
+def create_app(mock: MockKraken) -> Starlette:
+    async def v1(ws):
+        await mock.serve(ws, mock.on_v1, {"event": "heartbeat"})
+
+    async def v2(ws):
+        await mock.serve(ws, mock.on_v2, {"channel": "heartbeat"})
+
+    @contextlib.asynccontextmanager
+    async def lifespan(app):
+        await mock.start()
+        yield
+        await mock.stop()
+
+    return Starlette(
+        routes=(
+            Route("/0/public/{endpoint}", endpoint=mock.rest, methods=["GET", "POST"]),
+            Route("/0/private/{endpoint}", endpoint=mock.rest, methods=["POST"]),
+            Route("/stats", endpoint=mock.stats, methods=["GET"]),
+            WebSocketRoute("/public", endpoint=v1),
+            WebSocketRoute("/public/v2", endpoint=v2),
+            WebSocketRoute("/private", endpoint=v1),
+        ),
+        lifespan=lifespan,
+    )
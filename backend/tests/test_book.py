@@ -0,0 +1,134 @@
+import random
+
+from handlers.book import Book, BookSide
+
+
+def message(kind, bids=(), asks=()):
+    return {
+        "type": kind,
+        "data": [
+            {
+                "bids": [{"price": p, "qty": q} for p, q in bids],
+                "asks": [{"price": p, "qty": q} for p, q in asks],
+            }
+        ],
+    }
+
+
+def levels(side):
+    ticks, qty = side.levels()
+    return list(zip(ticks.tolist(), qty.tolist()))
+
+
+def test_insert_change_and_delete():
+    side = BookSide(True, depth=5)
+    for ticks in (100, 98, 102, 99):
+        side.set(ticks, 1)
+    assert levels(side) == [(98, 1), (99, 1), (100, 1), (102, 1)]
+    assert side.best() == (102, 1)
+
+    side.set(99, 3)
+    side.set(102, 0)
+    assert levels(side) == [(98, 1), (99, 3), (100, 1)]
+    assert side.best() == (100, 1)
+    assert (side.added, side.removed) == (6, 1)
+
+    # deleting a level the book does not have changes nothing
+    side.set(101, 0)
+    side.set(50, 0)
+    assert levels(side) == [(98, 1), (99, 3), (100, 1)]
+    assert (side.added, side.removed) == (6, 1)
+
+    side.clear()
+    assert len(side) == 0 and side.best() is None
+
+
+def test_truncation_after_every_level_of_a_message():
+    book = Book("XBT/USD", 2, 8, depth=3)
+    book.apply(
+        message("snapshot", [(100.0, 1.0), (99.9, 1.0), (99.8, 1.0)], [(100.1, 1.0)])
+    )
+    # the insert crosses the depth and drops 99.8, the delete after it in
+    # the same message does not bring it back
+    book.apply(message("update", bids=[(100.05, 2.0), (100.0, 0.0)]))
+    assert levels(book.bid) == [(9990, 100000000), (10005, 200000000)]
+    assert book.bid.top(3)[0].tolist() == [10005, 9990]
+
+
+def test_truncation_keeps_the_best_levels():
+    book = Book("XBT/USD", 2, 8, depth=3)
+    book.apply(
+        message(
+            "snapshot",
+            [(100.0, 1.0), (99.9, 1.0), (99.8, 1.0)],
+            [(100.1, 1.0), (100.2, 1.0), (100.3, 1.0)],
+        )
+    )
+    # a better level drops the worst one, a worse one is dropped at once
+    book.apply(
+        message(
+            "update",
+            bids=[(100.05, 2.0), (99.0, 5.0)],
+            asks=[(100.08, 2.0), (101.0, 5.0)],
+        )
+    )
+    assert levels(book.bid) == [
+        (9990, 100000000),
+        (10000, 100000000),
+        (10005, 200000000),
+    ]
+    assert levels(book.ask) == [
+        (10008, 200000000),
+        (10010, 100000000),
+        (10020, 100000000),
+    ]
+    # a level deleted after it left the depth is not in the book any more
+    book.apply(message("update", bids=[(99.8, 0.0), (99.9, 0.0)]))
+    assert levels(book.bid) == [(10000, 100000000), (10005, 200000000)]
+    assert book.bid.removed == 100000000
+
+
+def test_ticks_and_prices_round_trip():
+    rng = random.Random(4)
+    for decimals in (0, 1, 2, 5, 8):
+        book = Book("XBT/USD", decimals, 8, depth=10)
+        for _ in range(500):
+            text = "{:.{}f}".format(rng.uniform(0.0001, 100_000), decimals)
+            price = float(text)
+            ticks = book.ticks(price)
+            assert ticks == int(text.replace(".", ""))
+            assert book.price(ticks) == price
+    book = Book("XBT/USD", 1, 8, depth=10)
+    book.apply(message("snapshot", [(45283.5, 0.00000001)], [(45285.2, 1.2)]))
+    assert book.best_bid() == (45283.5, 0.00000001)
+    assert book.best_ask() == (45285.2, 1.2)
+    assert book.checksum_string("bid") == "4528351"
+
+
+def test_sides_follow_a_reference_book():
+    rng = random.Random(9)
+    depth = 20
+    book = Book("XBT/USD", 1, 8, depth=depth)
+    reference = {"bids": {}, "asks": {}}
+    for step in range(5000):
+        kind = "snapshot" if step % 1000 == 0 else "update"
+        if kind == "snapshot":
+            reference = {"bids": {}, "asks": {}}
+        update = {"bids": [], "asks": []}
+        for side, sign in (("bids", -1), ("asks", 1)):
+            for _ in range(depth if kind == "snapshot" else rng.randint(0, 4)):
+                ticks = 1000 + sign * rng.randint(1, 3 * depth)
+                qty = rng.choice((0, 0, 1, 2, 5)) if kind == "update" else 1
+                update[side].append((ticks / 10, qty / 1e8))
+        for side in ("asks", "bids"):
+            for price, qty in update[side]:
+                ticks = round(price * 10)
+                if qty:
+                    reference[side][ticks] = round(qty * 1e8)
+                else:
+                    reference[side].pop(ticks, None)
+                best = sorted(reference[side], reverse=side == "bids")[:depth]
+                reference[side] = {t: reference[side][t] for t in best}
+        book.apply(message(kind, update["bids"], update["asks"]))
+        assert levels(book.bid) == sorted(reference["bids"].items())
+        assert levels(book.ask) == sorted(reference["asks"].items())
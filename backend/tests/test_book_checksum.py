@@ -0,0 +1,99 @@
+import random
+from binascii import crc32
+
+from handlers.book import Book
+from handlers.book_checksum import BookChecksum
+
+
+def message(kind, bids=(), asks=(), checksum=0):
+    return {
+        "type": kind,
+        "data": [
+            {
+                "bids": [{"price": p, "qty": q} for p, q in bids],
+                "asks": [{"price": p, "qty": q} for p, q in asks],
+                "checksum": checksum,
+            }
+        ],
+    }
+
+
+def reference(levels, price_decimals=1, qty_decimals=8):
+    """The checksum as documented by Kraken, from the formatted levels"""
+
+    def digits(value, decimals):
+        return f"{value:.{decimals}f}".replace(".", "").lstrip("0")
+
+    asks = sorted(levels["asks"].items())[:10]
+    bids = sorted(levels["bids"].items(), reverse=True)[:10]
+    text = "".join(
+        digits(price, price_decimals) + digits(qty, qty_decimals)
+        for price, qty in asks + bids
+    )
+    return crc32(text.encode())
+
+
+def test_known_answer():
+    book = Book("XBT/USD", 1, 8, depth=10)
+    checksum = BookChecksum()
+    snapshot = message(
+        "snapshot",
+        [(45283.5, 0.1), (45283.4, 1.00000001)],
+        [(45285.2, 0.00143), (45286.4, 1.2)],
+        checksum=reference(
+            {
+                "bids": {45283.5: 0.1, 45283.4: 1.00000001},
+                "asks": {45285.2: 0.00143, 45286.4: 1.2},
+            }
+        ),
+    )
+    book.apply(snapshot)
+    assert checksum.verify(book, snapshot)
+    # price and quantity digits without the dot and the leading zeros, the
+    # asks first
+    assert checksum.checksum == crc32(
+        b"452852143000" b"452864120000000" b"45283510000000" b"452834100000001"
+    )
+
+    wrong = message("update", asks=[(45285.2, 0.5)], checksum=1)
+    book.apply(wrong)
+    assert not checksum.verify(book, wrong)
+
+
+def test_incremental_checksum_follows_the_book():
+    rng = random.Random(11)
+    book = Book("XBT/USD", 1, 8, depth=25)
+    checksum = BookChecksum()
+    levels = {
+        "bids": {round(100.0 - i * 0.1, 1): 1.0 for i in range(25)},
+        "asks": {round(100.1 + i * 0.1, 1): 1.0 for i in range(25)},
+    }
+    snapshot = message(
+        "snapshot",
+        levels["bids"].items(),
+        levels["asks"].items(),
+        reference(levels),
+    )
+    book.apply(snapshot)
+    assert checksum.verify(book, snapshot)
+
+    for _ in range(3000):
+        update = {"bids": [], "asks": []}
+        for side, sign, best in (("bids", -1, 100.0), ("asks", 1, 100.1)):
+            for _ in range(rng.randint(0, 3)):
+                # mostly changes of the best 10 levels, some further down
+                price = round(best + sign * rng.randint(0, 30) * 0.1, 1)
+                qty = rng.choice((0.0, 0.5, 1.25, 2.0))
+                if qty or price in levels[side]:
+                    update[side].append((price, qty))
+                    levels[side][price] = qty
+                    if not qty:
+                        del levels[side][price]
+            # the book keeps its 25 best levels
+            kept = sorted(levels[side], reverse=side == "bids")[:25]
+            levels[side] = {price: levels[side][price] for price in kept}
+        if not update["bids"] and not update["asks"]:
+            continue
+        msg = message("update", update["bids"], update["asks"], reference(levels))
+        book.apply(msg)
+        assert checksum.verify(book, msg)
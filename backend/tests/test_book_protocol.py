@@ -0,0 +1,86 @@
+import asyncio
+
+import numpy as np
+
+from handlers.book_protocol import (
+    COLUMNS,
+    DELTA,
+    SNAPSHOT,
+    BookDeltaStream,
+    decode_frame,
+)
+from handlers.broadcast import Frame, Subscriber
+from handlers.orderbook import OrderbookHub
+from handlers.shards import MirrorState
+
+PAIR = "SHIB/USD"
+
+
+def source(depth=4):
+    """A ladder of two asks and two bids with volumes past 32 bits"""
+    state = MirrorState(PAIR, depth)
+    snapshot = state.snapshot
+    snapshot.seq = 1
+    snapshot.start, snapshot.stop = depth - 2, depth + 2
+    snapshot.price[depth - 2 : depth + 2] = [0.3, 0.2, 0.1, 0.05]
+    snapshot.ask[depth - 2 : depth] = [3 * 2**32, 5]
+    snapshot.bid[depth : depth + 2] = [2**40, 7]
+    snapshot.ask_change[depth - 1] = -(2**35)
+    snapshot.bid_changed_at[depth] = 1
+    return state
+
+
+def assert_same_ladder(a, b):
+    for name, _ in COLUMNS:
+        assert np.array_equal(getattr(a, name), getattr(b, name)), name
+    assert (a.start, a.stop, a.seq) == (b.start, b.stop, b.seq)
+
+
+def test_snapshot_and_delta_round_trip():
+    state = source()
+    stream = BookDeltaStream(state)
+    mirror = MirrorState(PAIR, 4)
+
+    frame = decode_frame(stream.render().data)
+    assert frame["kind"] == SNAPSHOT
+    assert frame["pair"] == PAIR
+    assert frame["count"] == 4
+    mirror.apply(frame)
+    assert_same_ladder(state.snapshot, mirror.snapshot)
+    assert stream.render() is None
+
+    snapshot = state.snapshot
+    snapshot.seq = 2
+    snapshot.bid[5] = 2**33 + 1
+    snapshot.bid_change[5] = 2**33 - 6
+    frame = decode_frame(stream.render().data)
+    assert (frame["kind"], frame["base"], frame["seq"]) == (DELTA, 1, 2)
+    assert frame["index"].tolist() == [5]
+    mirror.apply(frame)
+    assert_same_ladder(state.snapshot, mirror.snapshot)
+
+
+def test_resync_notice_is_not_replaced_by_book_frames():
+    class Orderbook:
+        async def resubscribe(self, pair):
+            pass
+
+    async def main():
+        hub = OrderbookHub(depth=4)
+        hub.orderbook = Orderbook()
+        state = hub.pairs[PAIR] = MirrorState(PAIR, 4)
+        subscriber = Subscriber(ws=None)
+        state.clients.add(subscriber)
+
+        subscriber.publish(Frame({"stale": True}), key=("book", PAIR))
+        hub.invalidate(state)
+        # the snapshot of the resubscribed book
+        subscriber.publish(Frame({"fresh": True}), key=("book", PAIR))
+        await asyncio.sleep(0)
+
+        frames = [frame.text for frame in subscriber._latest.values()]
+        assert len(frames) == 2
+        assert '"resync"' in frames[0]
+        assert '"fresh"' in frames[1]
+
+    asyncio.run(main())
@@ -0,0 +1,109 @@
+import asyncio
+
+from handlers.broadcast import Frame, Subscriber, decode, send
+
+
+class FakeWebsocket:
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.sent = []
+        self.times = []
+        self.closed = False
+
+    async def send_text(self, text):
+        await asyncio.sleep(self.delay)
+        self.sent.append(decode(text.encode()))
+        self.times.append(asyncio.get_running_loop().time())
+
+    async def send_bytes(self, data):
+        await asyncio.sleep(self.delay)
+        self.sent.append(data)
+        self.times.append(asyncio.get_running_loop().time())
+
+    async def close(self):
+        self.closed = True
+
+
+def test_keyed_frames_are_conflated_and_unkeyed_frames_kept():
+    async def main():
+        ws = FakeWebsocket()
+        subscriber = Subscriber(ws)
+        subscriber.start()
+        for i in range(5):
+            subscriber.publish(Frame({"book": i}), key="book")
+            subscriber.publish(Frame({"spread": i}), key="spread")
+            subscriber.publish(Frame({"trade": i}))
+        subscriber.publish(lambda: Frame({"book": "rendered"}), key="book")
+        subscriber.publish(lambda: None, key="empty")
+        await asyncio.sleep(0.01)
+
+        # unkeyed frames first and in order, then one frame per key
+        assert ws.sent == [{"trade": i} for i in range(5)] + [
+            {"book": "rendered"},
+            {"spread": 4},
+        ]
+        assert subscriber.conflated == 9
+        assert subscriber.depth == 0
+        subscriber.close()
+
+    asyncio.run(main())
+
+
+def test_binary_frames_are_sent_as_bytes():
+    async def main():
+        ws = FakeWebsocket()
+        await send(ws, Frame.from_bytes(b"\x01\x02"))
+        await send(ws, Frame.from_bytes(b'{"a":1}', binary=False))
+        await send(ws, {"b": 2})
+        assert ws.sent == [b"\x01\x02", {"a": 1}, {"b": 2}]
+
+    asyncio.run(main())
+
+
+def test_slow_clients_are_disconnected():
+    async def main():
+        ws = FakeWebsocket(delay=1.0)
+        subscriber = Subscriber(ws, max_queue=3)
+        subscriber.start()
+        subscriber.publish(Frame({"trade": 0}))
+        # the sender task takes the first frame and waits on the socket
+        await asyncio.sleep(0)
+        for i in range(1, 4):
+            subscriber.publish(Frame({"trade": i}))
+        assert not subscriber.closed
+        # keyed frames do not count against the queue
+        subscriber.publish(Frame({"book": 0}), key="book")
+        assert not subscriber.closed
+
+        subscriber.publish(Frame({"trade": 4}))
+        assert subscriber.closed
+        assert subscriber.dropped == 3
+        assert subscriber.depth == 0
+        await asyncio.sleep(0)
+        assert ws.closed
+        # nothing is queued after the disconnect
+        subscriber.publish(Frame({"trade": 5}))
+        assert subscriber.depth == 0
+
+    asyncio.run(main())
+
+
+def test_outbox_is_drained_at_most_max_rate_times_per_second():
+    async def main():
+        ws = FakeWebsocket()
+        subscriber = Subscriber(ws, max_rate=20)
+        subscriber.start()
+        for i in range(10):
+            subscriber.publish(Frame({"book": i}), key="book")
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.1)
+        subscriber.close()
+
+        # 10 updates over 0.1 s reach the client at 20 frames per second,
+        # the latest one last
+        assert 2 <= len(ws.sent) <= 4
+        assert ws.sent[-1] == {"book": 9}
+        gaps = [b - a for a, b in zip(ws.times, ws.times[1:])]
+        assert all(gap >= 0.045 for gap in gaps)
+
+    asyncio.run(main())
@@ -0,0 +1,39 @@
+import math
+
+from handlers.candles import CandleSeries, merge, subtract
+
+
+def candle(t, o, h, l, c, vwap, volume, count):
+    return [float(t), o, h, l, c, vwap, volume, count]
+
+
+def test_merge_and_subtract():
+    first = candle(60, 10.0, 12.0, 9.0, 11.0, 10.5, 2.0, 3)
+    second = candle(120, 11.0, 15.0, 10.0, 14.0, 13.0, 6.0, 5)
+    merged = merge(first, second, 0.0)
+    assert merged == [0.0, 10.0, 15.0, 9.0, 14.0, 12.375, 8.0, 8]
+    assert merge(None, second, 0.0) == [0.0, *second[1:]]
+
+    base = subtract(merged, second)
+    assert base[:5] == [0.0, 10.0, 15.0, 9.0, 14.0]
+    assert math.isclose(base[5], first[5])
+    assert base[6:] == [2.0, 3]
+    # a candle made of its last minute only
+    minute = candle(0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1)
+    assert subtract(minute, minute) is None
+
+
+def test_series_rolls_up_minutes():
+    series = CandleSeries(5, capacity=2)
+    series.update(candle(0, 10.0, 11.0, 10.0, 11.0, 10.5, 1.0, 1))
+    # a later state of the same minute replaces it
+    series.update(candle(0, 10.0, 12.0, 10.0, 12.0, 11.0, 2.0, 2))
+    series.update(candle(60, 12.0, 13.0, 8.0, 9.0, 10.0, 2.0, 1))
+    assert series.current == [0.0, 10.0, 13.0, 8.0, 9.0, 10.5, 4.0, 3]
+    assert len(series) == 1
+
+    # the next intervals close the open candle, the oldest is overwritten
+    for t in (300, 600, 900):
+        series.update(candle(t, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1))
+    assert series.update(candle(840, *[1.0] * 7)) is False
+    assert series.arrays()[:, 0].tolist() == [300.0, 600.0, 900.0]
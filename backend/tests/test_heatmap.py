@@ -0,0 +1,70 @@
+import math
+
+import numpy as np
+
+from handlers.book import Book
+from handlers.heatmap import MAX_QUERY_ROWS, Heatmap
+
+
+def message(kind, bids=(), asks=()):
+    return {
+        "type": kind,
+        "data": [
+            {
+                "bids": [{"price": p, "qty": q} for p, q in bids],
+                "asks": [{"price": p, "qty": q} for p, q in asks],
+            }
+        ],
+    }
+
+
+def totals(heatmap, resolution):
+    result = heatmap.query(resolution)
+    return result["time"], [sum(row) for row in result["volume"]]
+
+
+def test_rows_roll_up_into_the_coarser_tiers():
+    book = Book("XBT/USD", 1, 8, depth=10)
+    book.apply(message("snapshot", [(100.0, 1.0)], [(100.1, 1.0)]))
+    heatmap = Heatmap(bucket=0.1, width=20)
+    for t in range(0, 26):
+        heatmap.update(book, float(t))
+    # 2 lots for 25 seconds, 4 lots for the last second before the gap
+    book.apply(message("update", [(100.0, 3.0)]))
+    heatmap.update(book, 25.0)
+    heatmap.update(book, 2000.0)
+
+    times, volumes = totals(heatmap, 1)
+    assert times[:26] == [float(t) for t in range(26)]
+    assert volumes[:26] == [2.0] * 25 + [4.0]
+
+    # the open rows were rolled up before the gap reset
+    times, volumes = totals(heatmap, 10)
+    assert times == [0.0, 10.0, 20.0]
+    assert np.allclose(volumes, [2.0, 2.0, 14 / 6])
+    # rows are weighted by the seconds they cover
+    times, volumes = totals(heatmap, 60)
+    assert times == [0.0]
+    assert math.isclose(volumes[0], (25 * 2 + 4) / 26, rel_tol=1e-6)
+
+
+def test_queries_return_the_latest_rows_at_most():
+    book = Book("XBT/USD", 1, 8, depth=10)
+    book.apply(message("snapshot", [(100.0, 1.0)], [(100.1, 1.0)]))
+    heatmap = Heatmap(bucket=0.1, width=20)
+    for t in range(MAX_QUERY_ROWS + 51):
+        heatmap.update(book, float(t))
+
+    result = heatmap.query(1)
+    assert result["truncated"]
+    assert result["time"] == [float(t) for t in range(50, MAX_QUERY_ROWS + 50)]
+    assert len(result["volume"]) == MAX_QUERY_ROWS
+
+    result = heatmap.query(1, start=100.0, max_rows=10)
+    assert result["truncated"]
+    assert result["time"] == [
+        float(t) for t in range(MAX_QUERY_ROWS + 40, MAX_QUERY_ROWS + 50)
+    ]
+    # larger limits are clamped
+    assert len(heatmap.query(1, max_rows=10**9)["time"]) == MAX_QUERY_ROWS
+    assert not heatmap.query(1, start=MAX_QUERY_ROWS + 40.0)["truncated"]
@@ -0,0 +1,66 @@
+import asyncio
+
+from handlers.ohlc_cache import OhlcCache
+
+
+class Clock:
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def cache(clock, max_entries=3):
+    calls = []
+
+    async def fetch(pair, interval, format):
+        calls.append((pair, interval))
+        await asyncio.sleep(0)
+        return f"{pair}-{interval}-{len(calls)}".encode()
+
+    return OhlcCache(fetch, clock=clock, max_entries=max_entries), calls
+
+
+def test_entries_expire_with_their_candle():
+    async def main():
+        clock = Clock(1000.0)
+        ohlc, calls = cache(clock)
+        # concurrent misses share a fetch
+        first, second = await asyncio.gather(
+            ohlc.get("XBT/USD", 1), ohlc.get("XBT/USD", 1)
+        )
+        assert first == second == (b"XBT/USD-1-1", 0.0)
+        clock.now = 1019.0
+        assert await ohlc.get("XBT/USD", 1) == (b"XBT/USD-1-1", 19.0)
+        clock.now = 1020.0
+        assert await ohlc.get("XBT/USD", 1) == (b"XBT/USD-1-2", 0.0)
+        assert (ohlc.hits, ohlc.misses, ohlc.coalesced) == (1, 2, 1)
+
+    asyncio.run(main())
+
+
+def test_expired_and_least_recently_used_entries_are_evicted():
+    async def main():
+        clock = Clock(1000.0)
+        ohlc, calls = cache(clock)
+        await ohlc.get("XBT/USD", 1)
+        await ohlc.get("XBT/USD", 60)
+        await ohlc.get("ETH/USD", 60)
+        await ohlc.get("XBT/USD", 60)
+        # the 1 minute entry expired and is dropped with the next insert
+        clock.now = 1030.0
+        await ohlc.get("SOL/USD", 60)
+        assert [e["pair"] for e in ohlc.stats()["entries"]] == [
+            "ETH/USD",
+            "XBT/USD",
+            "SOL/USD",
+        ]
+        assert ohlc.evicted == 0
+
+        await ohlc.get("ADA/USD", 60)
+        entries = [(e["pair"], e["interval"]) for e in ohlc.stats()["entries"]]
+        assert entries == [("XBT/USD", 60), ("SOL/USD", 60), ("ADA/USD", 60)]
+        assert ohlc.evicted == 1
+
+    asyncio.run(main())
@@ -0,0 +1,107 @@
+import asyncio
+
+import pytest
+
+from handlers.manager import TradingBot
+from handlers.order_entry import OrderEntry, OrderError
+
+
+class Client:
+    """Answers every request with the status ``reply(payload)`` returns"""
+
+    def __init__(self, reply):
+        self.reply = reply
+        self.entry = None
+        self.sent = []
+
+    async def send_message(self, payload, private=False):
+        assert private
+        self.sent.append(payload)
+        status = self.reply(payload)
+        if status is not None:
+            asyncio.get_running_loop().call_soon(self.entry.on_message, status)
+
+
+def entry(reply, timeout=1.0):
+    client = Client(reply)
+    client.entry = OrderEntry(client, timeout=timeout)
+    return client.entry, client
+
+
+def test_statuses_resolve_their_requests():
+    def reply(payload):
+        if payload["event"] == "addOrder":
+            return {
+                "event": "addOrderStatus",
+                "reqid": payload["reqid"],
+                "status": "ok",
+                "txid": "O1",
+            }
+        return {
+            "event": "cancelOrderStatus",
+            "reqid": payload["reqid"],
+            "status": "error",
+            "errorMessage": "EOrder:Unknown order",
+        }
+
+    async def main():
+        orders, client = entry(reply)
+        added = await orders.add_order("limit", "buy", "XBT/USD", 0.5, price=100.0)
+        assert added["txid"] == "O1"
+        assert added["latency"] >= 0
+        assert client.sent[0] == {
+            "event": "addOrder",
+            "ordertype": "limit",
+            "type": "buy",
+            "pair": "XBT/USD",
+            "volume": "0.5",
+            "price": "100.0",
+            "reqid": 1,
+        }
+        with pytest.raises(OrderError, match="Unknown order"):
+            await orders.cancel_order(["O2"])
+        assert orders.pending == {}
+        # statuses of other requests and other messages
+        assert orders.on_message({"event": "addOrderStatus", "reqid": 99})
+        assert not orders.on_message({"event": "heartbeat"})
+
+    asyncio.run(main())
+
+
+def test_requests_without_status_time_out():
+    async def main():
+        orders, _ = entry(lambda payload: None, timeout=0.01)
+        with pytest.raises(asyncio.TimeoutError):
+            await orders.cancel_all()
+        assert orders.pending == {}
+
+    asyncio.run(main())
+
+
+def test_failed_position_closes_return_none():
+    class Bot:
+        async def get_best_bid_ask(self, pair):
+            return 99.0, 101.0
+
+    def reply(payload):
+        if payload["ordertype"] == "market":
+            return {
+                "event": "addOrderStatus",
+                "reqid": payload["reqid"],
+                "status": "error",
+                "errorMessage": "EOrder:Insufficient margin",
+            }
+        return None
+
+    async def main():
+        bot = Bot()
+        bot.order_entry, client = entry(reply, timeout=0.01)
+        position = {"pair": "XBT/USD", "type": "buy", "leverage": "5", "vol": "1.0"}
+        for market in (True, False):
+            assert await TradingBot.close_position(bot, position, market=market) is None
+        market, limit = client.sent
+        assert "validate" not in market and "price" not in market
+        assert market["reduce_only"] and market["type"] == "sell"
+        assert limit["price"] == "101.0"
+
+    asyncio.run(main())
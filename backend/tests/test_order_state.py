@@ -0,0 +1,206 @@
+import asyncio
+
+from handlers.channels import ChannelRouter
+from handlers.order_state import OrderState
+
+
+class Client:
+    """Stands in for the Kraken websocket client of the router"""
+
+    async def subscribe(self, subscription, pair=None):
+        pass
+
+    async def unsubscribe(self, subscription, pair=None):
+        pass
+
+
+def order(txid, side="buy", leverage="none"):
+    return {
+        txid: {
+            "status": "open",
+            "descr": {"pair": "XBT/USD", "type": side, "leverage": leverage},
+            "vol": "1.00000000",
+            "vol_exec": "0.00000000",
+        }
+    }
+
+
+def private(name, payload, sequence=1):
+    return [payload, name, {"sequence": sequence}]
+
+
+def subscribed(name):
+    return {
+        "event": "subscriptionStatus",
+        "status": "subscribed",
+        "channelName": name,
+        "subscription": {"name": name},
+    }
+
+
+def run(test):
+    """Runs ``test(state, router)`` against a state seeded with ``rest``"""
+
+    async def main(rest_orders, rest_positions):
+        async def fetch_orders():
+            return dict(rest_orders)
+
+        async def fetch_positions():
+            return dict(rest_positions)
+
+        router = ChannelRouter(Client())
+        state = OrderState(fetch_orders, fetch_positions, reconcile_interval=3600)
+        await state.start(router)
+        try:
+            await test(state, router, rest_orders, rest_positions)
+        finally:
+            await state.close()
+
+    return lambda orders=None, positions=None: asyncio.run(
+        main(orders or {}, positions or {})
+    )
+
+
+def test_updates_and_diffs():
+    async def test(state, router, rest_orders, rest_positions):
+        router.on_message(subscribed("openOrders"))
+        router.on_message(private("openOrders", [order("O1"), order("O2")]))
+        assert set(state.orders) == {"O1", "O2"}
+        seen = state.seq
+
+        router.on_message(
+            private("openOrders", [{"O1": {"vol_exec": "0.50000000"}}], 2)
+        )
+        router.on_message(private("openOrders", [{"O2": {"status": "canceled"}}], 3))
+        assert state.orders["O1"]["vol_exec"] == "0.50000000"
+        assert state.orders["O1"]["descr"]["type"] == "buy"
+
+        diff = state.to_payload(seen)
+        assert diff["type"] == "update"
+        assert diff["orders"] == {"O1": state.orders["O1"], "O2": None}
+        snapshot = state.to_payload()
+        assert snapshot["type"] == "snapshot"
+        assert list(snapshot["orders"]) == ["O1"]
+
+    run(test)()
+
+
+def test_snapshot_after_resubscribe_replaces_the_orders():
+    async def test(state, router, rest_orders, rest_positions):
+        router.on_message(subscribed("openOrders"))
+        router.on_message(private("openOrders", [order("O1"), order("O2")]))
+        seen = state.seq
+
+        # reconnect: O2 was filled while the connection was down
+        router.on_message(subscribed("openOrders"))
+        assert not state.ready
+        router.on_message(private("openOrders", [order("O1"), order("O3")]))
+        assert state.ready
+        assert set(state.orders) == {"O1", "O3"}
+        diff = state.to_payload(seen)
+        assert diff["orders"] == {"O2": None, "O3": state.orders["O3"]}
+
+        # a later message is an update again
+        router.on_message(private("openOrders", [{"O1": {"status": "closed"}}], 2))
+        assert set(state.orders) == {"O3"}
+
+    run(test)()
+
+
+def test_reconcile_keeps_changes_made_during_the_call():
+    async def test(state, router, rest_orders, rest_positions):
+        assert state.ready
+        assert set(state.orders) == {"O1"}
+        # REST still lists O1, which a websocket message canceled meanwhile
+        start = state.seq
+        router.on_message(private("openOrders", [{"O1": {"status": "canceled"}}], 2))
+        state._replace("orders", state.orders, rest_orders, start, state._set_order)
+        assert state.orders == {}
+
+    run(test)({**order("O1")})
+
+
+def test_trades_open_and_close_positions():
+    async def test(state, router, rest_orders, rest_positions):
+        router.on_message(private("openOrders", [order("O1", leverage="5:1")]))
+        router.on_message(subscribed("ownTrades"))
+        router.on_message(private("ownTrades", []))
+        trade = {
+            "ordertxid": "O1",
+            "postxid": "P1",
+            "pair": "XBT/USD",
+            "time": 4e9,
+            "type": "buy",
+            "ordertype": "market",
+            "price": "100.00000",
+            "cost": "100.00000",
+            "fee": "0.26000",
+            "vol": "1.00000000",
+            "margin": "20.00000",
+        }
+        router.on_message(private("ownTrades", [{"T1": trade}]))
+        position = state.positions["P1"]
+        assert position["leverage"] == "5"
+        assert position["margin"] == "20.00000"
+
+        # the same trade again changes nothing
+        router.on_message(private("ownTrades", [{"T1": trade}]))
+        assert state.positions["P1"]["vol"] == "1.00000000"
+
+        closing = {**trade, "ordertxid": "O2", "type": "sell", "vol": "0.40000000"}
+        router.on_message(private("ownTrades", [{"T2": closing}]))
+        assert state.positions["P1"]["vol_closed"] == "0.40000000"
+        router.on_message(
+            private("ownTrades", [{"T3": {**closing, "vol": "0.60000000"}}])
+        )
+        assert state.positions == {}
+
+    run(test)()
+
+
+def test_trades_snapshot_is_not_applied():
+    async def main():
+        seeded = asyncio.Event()
+
+        async def fetch_orders():
+            return {}
+
+        async def fetch_positions():
+            await seeded.wait()
+            # P0 of an earlier fill of O1 was closed since
+            return {}
+
+        router = ChannelRouter(Client())
+        state = OrderState(fetch_orders, fetch_positions, reconcile_interval=3600)
+        start = asyncio.create_task(state.start(router))
+        # the REST calls are running
+        for _ in range(3):
+            await asyncio.sleep(0)
+        router.on_message(subscribed("openOrders"))
+        router.on_message(private("openOrders", [order("O1", leverage="5:1")]))
+        # the latest trades arrive while the positions are fetched
+        router.on_message(subscribed("ownTrades"))
+        fill = {
+            "ordertxid": "O1",
+            "postxid": "P0",
+            "pair": "XBT/USD",
+            "time": 1e9,
+            "type": "buy",
+            "ordertype": "limit",
+            "cost": "50.00000",
+            "fee": "0.13000",
+            "vol": "0.50000000",
+        }
+        router.on_message(private("ownTrades", [{"T0": fill}]))
+        seeded.set()
+        await start
+        assert state.positions == {}
+
+        # trades of the snapshot are not applied when they come again
+        router.on_message(private("ownTrades", [{"T0": {**fill, "time": 4e9}}], 2))
+        assert state.positions == {}
+        router.on_message(private("ownTrades", [{"T1": {**fill, "time": 4e9}}], 3))
+        assert state.positions["P0"]["vol"] == "0.50000000"
+        await state.close()
+
+    asyncio.run(main())
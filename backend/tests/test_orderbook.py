@@ -0,0 +1,140 @@
+import asyncio
+
+from handlers.book import Book
+from handlers.orderbook import OrderbookHub, parse_request
+from handlers.shards import ShardWorker
+
+
+class WebSocket:
+    """Feeds ``messages`` to the hub and collects the frames sent back"""
+
+    def __init__(self, messages):
+        self.query_params = {}
+        self.received = [{"type": "websocket.receive", **m} for m in messages]
+        self.sent = []
+
+    async def accept(self):
+        pass
+
+    async def receive(self):
+        if self.received:
+            return self.received.pop(0)
+        # lets the sender task drain the outbox before disconnecting
+        await asyncio.sleep(0.05)
+        return {"type": "websocket.disconnect", "code": 1000}
+
+    async def send_text(self, text):
+        self.sent.append(text)
+
+    async def close(self):
+        pass
+
+
+def test_parse_request():
+    assert parse_request('{"event": "subscribe", "pairs": ["XBT/USD"]}') == (
+        {"event": "subscribe", "pairs": ["XBT/USD"]},
+        None,
+    )
+    assert parse_request(b'{"event": "resync", "pair": "XBT/USD"}')[1] is None
+    assert parse_request("{") == (None, "invalid JSON")
+    assert parse_request("[]") == (None, "expected an object")
+    assert parse_request('{"event": "subscribe"}')[1] == "pairs must be a list of pairs"
+    assert parse_request('{"event": "unsubscribe", "pairs": "XBT/USD"}')[1]
+    assert parse_request('{"event": "subscribe", "pairs": [1]}')[1]
+    assert parse_request('{"event": "resync"}') == (None, "pair is required")
+    assert parse_request('{"event": "ping"}') == (None, "unknown event")
+    # the binary protocol has a 1 byte pair length
+    long = '{"event": "subscribe", "pairs": ["%s"]}' % ("\u00e9" * 128)
+    assert parse_request(long) == (None, "pairs must be at most 255 bytes")
+
+
+def test_serve_answers_malformed_requests_with_errors():
+    ws = WebSocket(
+        [
+            {"text": "not json"},
+            {"bytes": b'{"event": "subscribe", "pairs": null}'},
+            {"text": '{"event": "unsubscribe", "pairs": ["XBT/USD"]}'},
+            {"text": '{"event": "resync", "pair": "XBT/USD"}'},
+        ]
+    )
+    asyncio.run(OrderbookHub().serve(ws, []))
+    assert ws.sent == [
+        '{"event":"error","error":"invalid JSON"}',
+        '{"event":"error","error":"pairs must be a list of pairs"}',
+    ]
+
+
+class FakeOrderbook:
+    """Records the book subscriptions of the hub"""
+
+    exception_occur = False
+
+    def __init__(self):
+        self.calls = []
+
+    async def add_book(self, pairs):
+        self.calls.append(("add", pairs))
+
+    async def remove_book(self, pairs):
+        self.calls.append(("remove", pairs))
+
+
+def test_books_are_released_after_their_last_client():
+    async def main():
+        hub = OrderbookHub(known=lambda pair: pair.endswith("/USD"), release_delay=0)
+        hub.orderbook = FakeOrderbook()
+        hub.users.pin(["BTC/USD"])
+        await hub.add_pairs(["BTC/USD"])
+        ws = WebSocket(
+            [
+                {"text": '{"event": "subscribe", "pairs": ["FOO/EUR"]}'},
+                {"text": '{"event": "subscribe", "pairs": ["ETH/USD", "ETH/USD"]}'},
+            ]
+        )
+        await hub.serve(ws, ["BTC/USD"])
+        assert ws.sent == ['{"event":"error","error":"unknown pairs FOO/EUR"}']
+        assert "FOO/EUR" not in hub.pairs
+        await asyncio.sleep(0.01)
+        # the startup pair stays
+        assert hub.orderbook.calls == [
+            ("add", ["BTC/USD"]),
+            ("add", ["ETH/USD"]),
+            ("remove", ["ETH/USD"]),
+        ]
+        assert list(hub.pairs) == ["BTC/USD"]
+        assert hub.users.counts == {}
+
+    asyncio.run(main())
+
+
+def test_shard_workers_keep_no_heatmaps():
+    async def main():
+        hub = ShardWorker("unused", depth=10, retention=60).hub
+        hub.orderbook = FakeOrderbook()
+        await hub.add_pairs(["BTC/USD"])
+        state = hub.pairs["BTC/USD"]
+        assert state.heatmap is None
+
+        book = Book("BTC/USD", 1, 8, depth=10)
+        message = {
+            "type": "snapshot",
+            "data": [
+                {
+                    "bids": [{"price": 100.0, "qty": 1.0}],
+                    "asks": [{"price": 100.1, "qty": 2.0}],
+                    "checksum": 0,
+                }
+            ],
+        }
+        book.apply(message)
+        state.update(book, message)
+        assert state.imbalance["value"] == -1 / 3
+        assert hub.get_heatmap("BTC/USD", 1) is None
+
+        # the single process hub keeps them
+        hub = OrderbookHub()
+        hub.orderbook = FakeOrderbook()
+        await hub.add_pairs(["BTC/USD"])
+        assert hub.pairs["BTC/USD"].heatmap is not None
+
+    asyncio.run(main())
@@ -0,0 +1,81 @@
+import asyncio
+
+from handlers.pairs import AssetPairs, PairUsers
+
+
+def test_known_pairs():
+    asset_pairs = AssetPairs(["BTC/USD"])
+    assert asset_pairs.known("BTC/USD")
+    assert not asset_pairs.known("XBT/USD")
+    asset_pairs.update(
+        {
+            "XXBTZUSD": {"altname": "XBTUSD", "wsname": "XBT/USD"},
+            "XDGEUR": {"altname": "XDGEUR", "wsname": "XDG/EUR"},
+            "ETHUSDT": {"altname": "ETHUSDT", "wsname": "ETH/USDT"},
+            # dark pools have no websocket name
+            "XXBTZUSD.d": {"altname": "XBTUSD.d"},
+        }
+    )
+    for pair in ("XBT/USD", "BTC/USD", "XDG/EUR", "DOGE/EUR", "ETH/USDT"):
+        assert asset_pairs.known(pair), pair
+    assert not asset_pairs.known("XBTUSD")
+    assert not asset_pairs.known("FOO/BAR")
+    assert not asset_pairs.known(None)
+
+
+def test_pairs_are_released_after_their_last_user():
+    async def main():
+        released = []
+
+        async def release(pair):
+            released.append(pair)
+
+        users = PairUsers(release, delay=0.1)
+        users.pin(["BTC/USD"])
+        users.acquire("BTC/USD")
+        users.release("BTC/USD")
+        users.acquire("ETH/USD")
+        users.acquire("ETH/USD")
+        users.release("ETH/USD")
+        await asyncio.sleep(0.2)
+        assert released == []
+
+        users.release("ETH/USD")
+        await asyncio.sleep(0.05)
+        # a user back within the delay keeps the pair
+        users.acquire("ETH/USD")
+        await asyncio.sleep(0.2)
+        assert released == []
+
+        users.release("ETH/USD")
+        users.touch("SOL/USD")
+        await asyncio.sleep(0.05)
+        # every request keeps it for another delay
+        users.touch("SOL/USD")
+        await asyncio.sleep(0.08)
+        assert released == ["ETH/USD"]
+        await asyncio.sleep(0.1)
+        assert released == ["ETH/USD", "SOL/USD"]
+        assert users.counts == {}
+
+    asyncio.run(main())
+
+
+def test_new_users_wait_for_a_running_release():
+    async def main():
+        events = []
+
+        async def release(pair):
+            events.append("release")
+            await asyncio.sleep(0.02)
+            events.append("released")
+
+        users = PairUsers(release, delay=0)
+        users.touch("ETH/USD")
+        await asyncio.sleep(0.005)
+        users.acquire("ETH/USD")
+        await users.settled("ETH/USD")
+        events.append("added")
+        assert events == ["release", "released", "added"]
+
+    asyncio.run(main())
@@ -0,0 +1,117 @@
+import json
+from pathlib import Path
+
+from handlers.book import Book
+from handlers.book_snapshot import BookSnapshot
+from handlers.pulling_stacking import PULLING_STACKING_CLEANUP_INTERVAL
+
+# BTC/USD book messages at depth 10 recorded from python -m mock_kraken
+FIXTURE = Path(__file__).parent / "fixtures" / "book_btc_usd_depth10.jsonl"
+DEPTH = 10
+
+
+def pulling_stacking(book, prev_book):
+    """The full recompute of the ladder before the incremental tracker"""
+    for b in book:
+        price = b["price"]
+        if b["ask"] != 0:
+            prev_ask = (
+                prev_book[price]["ask"] if prev_book and price in prev_book else 0
+            )
+            ask_ps = b["ask"] - prev_ask
+            if (
+                prev_book
+                and ask_ps == 0
+                and price in prev_book
+                and "ask_ps" in prev_book[price]
+                and "ask_ps_history" in prev_book[price]
+                and prev_book[price]["ask_ps_history"]
+                < PULLING_STACKING_CLEANUP_INTERVAL
+            ):
+                b["ask_ps"] = prev_book[price]["ask_ps"]
+                b["ask_ps_history"] = prev_book[price]["ask_ps_history"] + 1
+            else:
+                b["ask_ps"] = ask_ps
+
+        if b["bid"] != 0:
+            prev_bid = (
+                prev_book[price]["bid"] if prev_book and price in prev_book else 0
+            )
+            bid_ps = b["bid"] - prev_bid
+            if (
+                prev_book
+                and bid_ps == 0
+                and price in prev_book
+                and "bid_ps" in prev_book[price]
+                and "bid_ps_history" in prev_book[price]
+                and prev_book[price]["bid_ps_history"]
+                < PULLING_STACKING_CLEANUP_INTERVAL
+            ):
+                b["bid_ps"] = prev_book[price]["bid_ps"]
+                b["bid_ps_history"] = prev_book[price]["bid_ps_history"] + 1
+            else:
+                b["bid_ps"] = bid_ps
+
+
+def transform_book(bids, asks, depth, prev_book):
+    """The rows of the full recompute, from the sides best level first"""
+    bid_volume = [round(qty) for _, qty in bids]
+    ask_volume = [round(qty) for _, qty in asks][::-1]
+    price = [p for p, _ in asks][::-1] + [p for p, _ in bids]
+    rows = [
+        {
+            "bid": bid,
+            "price": price,
+            "ask": ask,
+            "ask_ps": 0,
+            "bid_ps": 0,
+            "ask_ps_history": 0,
+            "bid_ps_history": 0,
+        }
+        for bid, price, ask in zip(
+            [0] * depth + bid_volume, price, ask_volume + [0] * depth
+        )
+    ]
+    pulling_stacking(rows, prev_book)
+    return rows, {row["price"]: row for row in rows}
+
+
+def apply(levels, message, depth):
+    """Applies a message to price -> qty dicts, truncated like Kraken does"""
+    data = message["data"][0]
+    if message["type"] == "snapshot":
+        levels["bids"].clear()
+        levels["asks"].clear()
+    for side in ("asks", "bids"):
+        for order in data[side]:
+            if order["qty"]:
+                levels[side][order["price"]] = order["qty"]
+            else:
+                levels[side].pop(order["price"], None)
+            kept = sorted(levels[side], reverse=side == "bids")[:depth]
+            levels[side] = {price: levels[side][price] for price in kept}
+    return [
+        sorted(levels[side].items(), reverse=side == "bids")
+        for side in ("bids", "asks")
+    ]
+
+
+def test_incremental_ladder_matches_the_full_recompute():
+    messages = [json.loads(line) for line in FIXTURE.read_text().splitlines()]
+    assert messages[0]["type"] == "snapshot"
+    book = Book("BTC/USD", 1, 8, DEPTH)
+    snapshot = BookSnapshot(DEPTH)
+    levels = {"bids": {}, "asks": {}}
+    prev_book = None
+    carried = 0
+    for message in messages:
+        book.apply(message)
+        snapshot.update(book, message)
+        bids, asks = apply(levels, message, DEPTH)
+        expected, prev_book = transform_book(bids, asks, DEPTH, prev_book)
+        assert snapshot.to_rows() == expected
+        carried += sum(
+            row["bid_ps_history"] + row["ask_ps_history"] for row in expected
+        )
+    # the stream exercises carried over changes
+    assert carried
@@ -0,0 +1,31 @@
+from handlers.ring_buffer import RingBuffer
+
+
+def test_wraparound_keeps_the_newest_points_in_order():
+    ring = RingBuffer(4)
+    assert ring.to_points() == []
+    for t in range(1, 4):
+        ring.push(float(t), t * 10.0)
+    assert len(ring) == 3
+    assert ring.arrays()[0].tolist() == [1.0, 2.0, 3.0]
+
+    for t in range(4, 11):
+        ring.push(float(t), t * 10.0)
+    assert len(ring) == 4
+    time, value = ring.arrays()
+    assert time.tolist() == [7.0, 8.0, 9.0, 10.0]
+    assert value.tolist() == [70.0, 80.0, 90.0, 100.0]
+    # copies, the ring is not changed through them
+    time[:] = 0
+    assert ring.arrays()[0].tolist() == [7.0, 8.0, 9.0, 10.0]
+
+
+def test_retention_is_relative_to_the_newest_point():
+    ring = RingBuffer(8, retention=2.5)
+    for t in (0.0, 1.0, 2.0, 2.5, 4.0, 5.0):
+        ring.push(t, t)
+    assert ring.to_points() == [
+        {"time": 2.5, "value": 2.5},
+        {"time": 4.0, "value": 4.0},
+        {"time": 5.0, "value": 5.0},
+    ]
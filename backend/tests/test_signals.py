@@ -0,0 +1,172 @@
+import asyncio
+import math
+import random
+
+import numpy as np
+
+from handlers.book import Book
+from handlers.signals import (
+    SIGNALS,
+    BookSlope,
+    DecayedDepth,
+    PullingStackingIntensity,
+    SignalEngine,
+    SignalSeries,
+    WeightedImbalance,
+)
+
+
+def message(kind, bids=(), asks=()):
+    return {
+        "type": kind,
+        "data": [
+            {
+                "bids": [{"price": p, "qty": q} for p, q in bids],
+                "asks": [{"price": p, "qty": q} for p, q in asks],
+            }
+        ],
+    }
+
+
+def brute_force(depth):
+    """The weighted lots of a side computed from its levels"""
+    side = depth.side
+    ticks, qty = side.levels()
+    best = side.best()[0]
+    distance = np.abs(ticks - best)
+    return float(qty @ np.exp(-distance / depth.scale))
+
+
+def test_decayed_depth_follows_the_book():
+    rng = random.Random(7)
+    book = Book("XBT/USD", 1, 8, depth=25)
+    bids = [(100.0 - i * 0.1, 1.0) for i in range(25)]
+    asks = [(100.1 + i * 0.1, 1.0) for i in range(25)]
+    book.apply(message("snapshot", bids, asks))
+    bid, ask = DecayedDepth(book.bid, 20.0), DecayedDepth(book.ask, 20.0)
+
+    mid = 100.05
+    for step in range(3000):
+        if step == 1500:
+            # a snapshot far away, past the float range of the anchor
+            mid = 160.0
+            book.apply(
+                message(
+                    "snapshot",
+                    [(mid - 0.05 - i * 0.1, 2.0) for i in range(25)],
+                    [(mid + 0.05 + i * 0.1, 2.0) for i in range(25)],
+                )
+            )
+        mid += rng.choice((-0.1, 0.0, 0.1))
+        levels = []
+        for _ in range(rng.randint(1, 4)):
+            offset = round(rng.randint(1, 40) * 0.1, 1)
+            qty = rng.choice((0.0, 0.5, 1.0, 3.0))
+            levels.append((round(mid - offset, 1), qty))
+        book.apply(message("update", bids=levels))
+        levels = [
+            (round(mid + offset, 1), qty)
+            for (p, qty), offset in zip(
+                levels, (round(rng.randint(1, 40) * 0.1, 1) for _ in levels)
+            )
+        ]
+        book.apply(message("update", asks=levels))
+        if book.bid.best() is None or book.ask.best() is None:
+            continue
+        if step % 50 == 0:
+            assert math.isclose(bid.value(), brute_force(bid), rel_tol=1e-9)
+            assert math.isclose(ask.value(), brute_force(ask), rel_tol=1e-9)
+
+
+def test_weighted_imbalance_and_slope():
+    book = Book("XBT/USD", 1, 8, depth=500)
+    # a bid every tick and an ask every second tick, the decay length is
+    # about 43 ticks
+    book.apply(
+        message(
+            "snapshot",
+            [(15000.0 - i * 0.1, 1.0) for i in range(500)],
+            [(15000.1 + i * 0.2, 1.0) for i in range(500)],
+        )
+    )
+    imbalance = WeightedImbalance("XBT/USD")
+    (value,) = imbalance.on_book(book, 0.0)
+    assert math.isclose(value, 1 / 3, rel_tol=0.02)
+
+    slope = BookSlope("XBT/USD")
+    bid, ask = slope.on_book(book, 0.0)
+    # 1 per 0.1 and 1 per 0.2 of the price
+    assert math.isclose(bid, 10.0, rel_tol=1e-4)
+    assert math.isclose(ask, 5.0, rel_tol=0.02)
+
+    # the signals follow updates without rescanning the book
+    book.apply(message("update", asks=[(15000.1, 0.0), (15000.3, 0.0)]))
+    (after,) = imbalance.on_book(book, 1.0)
+    assert after > value
+
+
+def test_pulling_stacking_counts_lots():
+    book = Book("XBT/USD", 1, 8, depth=10)
+    book.apply(message("snapshot", [(100.0, 1.0)], [(100.1, 1.0)]))
+    signal = PullingStackingIntensity("XBT/USD")
+    signal.on_book(book, 0.0)
+    book.apply(message("update", bids=[(100.0, 3.0)], asks=[(100.1, 0.0)]))
+    pulling, stacking = signal.on_book(book, 0.0)
+    assert math.isclose(pulling * signal.tau, 1.0)
+    assert math.isclose(stacking * signal.tau, 2.0)
+
+
+def test_book_signals_need_local_books():
+    class ShardedHub:
+        keeps_books = False
+        listeners = []
+
+    engine = SignalEngine()
+    engine.start(ShardedHub(), router=None)
+    assert not ShardedHub.listeners
+    assert not engine.available("weighted_imbalance")
+    assert engine.available("spread_ewma")
+
+
+def test_engine_keeps_watchers_off_the_hub_books():
+    class Hub:
+        keeps_books = True
+        listeners = []
+
+    async def main():
+        rng = random.Random(5)
+        engine = SignalEngine(names=["weighted_imbalance", "microprice"])
+        engine.start(Hub(), router=None)
+        engine.pairs["XBT/USD"] = {
+            name: SignalSeries(SIGNALS[name]("XBT/USD"), 60.0) for name in engine.names
+        }
+        book = Book("XBT/USD", 1, 8, depth=25)
+        for step in range(300):
+            if step % 100 == 0:
+                msg = message(
+                    "snapshot",
+                    [(100.0 - i * 0.1, 1.0) for i in range(25)],
+                    [(100.1 + i * 0.1, 1.0) for i in range(25)],
+                )
+            else:
+                side = rng.choice(("bids", "asks"))
+                sign = -1 if side == "bids" else 1
+                levels = [
+                    (round(100.05 + sign * (0.05 + rng.randint(0, 40) * 0.1), 1), qty)
+                    for qty in rng.choices((0.0, 0.5, 2.0), k=rng.randint(1, 3))
+                ]
+                msg = message("update", **{side: levels})
+            book.apply(msg)
+            for listener in Hub.listeners:
+                listener("XBT/USD", None, book, msg)
+            if step % 7 == 0:
+                # several updates per run
+                await asyncio.sleep(0)
+                assert not book.bid.watchers and not book.ask.watchers
+                series = engine.pairs["XBT/USD"]["weighted_imbalance"]
+                expected = WeightedImbalance("XBT/USD").on_book(book.copy(), 0.0)
+                assert len(series.values) == 1
+                assert math.isclose(series.values[0], expected[0], rel_tol=1e-9)
+                assert series.signal.book is not book
+
+    asyncio.run(main())
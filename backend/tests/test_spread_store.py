@@ -0,0 +1,83 @@
+import math
+import random
+import time
+
+from handlers.spread_store import (
+    HISTORY_POINTS,
+    QUOTE_MAX_AGE,
+    WINDOWS,
+    SpreadHub,
+    SpreadStore,
+)
+
+
+def brute_force(quotes, seconds):
+    """Statistics of the window from the kept quotes"""
+    now = quotes[-1][0]
+    window = [(t, spread) for t, spread in quotes if t > now - seconds]
+    if not window:
+        return None
+    spreads = [spread for _, spread in window]
+    held = sum((t1 - t0) * spread for (t0, spread), (t1, _) in zip(window, window[1:]))
+    duration = now - window[0][0]
+    return {
+        "mean": sum(spreads) / len(spreads),
+        "max": max(spreads),
+        "time_weighted": held / duration if duration > 0 else spreads[-1],
+        "rate": len(spreads) / seconds,
+    }
+
+
+def test_window_stats_follow_the_quotes():
+    rng = random.Random(3)
+    store = SpreadStore("XBT/USD", capacity=64)
+    quotes = []
+    t = 1000.0
+    for step in range(2000):
+        # bursts and gaps longer than the windows
+        t += rng.choice((0.0, 0.01, 0.2, 3.0, 90.0 if step % 400 == 0 else 0.5))
+        bid = 100.0 + rng.randint(0, 20) * 0.1
+        spread = rng.randint(1, 10) * 0.1
+        store.push(t, bid, bid + spread, 1.0, 1.0)
+        quotes = (quotes + [(t, store.spread[step % 64])])[-64:]
+
+        stats = store.stats()
+        for seconds in WINDOWS:
+            expected = brute_force(quotes, seconds)
+            actual = stats.get(str(seconds))
+            assert (actual is None) == (expected is None)
+            if expected is None:
+                continue
+            for name, value in expected.items():
+                assert math.isclose(actual[name], value, rel_tol=1e-9, abs_tol=1e-9)
+
+
+def test_history_buckets():
+    store = SpreadStore("XBT/USD", capacity=16)
+    for i in range(10):
+        store.push(float(i), 100.0, 100.0 + (i % 3 + 1) * 0.5, 1.0, 1.0)
+
+    history = store.history(points=3, seconds=9.0)
+    assert history["time"] == [0.0, 3.0, 6.0]
+    assert history["min"] == [0.5, 0.5, 0.5]
+    assert history["max"] == [1.5, 1.5, 1.5]
+    # the last bucket ends with the latest quote
+    assert history["last"] == [1.5, 1.5, 0.5]
+    assert history["ask"] == [101.5, 101.5, 100.5]
+
+    # points are clamped
+    assert len(store.history(points=0, seconds=9.0)["time"]) == 1
+    assert store.history(points=10**9, seconds=9.0)["bucket"] == 9.0 / HISTORY_POINTS
+
+
+def test_stale_quotes_are_not_served():
+    hub = SpreadHub()
+    store = hub.stores["BTC/USD"] = hub._keys["BTCUSD"] = SpreadStore("BTC/USD", 4)
+    assert hub.quote("XBT/USD") is None
+    t = time.time() - QUOTE_MAX_AGE - 1.0
+    store.push(t, 100.0, 100.5, 1.0, 1.0)
+    assert hub.quote("XBT/USD") is None
+    assert hub.quote("XBT/USD", max_age=None) == (100.0, 100.5)
+    assert store.quote(max_age=QUOTE_MAX_AGE, now=t + 1.0) == (100.0, 100.5)
+    store.push(time.time(), 100.0, 101.0, 1.0, 1.0)
+    assert hub.quote("XBT/USD") == (100.0, 101.0)
@@ -0,0 +1,78 @@
+import math
+import random
+
+import numpy as np
+
+from handlers.broadcast import decode
+from handlers.trade_flow import CVD_WINDOWS, PROFILE_WINDOW, TradeFlow, TradeFlowStream
+
+DAY = 24 * 60 * 60
+
+
+def trade(price, volume, t, side):
+    # as Kraken sends them: [price, volume, time, side, order type, misc]
+    return [f"{price:.1f}", f"{volume:.8f}", f"{t:.6f}", side, "l", ""]
+
+
+def test_cvd_and_profile_follow_the_trades():
+    rng = random.Random(2)
+    flow = TradeFlow("XBT/USD", bucket=1.0, capacity=500)
+    kept = []
+    t = 10 * DAY + 0.5
+    for _ in range(1500):
+        t += rng.choice((0.05, 1.0, 5.0, 30.0, 400.0 if rng.random() < 0.01 else 2.0))
+        message = []
+        for _ in range(rng.randint(1, 4)):
+            side = rng.choice("bs")
+            volume = rng.choice((0.1, 0.5, 2.0))
+            price = rng.randint(950, 1050) / 10 * 10
+            message.append(trade(price, volume, t, side))
+            kept.append((t, price, volume if side == "b" else -volume))
+        flow.on_message(message)
+        kept = kept[-500:]
+
+        for window, seconds in zip(flow.windows, (*CVD_WINDOWS, PROFILE_WINDOW)):
+            expected = [(p, v) for ts, p, v in kept if ts > t - seconds]
+            assert math.isclose(
+                window.cvd, sum(v for _, v in expected), abs_tol=1e-9
+            ), seconds
+        profile = flow.profile_window.profile.to_payload(flow.bucket)
+        expected = {}
+        for ts, p, v in kept:
+            if ts > t - PROFILE_WINDOW:
+                buy, sell = expected.get(p, (0.0, 0.0))
+                expected[p] = (buy + max(v, 0), sell + max(-v, 0))
+        expected = {p: bs for p, bs in expected.items() if bs != (0.0, 0.0)}
+        assert profile["price"] == sorted(expected)
+        assert np.allclose(profile["buy"], [expected[p][0] for p in profile["price"]])
+        assert np.allclose(profile["sell"], [expected[p][1] for p in profile["price"]])
+
+
+def test_session_footprint_and_deltas():
+    flow = TradeFlow("XBT/USD", bucket=10.0)
+    stream = TradeFlowStream(flow)
+    start = 10 * DAY - 90
+    flow.on_message(
+        [trade(1000.0, 1.0, start, "b"), trade(1015.0, 0.5, start + 1, "s")]
+    )
+    snapshot = decode(stream.render().data)
+    assert snapshot["event"] == "snapshot"
+    assert snapshot["cvd"]["session"] == 0.5
+    assert snapshot["footprint"]["price"] == [1000.0, 1010.0]
+
+    # the next candle closes the footprint, a later message the session
+    flow.on_message([trade(1020.0, 2.0, start + 60, "b")])
+    delta = decode(stream.render().data)
+    assert delta["event"] == "delta"
+    assert delta["base"] == snapshot["seq"]
+    assert delta["profile"]["session"]["price"] == [1020.0]
+    assert [c["time"] for c in delta["closed"]] == [start - start % 60]
+    assert delta["closed"][0]["buy"] == [1.0, 0.0]
+    assert delta["closed"][0]["sell"] == [0.0, 0.5]
+
+    flow.on_message([trade(1020.0, 1.0, 10 * DAY + 5, "s")])
+    assert decode(stream.render().data)["event"] == "snapshot"
+    assert flow.cvd()["session"] == -1.0
+    # the rolling windows span midnight
+    assert flow.cvd()["60"] == 1.0
+    assert flow.cvd()["300"] == 1.5
@@ -92,7 +92,7 @@ export default function Chartview() {
   useEffect(() => {
     if (ohlcLastMessage?.data) {
       const [time, etime, open, high, low, close, vwap, volume, count] =
-        JSON.parse(JSON.parse(ohlcLastMessage?.data));
+        JSON.parse(ohlcLastMessage?.data);
       if (lastTimestamp && time > lastTimestamp) {
         if (candleStickSeries) {
           candleStickSeries.update({
@@ -23,7 +23,7 @@ export default function Spread({ pair }: Props) {
 
   useEffect(() => {
     if (spreadLastMessage?.data) {
-      debouncedSetDataHandler(JSON.parse(JSON.parse(spreadLastMessage?.data)));
+      debouncedSetDataHandler(JSON.parse(spreadLastMessage?.data));
     }
   }, [spreadLastMessage?.data]);
 